@@ -1,15 +1,34 @@
+import asyncio
 import json
 import os
-from math import floor
 
-import requests
 import tekore
 from dotenv import load_dotenv
-from flask import Flask, abort, g, redirect, render_template, request, session
+from flask import (
+    Flask,
+    Response,
+    abort,
+    g,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    session,
+)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
+import assets
+import compilation
+import favorites
+import follow_import
+import fragments
+import httpcache
+import metrics
+import profiler
+import shows
+from dbpool import engine_options, pool_metrics, replica_pool_metrics
 from forms import (
     ForgotPassAnswer,
     ForgotPassUsername,
@@ -18,17 +37,42 @@ from forms import (
     RegisterForm,
     UserEditForm,
 )
+from httpcache import cache_page, upstream_window
 from models import (
     Band,
     Favorite,
+    Import_Job,
     Playlist,
     Playlist_Song,
     Song,
     User,
-    User_Playlist,
     connect_db,
     db,
 )
+from passwords import HashingBusy, hasher
+from playlists import (
+    build_setlist_playlist,
+    edit_for_user,
+    fill_playlist,
+    save_to_spotify,
+    user_version,
+)
+from ratelimit import RateLimitExceeded
+from routing import REPLICA_BIND, read_primary, replica_reads, shared_writes
+from setlist_stats import (
+    PREDICTED_ID,
+    cache_setlists,
+    predicted_id,
+    predicted_setlist,
+    refresh_song_stats,
+)
+from throttle import Throttled, failed, succeeded, throttled
+from upstream import (
+    UpstreamUnavailable,
+    bandsintown_get,
+    setlistfm_get,
+    spotify_sender,
+)
 
 load_dotenv()
 
@@ -40,21 +84,34 @@ if uri.startswith("postgres://"):
     uri = uri.replace("postgres://", "postgresql://", 1)
 
 app.config["SQLALCHEMY_DATABASE_URI"] = uri
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(uri)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ECHO"] = False
 app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = False
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "secret!")
 app.config["SESSION_COOKIE_SECURE"] = True
 app.config["SESSION_COOKIE_HTTPONLY"] = True
+app.config["CATALOG_PRELOAD"] = os.environ.get("CATALOG_PRELOAD", "") == "true"
+app.config["CATALOG_MAX_AGE_HOURS"] = int(os.environ.get("CATALOG_MAX_AGE_HOURS", 24))
+# Bearer token for /metrics and /status, they 404 without it
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+replica_uri = os.getenv("DATABASE_REPLICA_URL")
+if replica_uri:
+    if replica_uri.startswith("postgres://"):
+        replica_uri = replica_uri.replace("postgres://", "postgresql://", 1)
+    app.config["SQLALCHEMY_BINDS"] = {REPLICA_BIND: replica_uri}
 
 CURR_USER_KEY = os.environ.get("CURR_USER_KEY")
+# Most artists Spotify returns in one request or page
+SPOTIFY_ARTISTS_PER_REQUEST = 50
 APP_TOKEN = tekore.request_client_token(
     os.environ.get("SPOTIFY_CLIENT_ID"), os.environ.get("SPOTIFY_CLIENT_SECRET")
 )
 
 conf = tekore.config_from_environment(return_refresh=True)
 cred = tekore.RefreshingCredentials(*conf)
-spotify = tekore.Spotify(APP_TOKEN)
+spotify = tekore.Spotify(APP_TOKEN, sender=spotify_sender(APP_TOKEN))
 
 auths = {}
 auths["APP_TOKEN"] = APP_TOKEN
@@ -63,12 +120,19 @@ scope = (
     + tekore.scope.playlist_read_private
     + tekore.scope.user_read_private
     + tekore.scope.playlist_read_collaborative
+    + tekore.scope.user_follow_read
 )
 
 
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+metrics.install_app(app)
+profiler.install_app(app)
+httpcache.install_app(app)
+assets.install_app(app)
+favorites.install_app(app)
+follow_import.install_app(app)
 
 ##################
 # Global Methods ################################################
@@ -93,34 +157,129 @@ def session_logout():
     return None
 
 
-@app.context_processor
-def utility_processor():
+def get_spotify_artist(band_id):
     """
-    Creates a dict that contains methods to be used within Jinja templates
+    - Returns the band from Spotify (dict)
+    - Made with the app's token whichever user is asking, so concurrent
+      lookups of the same band share one request and its cached response
     """
+    with spotify.token_as(APP_TOKEN):
+        return json.loads(spotify.artist(band_id).json())
 
-    def format_setlist_display(set):
-        """
-        Returns setlist details arranged in venue name - event date - venue location
-        """
-        venue_name = set["venue"]["name"]
-        event_date = set["eventDate"]
-        try:
-            state_code = set["venue"]["city"]["stateCode"]
-        except KeyError:
-            state_code = ""
-        venue_loc = (
-            set["venue"]["city"]["name"]
-            + ", "
-            + state_code
-            + ", "
-            + set["venue"]["city"]["country"]["code"]
+
+def get_spotify_artists(band_ids):
+    """
+    Returns the bands from Spotify (dicts), 50 per request, None for unknown ids
+    """
+    artists = []
+    for i in range(0, len(band_ids), SPOTIFY_ARTISTS_PER_REQUEST):
+        with spotify.token_as(APP_TOKEN):
+            res = spotify.artists(band_ids[i : i + SPOTIFY_ARTISTS_PER_REQUEST])
+        artists.extend(
+            None if artist is None else json.loads(artist.json()) for artist in res
         )
-        if venue_name == "":
-            venue_name = "Venue Unknown"
-        return f"{venue_name} - {event_date} - {venue_loc}"
+    return artists
+
+
+def get_followed_artists(token):
+    """
+    Yields the artists a user follows on Spotify a page at a time, as
+    (artists (dicts), total followed), fetching each page when it's needed
+    """
+    after = None
+    while True:
+        with spotify.token_as(token):
+            page = spotify.followed_artists(
+                limit=SPOTIFY_ARTISTS_PER_REQUEST, after=after
+            )
+        yield [json.loads(artist.json()) for artist in page.items], page.total
+        after = page.cursors.after if page.cursors else None
+        if page.next is None or after is None or not page.items:
+            break
+
+
+def get_band_setlists(band_name):
+    """
+    - Get band from Setlist.fm using band_name
+    - Get setlists for band from Setlist.fm using Setlist.fm mbid
+    - Returns the setlists, or None if there are none or Setlist.fm is down
+    """
+    try:
+        res = setlistfm_get(
+            "/search/artists",
+            params=[("artistName", band_name), ("sort", "relevance")],
+        )
+    except (UpstreamUnavailable, RateLimitExceeded):
+        return None
+
+    fm_band = None
+
+    try:
+        if res["artist"][0]["name"].lower() == band_name.lower():
+            fm_band = res["artist"][0]
+        else:
+            for band in res["artist"]:
+                if band["name"].lower() == band_name.lower():
+                    fm_band = band
+    except KeyError:
+        fm_band = None
+
+    if fm_band is None:
+        return None
+
+    try:
+        res = setlistfm_get(f"/artist/{fm_band['mbid']}/setlists")
+        return res["setlist"]
+    except (KeyError, UpstreamUnavailable, RateLimitExceeded):
+        return None
+
+
+def get_upcoming_shows(band_name):
+    """
+    - Get upcoming shows for band from Bandsintown using band_name
+    - Returns the shows, or None if there are none or Bandsintown is down
+    """
+    bit_search_name = Band.bit_prep_band_name(band_name)
+
+    try:
+        upcoming_shows = bandsintown_get("/artists/" + bit_search_name + "/events/")
+    except (UpstreamUnavailable, RateLimitExceeded):
+        return None
+
+    if type(upcoming_shows) != list:
+        return None
+    return upcoming_shows
+
 
-    return dict(format_setlist_display=format_setlist_display)
+def search_version():
+    """
+    Data version of the search page for cache_page, results come from Spotify
+    """
+    search = request.args.get("search")
+    if not search:
+        return None
+    return search, upstream_window()
+
+
+def band_version(band_id):
+    """
+    Data version of a band's page for cache_page, signed out users only see
+    the band's Spotify details
+    """
+    return band_id, upstream_window()
+
+
+@app.context_processor
+def utility_processor():
+    """
+    Creates a dict that contains methods to be used within Jinja templates
+    - The user-independent sections render through the fragment cache
+    """
+    return dict(
+        band_setlists=fragments.band_setlists,
+        band_upcoming_shows=fragments.band_upcoming_shows,
+        playlist_songs=fragments.playlist_songs,
+    )
 
 
 @app.before_request
@@ -208,8 +367,8 @@ def spotify_callback():
         db.session.add(user)
         db.session.commit()
 
-        spotify.token = token
-        res = spotify.current_user().json()
+        with spotify.token_as(token):
+            res = spotify.current_user().json()
         user_profile = json.loads(res)
         user.spotify_user_id = user_profile["id"]
         db.session.add(user)
@@ -221,6 +380,7 @@ def spotify_callback():
 
 
 @app.route("/login", methods=["GET", "POST"])
+@throttled("login")
 def login():
     """
     GET ROUTE:
@@ -238,9 +398,13 @@ def login():
         user = User.authenticate(form.username.data, form.password.data)
 
         if user:
+            # Saves the password if it was rehashed
+            db.session.commit()
+            succeeded()
             session_login(user)
 
             return redirect("/user/home")
+        failed()
         form.username.errors.append("Invalid username/password")
 
     return render_template("auth.html", form=form, title="Login", q_display="")
@@ -262,6 +426,7 @@ def logout():
 
 
 @app.route("/forgot", methods=["GET", "POST"])
+@throttled("reset")
 def forgot_password_check_username():
     """
     GET ROUTE:
@@ -283,6 +448,7 @@ def forgot_password_check_username():
         try:
             user = User.query.filter_by(username=form.username.data).one()
         except NoResultFound or MultipleResultsFound:
+            failed()
             form.username.errors.append("Username not found")
             return render_template(
                 "auth.html", title="Forgot Password", form=form, q_display=""
@@ -297,6 +463,7 @@ def forgot_password_check_username():
 
 
 @app.route("/forgot/<int:user_id>", methods=["GET", "POST"])
+@throttled("reset", account=lambda user_id: f"#{user_id}")
 def forgot_password_check_secret_question(user_id):
     """
     GET ROUTE:
@@ -318,8 +485,12 @@ def forgot_password_check_secret_question(user_id):
 
     if form.validate_on_submit():
         if User.authenticate_secret_answer(user.username, form.secret_answer.data):
+            # Saves the answer if it was rehashed
+            db.session.commit()
+            succeeded()
             return redirect(f"/forgot/{user.id}/new")
         else:
+            failed()
             form.secret_answer.errors.append("Invalid secret answer")
 
     form.secret_question.data = user.secret_question
@@ -376,6 +547,7 @@ def forgot_password_new_password(user_id):
 
 
 @app.route("/")
+@cache_page()
 def landing():
     """
     GET ROUTE:
@@ -394,18 +566,41 @@ def landing():
 
 
 @app.route("/user/home")
+@replica_reads
 def homepage():
     """
     GET ROUTE:
     - If user logged out, redirect to '/'
-    - If logged in, return logged in homepage
+    - If logged in, return logged in homepage with the user's bands playing
+      soon
     """
     if not g.user:
         return redirect("/")
 
-    recent_playlists = Playlist.query.order_by(Playlist.id.desc()).limit(10).all()
+    recent_playlists = Playlist.shared().order_by(Playlist.id.desc()).limit(10).all()
+    upcoming_shows = shows.user_upcoming(g.user.id)
 
-    return render_template("/user/home.html", recent_playlists=recent_playlists)
+    return render_template(
+        "/user/home.html",
+        recent_playlists=recent_playlists,
+        upcoming_shows=upcoming_shows,
+    )
+
+
+@app.route("/user/auto-playlists", methods=["POST"])
+def toggle_auto_playlists():
+    """
+    POST ROUTE:
+    - Turn saving playlists of new setlists by the user's favorite bands to
+      their Spotify on or off
+    """
+    if not g.user:
+        abort(403)
+
+    g.user.auto_playlists = not g.user.auto_playlists
+    db.session.commit()
+
+    return redirect("/user/home")
 
 
 @app.route("/user/edit/<int:user_id>", methods=["GET", "POST"])
@@ -492,96 +687,51 @@ def edit_user(user_id):
 
 
 @app.route("/band/<band_id>")
-def show_band_details(band_id):
+@replica_reads
+@cache_page(band_version)
+async def show_band_details(band_id):
     """
     GET ROUTE:
     - Check if band already in database
     - Get band from Spotify with band_id
     - Sets band_image and band_name
-    - Get band from Setlist.fm using band_name
-    - Get setlists for band from Setlist.fm using Setlist.fm mbid
-    - Get upcoming shows for band from Bandsintown using band_name
+    - Get setlists for band from Setlist.fm
+    - Get upcoming shows for band from Bandsintown
+    - Upstream calls that don't depend on each other run concurrently
     """
-    band = Band.query.filter_by(spotify_artist_id=band_id).first()
+    band_db = Band.query.filter_by(spotify_artist_id=band_id).first()
 
-    if band is None:
-        # Spotify
-        res = spotify.artist(band_id)
+    if band_db is None:
+        # Spotify first, the band's name is needed for the other searches
+        sp_band = await asyncio.to_thread(get_spotify_artist, band_id)
+        setlists, upcoming_shows = await asyncio.gather(
+            asyncio.to_thread(get_band_setlists, sp_band["name"]),
+            asyncio.to_thread(get_upcoming_shows, sp_band["name"]),
+        )
     else:
-        res = spotify.artist(band.spotify_artist_id)
-
-    json_res = res.json()
-    sp_band = json.loads(json_res)
-
-    band_name = sp_band["name"]
+        sp_band, setlists, upcoming_shows = await asyncio.gather(
+            asyncio.to_thread(get_spotify_artist, band_db.spotify_artist_id),
+            asyncio.to_thread(get_band_setlists, band_db.name),
+            asyncio.to_thread(get_upcoming_shows, band_db.name),
+        )
 
     try:
         band_image = sp_band["images"][0]["url"]
     except IndexError:
         band_image = "/static/img/rocco-dipoppa-_uDj_lyPVpA-unsplash.jpg"
 
-    # Setlist.fm search band
-    url = os.environ.get("SETLIST_FM_BASE_URL") + "/search/artists"
-    res = requests.get(
-        url,
-        headers={
-            "Accept": "application/json",
-            "x-api-key": os.environ.get("SETLIST_FM_API_KEY"),
-        },
-        params=[("artistName", band_name), ("sort", "relevance")],
-    ).json()
-
-    fm_band = {}
-
-    try:
-        if res["artist"][0]["name"].lower() == band_name.lower():
-            fm_band = res["artist"][0]
-        else:
-            for band in res["artist"]:
-                if band["name"].lower() == band_name.lower():
-                    fm_band = band
-    except KeyError:
-        fm_band = None
-
-    # Setlist.fm setlists search
-    if fm_band is not None:
-        url = (
-            os.environ.get("SETLIST_FM_BASE_URL")
-            + f"/artist/{fm_band['mbid']}/setlists"
-        )
-
-        res = requests.get(
-            url,
-            headers={
-                "Accept": "application/json",
-                "x-api-key": os.environ.get("SETLIST_FM_API_KEY"),
-            },
-        ).json()
-
-        try:
-            setlists = res["setlist"]
-        except KeyError:
-            setlists = None
-    else:
-        setlists = None
-
-    # Bandsintown Upcoming Events Search
-    bit_search_name = Band.bit_prep_band_name(band_name)
-
-    url = (
-        os.environ.get("BANDSINTOWN_BASE_URL")
-        + "/artists/"
-        + bit_search_name
-        + "/events/"
-    )
-    upcoming_shows = requests.get(
-        url,
-        headers={"accept": "application/json"},
-        params=[("app_id", os.environ.get("BIT_APP_ID"))],
-    ).json()
-
-    if type(upcoming_shows) != list:
-        upcoming_shows = None
+    # Cache setlists and update the band's song stats with any new ones
+    if band_db is not None and setlists:
+        # Check the cache against the primary, the replica may lag behind
+        read_primary()
+        with shared_writes():
+            try:
+                cache_setlists(band_db, setlists)
+                db.session.commit()
+            except IntegrityError:
+                # A concurrent request cached them first
+                db.session.rollback()
+            refresh_song_stats(band_db)
 
     return render_template(
         "/band/band-detail.html",
@@ -596,61 +746,91 @@ def show_band_details(band_id):
 def add_to_favorites(band_id):
     """
     POST ROUTE:
-    - If band is not in database
-        - Get info and add band to database
     - Add or remove the band from the user's favorites
+    - If band is not in database, add it from Spotify
     """
     if not g.user:
         abort(403)
 
-    band_db = Band.query.filter_by(spotify_artist_id=band_id).first()
+    favorites.save_favorites(g.user, [band_id], "toggle", get_spotify_artists)
 
-    if band_db in g.user.favorites:
-        fav = Favorite.query.filter_by(band_id=band_db.id, user_id=g.user.id).one()
-        db.session.delete(fav)
-        db.session.commit()
-    else:
-        if band_db is None:
-            token = cred.refresh_user_token(g.user.spotify_user_token)
-            spotify.token = token
+    return redirect("/user/home")
 
-            res = spotify.artist(band_id).json()
-            sp_band = json.loads(res)
 
-            try:
-                band_image = sp_band["images"][0]["url"]
-            except IndexError:
-                band_image = "/static/img/rocco-dipoppa-_uDj_lyPVpA-unsplash.jpg"
-
-            url = os.environ.get("SETLIST_FM_BASE_URL") + "/search/artists"
-            res = requests.get(
-                url,
-                headers={
-                    "Accept": "application/json",
-                    "x-api-key": os.environ.get("SETLIST_FM_API_KEY"),
-                },
-                params=[("artistName", sp_band["name"])],
-            ).json()
+@app.route("/favorites", methods=["GET", "POST"])
+def favorites_api():
+    """
+    GET ROUTE:
+    - Returns the user's favorites (JSON)
+    --------------------
+    POST ROUTE:
+    - Takes {"action": "add"|"remove"|"toggle", "band_ids": [...]} (JSON) of
+      Spotify artist ids
+    - Adds, removes or toggles the bands in one transaction
+    - Returns the Spotify ids added and removed (JSON)
+    """
+    if not g.user:
+        abort(403)
 
-            for band in res["artist"]:
-                if band["name"].lower() == sp_band["name"].lower():
-                    fm_band = band
+    if request.method == "GET":
+        bands = (
+            Band.query.join(Favorite, Favorite.band_id == Band.id)
+            .filter(Favorite.user_id == g.user.id)
+            .order_by(Band.name)
+        )
+        return jsonify(
+            favorites=[
+                {"band_id": band.spotify_artist_id, "name": band.name} for band in bands
+            ]
+        )
 
-            band_db = Band(
-                spotify_artist_id=band_id,
-                setlistfm_artist_id=fm_band["mbid"],
-                name=sp_band["name"],
-                photo=band_image,
-            )
+    data = request.get_json(silent=True) or {}
+    action = data.get("action", "toggle")
+    band_ids = data.get("band_ids")
+    if (
+        action not in favorites.ACTIONS
+        or not isinstance(band_ids, list)
+        or not all(isinstance(band_id, str) for band_id in band_ids)
+        or len(band_ids) > favorites.MAX_BATCH
+    ):
+        return jsonify(error="Invalid favorites update"), 400
+
+    return jsonify(
+        favorites.save_favorites(g.user, band_ids, action, get_spotify_artists)
+    )
 
-            db.session.add(band_db)
-            db.session.commit()
 
-        new_fav = Favorite(user_id=g.user.id, band_id=band_db.id)
-        db.session.add(new_fav)
-        db.session.commit()
+@app.route("/favorites/import", methods=["POST"])
+def import_followed_artists():
+    """
+    POST ROUTE:
+    - Starts importing the bands the user follows on Spotify as favorites, or
+      returns the import already in progress
+    - Returns the import's progress (JSON)
+    """
+    if not g.user:
+        abort(403)
+    if not g.user.spotify_user_token:
+        return jsonify(error="Connect Spotify to import followed artists"), 400
 
-    return redirect("/user/home")
+    token = cred.refresh_user_token(g.user.spotify_user_token)
+    job = follow_import.importer.start(g.user.id, get_followed_artists(token))
+
+    return jsonify(job.serialize()), 202
+
+
+@app.route("/favorites/import/<int:job_id>")
+def show_import(job_id):
+    """
+    GET ROUTE:
+    - Returns the progress of one of the user's imports (JSON)
+    """
+    if not g.user:
+        abort(403)
+
+    job = Import_Job.query.filter_by(id=job_id, user_id=g.user.id).first_or_404()
+
+    return jsonify(job.serialize())
 
 
 ######################
@@ -659,17 +839,20 @@ def add_to_favorites(band_id):
 
 
 @app.route("/band/search")
-def search_results():
+@cache_page(search_version)
+async def search_results():
     """
     GET ROUTE:
     - Display search results
     OR
     - Display search form
     """
-    spotify.token = auths["APP_TOKEN"]
     if request.args.get("search"):
         search = request.args.get("search")
-        res = spotify.search("artist: " + search, types=["artist"])
+        with spotify.token_as(auths["APP_TOKEN"]):
+            res = await asyncio.to_thread(
+                spotify.search, "artist: " + search, types=["artist"]
+            )
         json_res = res[0].json()
         band_results = json.loads(json_res)
 
@@ -686,43 +869,40 @@ def search_results():
 
 
 @app.route("/playlist/show/<band_id>/<setlist_id>")
-def show_setlist(band_id, setlist_id):
+@replica_reads
+async def show_setlist(band_id, setlist_id):
     """
     GET ROUTE:
     - Get band from Spotify with band_id
-    - Get setlist from Setlist.fm with setlist_id
+    - Get setlist from Setlist.fm with setlist_id, alongside the Spotify call
     - Arrange data for display
     - Display page with data
     """
     if not g.user:
         return redirect("/login")
 
-    token = cred.refresh_user_token(g.user.spotify_user_token)
-    spotify.token = token
     saved = False
 
-    res = spotify.artist(band_id).json()
-    sp_band = json.loads(res)
-
     band_db = Band.query.filter_by(spotify_artist_id=band_id).first()
 
     if band_db is not None:
-        playlist_db = Playlist.query.filter_by(
-            setlistfm_setlist_id=setlist_id, band_id=band_db.id
-        ).first()
+        playlist_db = (
+            Playlist.shared()
+            .filter_by(setlistfm_setlist_id=setlist_id, band_id=band_db.id)
+            .first()
+        )
     else:
         playlist_db = None
 
     if playlist_db is None:
-        url = os.environ.get("SETLIST_FM_BASE_URL") + f"/setlist/{setlist_id}"
-        res = requests.get(
-            url,
-            headers={
-                "Accept": "application/json",
-                "x-api-key": os.environ.get("SETLIST_FM_API_KEY"),
-            },
-        ).json()
+        sp_band, res = await asyncio.gather(
+            asyncio.to_thread(get_spotify_artist, band_id),
+            asyncio.to_thread(setlistfm_get, f"/setlist/{setlist_id}"),
+        )
+    else:
+        sp_band = await asyncio.to_thread(get_spotify_artist, band_id)
 
+    if playlist_db is None:
         setlist = res["sets"]["set"]
 
         songs = []
@@ -779,12 +959,13 @@ def show_setlist(band_id, setlist_id):
 
 
 @app.route("/playlist/create/<band_id>/<setlist_id>", methods=["POST"])
-def create_playlist(band_id, setlist_id):
+async def create_playlist(band_id, setlist_id):
     """
     POST ROUTE:
     - If band not in databse, get info and create band
     - If playlist not in database, get info and create playlist
     - Put songs in to playlist
+        - Songs are searched for concurrently
         - If songs are not in database, create them
     - Add the playlist to the user's playlists
     - Add the playlist to the user's Spotify
@@ -793,31 +974,32 @@ def create_playlist(band_id, setlist_id):
         abort(403)
 
     token = cred.refresh_user_token(g.user.spotify_user_token)
-    spotify.token = token
 
+    with spotify.token_as(token):
+        return await build_playlist(band_id, setlist_id)
+
+
+async def build_playlist(band_id, setlist_id):
+    """
+    - Creates the band and playlist for create_playlist if needed
+    - Saves the playlist to the user's playlists and Spotify
+    - Returns the result page
+    """
     band_db = Band.query.filter_by(spotify_artist_id=band_id).first()
-    playlist_db = Playlist.query.filter_by(setlistfm_setlist_id=setlist_id).first()
+    playlist_db = Playlist.shared().filter_by(setlistfm_setlist_id=setlist_id).first()
     playlist_call = None
-    setlist = None
     sp_band = None
-    not_included = []
 
     if band_db is None:
-        res = spotify.artist(band_id).json()
-        sp_band = json.loads(res)
-
         if playlist_db is None:
-            url = os.environ.get("SETLIST_FM_BASE_URL") + f"/setlist/{setlist_id}"
-            playlist_call = requests.get(
-                url,
-                headers={
-                    "Accept": "application/json",
-                    "x-api-key": os.environ.get("SETLIST_FM_API_KEY"),
-                },
-            ).json()
+            sp_band, playlist_call = await asyncio.gather(
+                asyncio.to_thread(get_spotify_artist, band_id),
+                asyncio.to_thread(setlistfm_get, f"/setlist/{setlist_id}"),
+            )
             setlist_fm_artist_id = playlist_call["artist"]["mbid"]
         else:
-            setlist_fm_artist_id = playlist_db.band.setlist_artist_id
+            sp_band = await asyncio.to_thread(get_spotify_artist, band_id)
+            setlist_fm_artist_id = playlist_db.band.setlistfm_artist_id
 
         try:
             band_image = sp_band["images"][0]["url"]
@@ -834,127 +1016,18 @@ def create_playlist(band_id, setlist_id):
         db.session.commit()
 
     if playlist_db is None:
-        url = os.environ.get("SETLIST_FM_BASE_URL") + f"/setlist/{setlist_id}"
-        playlist_call = requests.get(
-            url,
-            headers={
-                "Accept": "application/json",
-                "x-api-key": os.environ.get("SETLIST_FM_API_KEY"),
-            },
-        ).json()
-        setlist = playlist_call["sets"]["set"]
-
-        venue_name = playlist_call["venue"]["name"]
-        play_name = band_db.name + " @ " + venue_name
-        event_date = playlist_call["eventDate"]
-        try:
-            tour_name = playlist_call["tour"]["name"]
-        except KeyError:
-            tour_name = "N/A"
-        venue_loc = (
-            playlist_call["venue"]["city"]["name"]
-            + ", "
-            + playlist_call["venue"]["city"]["state"]
-        )
-        play_desc = (
-            play_name
-            + " in "
-            + venue_loc
-            + " on "
-            + event_date
-            + ". Tour - "
-            + tour_name
-        )
-        length = 0
-        band_id = band_db.id
-
-        playlist_db = Playlist(
-            spotify_playlist_id="None Yet",
-            setlistfm_setlist_id=setlist_id,
-            name=play_name,
-            description=play_desc,
-            tour_name=tour_name,
-            venue_name=venue_name,
-            event_date=event_date,
-            venue_loc=venue_loc,
-            length=length,
-            band_id=band_db.id,
-        )
-        db.session.add(playlist_db)
+        if playlist_call is None:
+            playlist_call = await asyncio.to_thread(
+                setlistfm_get, f"/setlist/{setlist_id}"
+            )
+        # Songs are searched for concurrently, the playlist is only saved
+        # once they're resolved
+        playlist_db = build_setlist_playlist(spotify, band_db, playlist_call)
         db.session.commit()
 
-        playlist = []
-        uris = []
-        dur = 0
-
-        for set in setlist:
-            for song in set["song"]:
-                res = spotify.search(
-                    query=("track: " + song["name"] + " artist: " + band_db.name),
-                    types=["track"],
-                    limit=1,
-                )
-                json_res = res[0].json()
-                song_res = json.loads(json_res)
-
-                try:
-                    spotify_song_id = song_res["items"][0]["id"]
-                    name = song_res["items"][0]["name"]
-                    duration = floor(song_res["items"][0]["duration_ms"] / 1000)
-
-                    song_db = Song.query.filter_by(
-                        spotify_song_id=spotify_song_id, name=name, duration=duration
-                    ).first()
-
-                    if song_db is None:
-                        song_db = Song(
-                            spotify_song_id=spotify_song_id,
-                            name=name,
-                            duration=duration,
-                            band_id=band_db.id,
-                        )
-                        db.session.add(song_db)
-                        db.session.commit()
-                        uris.append("spotify:track:" + song_db.spotify_song_id)
-                        dur += duration
-
-                    new_song_relate = Playlist_Song(
-                        playlist_id=playlist_db.id, song_id=song_db.id
-                    )
-                    db.session.add(new_song_relate)
-                    db.session.commit()
+    copy = save_to_spotify(spotify, g.user, playlist_db)
 
-                    playlist.append(song_db)
-                except IndexError:
-                    not_included.append(song["name"])
-
-            play_duration = Playlist.format_duration(dur)
-
-            playlist_db.length = len(playlist)
-            playlist_db.duration = play_duration
-            db.session.add(playlist_db)
-            db.session.commit()
-
-    new_relate_playlist = User_Playlist(user_id=g.user.id, playlist_id=playlist_db.id)
-    db.session.add(new_relate_playlist)
-    db.session.commit()
-
-    json_res = spotify.playlist_create(
-        user_id=g.user.spotify_user_id,
-        name=playlist_db.name,
-        public=False,
-        description=playlist_db.description,
-    ).json()
-    res = json.loads(json_res)
-
-    playlist_db.spotify_playlist_id = res["id"]
-    playlist_db.spotify_playlist_url = res["external_urls"]["spotify"]
-    db.session.add(playlist_db)
-    db.session.commit()
-
-    spotify.playlist_add(playlist_id=playlist_db.spotify_playlist_id, uris=uris)
-
-    return render_template("/playlist/result.html", playlist=playlist_db)
+    return render_template("/playlist/result.html", playlist=playlist_db, copy=copy)
 
 
 @app.route("/playlist/hype-create/<band_id>", methods=["POST"])
@@ -971,13 +1044,21 @@ def create_hype_playlist(band_id):
     """
     if not g.user:
         abort(403)
+
     token = cred.refresh_user_token(g.user.spotify_user_token)
-    spotify.token = token
 
+    with spotify.token_as(token):
+        return build_hype_playlist(band_id)
+
+
+def build_hype_playlist(band_id):
+    """
+    - Creates the band and hype playlist for create_hype_playlist if needed
+    - Saves the playlist to the user's playlists and Spotify
+    - Returns the result page
+    """
     band_db = Band.query.filter_by(spotify_artist_id=band_id).first()
-    setlist = None
     sp_band = None
-    uris = []
 
     if band_db is None:
         json_res = spotify.artist(band_id).json()
@@ -988,15 +1069,7 @@ def create_hype_playlist(band_id):
         except IndexError:
             band_image = "/static/img/rocco-dipoppa-_uDj_lyPVpA-unsplash.jpg"
 
-        url = os.environ.get("SETLIST_FM_BASE_URL") + "/search/artists"
-        res = requests.get(
-            url,
-            headers={
-                "Accept": "application/json",
-                "x-api-key": os.environ.get("SETLIST_FM_API_KEY"),
-            },
-            params=[("artistName", sp_band["name"])],
-        ).json()
+        res = setlistfm_get("/search/artists", params=[("artistName", sp_band["name"])])
 
         for band in res["artist"]:
             if band["name"].lower() == sp_band["name"].lower():
@@ -1012,9 +1085,11 @@ def create_hype_playlist(band_id):
         db.session.add(band_db)
         db.session.commit()
 
-    playlist_db = Playlist.query.filter_by(
-        setlistfm_setlist_id="Hype", band_id=band_db.id
-    ).first()
+    playlist_db = (
+        Playlist.shared()
+        .filter_by(setlistfm_setlist_id="Hype", band_id=band_db.id)
+        .first()
+    )
 
     if playlist_db is None:
 
@@ -1033,80 +1108,134 @@ def create_hype_playlist(band_id):
             band_id=band_db.id,
         )
 
-        db.session.add(playlist_db)
-        db.session.commit()
-
         res = spotify.artist_top_tracks(band_id, "US")
 
         order = [1, 3, 5, 7, 9, 8, 6, 4, 2, 0]
-        setlist = []
-        songs = []
+        tracks = [
+            {"id": track.id, "name": track.name, "duration_ms": track.duration_ms}
+            for track in res
+        ]
+        tracks = [tracks[i] for i in order if i < len(tracks)]
+
+        fill_playlist(
+            spotify,
+            band_db,
+            playlist_db,
+            [{"name": track["name"]} for track in tracks],
+            tracks,
+        )
+        db.session.commit()
 
-        playlist = []
+    copy = save_to_spotify(spotify, g.user, playlist_db)
 
-        for song in res:
-            setlist.append(song)
+    return render_template("/playlist/result.html", playlist=playlist_db, copy=copy)
 
-        for i in order:
-            song = setlist[i]
-            songs.append(song)
 
-        dur = 0
-
-        for song in songs:
-            song_db = Song.query.filter_by(
-                spotify_song_id=song.id, name=song.name
-            ).first()
-
-            if song_db is None:
-                song_db = Song(
-                    spotify_song_id=song.id,
-                    name=song.name,
-                    duration=floor(song.duration_ms / 1000),
-                    band_id=band_db.id,
-                )
-                db.session.add(song_db)
-                db.session.commit()
-                dur += floor(song.duration_ms / 1000)
+@app.route("/playlist/compile/<band_id>", methods=["POST"])
+def create_compilation_playlist(band_id):
+    """
+    POST ROUTE:
+    - Compile one playlist from many of the band's shows, given as setlist_ids
+      or as a tour name
+        - Setlists are fetched concurrently, the tour's pages too
+        - Each song is in once, most played first
+        - Each song is searched for once
+    - If band not in database, create band
+    - Add the playlist to the user's playlists
+    - Add the playlist to the user's Spotify
+    """
+    if not g.user:
+        abort(403)
+
+    setlist_ids = compilation.parse_setlist_ids(request.form.getlist("setlist_ids"))
+    tour_name = request.form.get("tour", "").strip() or None
+    if not setlist_ids and tour_name is None:
+        return redirect(f"/band/{band_id}")
 
-            uris.append("spotify:track:" + song_db.spotify_song_id)
+    token = cred.refresh_user_token(g.user.spotify_user_token)
 
-            new_song_relate = Playlist_Song(
-                playlist_id=playlist_db.id, song_id=song_db.id
+    with spotify.token_as(token):
+        band_db = Band.query.filter_by(spotify_artist_id=band_id).first()
+        if band_db is None:
+            band_db = favorites.band_from_artist(get_spotify_artist(band_id))
+            db.session.add(band_db)
+        if band_db.setlistfm_artist_id == favorites.PENDING:
+            band_db.setlistfm_artist_id = (
+                favorites.find_setlistfm_artist(band_db.name) or favorites.PENDING
             )
-            db.session.add(new_song_relate)
-            db.session.commit()
+        db.session.commit()
 
-            playlist.append(song_db)
+        if setlist_ids:
+            setlists = compilation.get_setlists(setlist_ids)
+        else:
+            setlists = compilation.tour_setlists(band_db.setlistfm_artist_id, tour_name)
 
-        playlist_db.length = len(playlist)
-        playlist_db.duration = Playlist.format_duration(init_duration=dur)
-        db.session.add(playlist_db)
-        db.session.commit()
+        playlist_db = compilation.build_compilation(
+            spotify, band_db, setlists, tour_name
+        )
+        if playlist_db is None:
+            return redirect(f"/band/{band_id}")
 
-    new_relate_playlist = User_Playlist(user_id=g.user.id, playlist_id=playlist_db.id)
-    db.session.add(new_relate_playlist)
-    db.session.commit()
+        copy = save_to_spotify(spotify, g.user, playlist_db)
 
-    json_res = spotify.playlist_create(
-        user_id=g.user.spotify_user_id,
-        name=playlist_db.name,
-        public=False,
-        description=playlist_db.description,
-    ).json()
-    res = json.loads(json_res)
-
-    playlist_db.spotify_playlist_id = res["id"]
-    playlist_db.spotify_playlist_url = res["external_urls"]["spotify"]
-    db.session.add(playlist_db)
-    db.session.commit()
+    return render_template("/playlist/result.html", playlist=playlist_db, copy=copy)
 
-    spotify.playlist_add(playlist_id=playlist_db.spotify_playlist_id, uris=uris)
 
-    return render_template("/playlist/result.html", playlist=playlist_db)
+@app.route("/playlist/<int:playlist_id>/songs", methods=["GET", "POST"])
+def playlist_songs_api(playlist_id):
+    """
+    GET ROUTE:
+    - Returns the songs of the user's version of the playlist (JSON)
+    --------------------
+    POST ROUTE:
+    - Takes {"song_ids": [...]} (JSON), the playlist's songs to keep in their
+      new order
+    - The first edit gives the user their own copy of the shared playlist,
+      other users' playlists don't change
+    - Updates the user's Spotify playlist if they've saved it
+    - Returns the edited playlist's songs (JSON)
+    """
+    if not g.user:
+        abort(403)
+
+    playlist_db = Playlist.query.get_or_404(playlist_id)
+    if playlist_db.owner_id not in (None, g.user.id):
+        abort(404)
+
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        song_ids = data.get("song_ids")
+        if not isinstance(song_ids, list) or not all(
+            isinstance(song_id, int) for song_id in song_ids
+        ):
+            return jsonify(error="Invalid playlist update"), 400
+
+        token = cred.refresh_user_token(g.user.spotify_user_token)
+        try:
+            with spotify.token_as(token):
+                playlist_db = edit_for_user(spotify, g.user, playlist_db, song_ids)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+    else:
+        playlist_db = user_version(g.user.id, playlist_db)
+
+    songs = (
+        db.session.query(Song.id, Song.name)
+        .join(Playlist_Song, Playlist_Song.song_id == Song.id)
+        .filter(Playlist_Song.playlist_id == playlist_db.id)
+        .order_by(Playlist_Song.id)
+    )
+    return jsonify(
+        playlist_id=playlist_db.id,
+        forked_from_id=playlist_db.forked_from_id,
+        length=playlist_db.length,
+        duration=playlist_db.duration,
+        songs=[{"song_id": song_id, "name": name} for song_id, name in songs],
+    )
 
 
 @app.route("/playlist/hype/<band_id>")
+@replica_reads
 def show_hype_setlist(band_id):
     """
     GET ROUTE:
@@ -1118,24 +1247,25 @@ def show_hype_setlist(band_id):
         return redirect("/login")
 
     token = cred.refresh_user_token(g.user.spotify_user_token)
-    spotify.token = token
     saved = False
 
     band_db = Band.query.filter_by(spotify_artist_id=band_id).first()
 
     if band_db is not None:
-        playlist_db = Playlist.query.filter_by(
-            setlistfm_setlist_id="Hype", band_id=band_db.id
-        ).first()
+        playlist_db = (
+            Playlist.shared()
+            .filter_by(setlistfm_setlist_id="Hype", band_id=band_db.id)
+            .first()
+        )
     else:
         playlist_db = None
 
-    json_res = spotify.artist(band_id).json()
-    sp_band = json.loads(json_res)
+    sp_band = get_spotify_artist(band_id)
 
     if playlist_db is None:
 
-        res = spotify.artist_top_tracks(band_id, "US")
+        with spotify.token_as(token):
+            res = spotify.artist_top_tracks(band_id, "US")
 
         order = [1, 3, 5, 7, 9, 8, 6, 4, 2, 0]
         setlist = []
@@ -1179,6 +1309,169 @@ def show_hype_setlist(band_id):
     )
 
 
+@app.route("/playlist/predicted-create/<band_id>", methods=["POST"])
+def create_predicted_playlist(band_id):
+    """
+    POST ROUTE:
+    - If playlist not in database, create it from the band's predicted setlist
+    - Put songs in playlist
+        - If songs are not in database, create them
+    - Add the playlist to the user's playlists
+    - Add the playlist to the user's Spotify
+    """
+    if not g.user:
+        abort(403)
+
+    token = cred.refresh_user_token(g.user.spotify_user_token)
+
+    with spotify.token_as(token):
+        return build_predicted_playlist(band_id)
+
+
+def build_predicted_playlist(band_id):
+    """
+    - Creates the predicted playlist for create_predicted_playlist if needed
+    - Saves the playlist to the user's playlists and Spotify
+    - Returns the result page
+    """
+    band_db = Band.query.filter_by(spotify_artist_id=band_id).first_or_404()
+
+    playlist_db = (
+        Playlist.shared()
+        .filter_by(setlistfm_setlist_id=predicted_id(band_db), band_id=band_db.id)
+        .first()
+    )
+
+    if playlist_db is None:
+        songs = predicted_setlist(band_db)
+
+        if not songs:
+            return redirect(f"/band/{band_id}")
+
+        play_name = band_db.name + " Predicted Setlist"
+
+        playlist_db = Playlist(
+            spotify_playlist_id="None Yet",
+            setlistfm_setlist_id=predicted_id(band_db),
+            name=play_name,
+            description=(
+                play_name
+                + ". Based on "
+                + str(band_db.stats_setlist_count)
+                + " recent setlists."
+            ),
+            tour_name="N/A",
+            venue_name="Their next show",
+            event_date="Coming soon!",
+            venue_loc="Your speakers",
+            length=0,
+            band_id=band_db.id,
+        )
+
+        fill_playlist(spotify, band_db, playlist_db, [{"name": name} for name in songs])
+        db.session.commit()
+
+    copy = save_to_spotify(spotify, g.user, playlist_db)
+
+    return render_template("/playlist/result.html", playlist=playlist_db, copy=copy)
+
+
+@app.route("/playlist/predicted/<band_id>")
+@replica_reads
+def show_predicted_setlist(band_id):
+    """
+    GET ROUTE:
+    - Build the band's most likely setlist from its cached setlist stats
+    - Arrange data
+    - Return band, playlist, page config variables (duration, saved)
+    """
+    if not g.user:
+        return redirect("/login")
+
+    saved = False
+
+    band_db = Band.query.filter_by(spotify_artist_id=band_id).first()
+
+    if band_db is not None:
+        playlist_db = (
+            Playlist.shared()
+            .filter_by(setlistfm_setlist_id=predicted_id(band_db), band_id=band_db.id)
+            .first()
+        )
+    else:
+        playlist_db = None
+
+    sp_band = get_spotify_artist(band_id)
+
+    if playlist_db is None:
+        if band_db is not None:
+            songs = predicted_setlist(band_db)
+            setlist_count = band_db.stats_setlist_count
+        else:
+            songs = []
+            setlist_count = 0
+
+        playlist_db = Playlist(
+            spotify_playlist_id=None,
+            setlistfm_setlist_id=PREDICTED_ID,
+            name=sp_band["name"],
+            description=sp_band["name"] + " Predicted Setlist",
+            tour_name="N/A",
+            venue_name="Their next show",
+            event_date="Coming soon!",
+            venue_loc=f"Based on {setlist_count} recent setlists",
+            length=len(songs),
+            band_id=sp_band["id"],
+        )
+        playlist_db.add_songs(songs)
+    else:
+        saved = True
+
+    return render_template(
+        "/playlist/playlist.html",
+        playlist=playlist_db,
+        band=sp_band,
+        duration=False,
+        saved=saved,
+    )
+
+
+#################
+# Status Routes #################################################
+#################
+
+
+@app.route("/status/db-pool")
+@metrics.internal
+def show_db_pool():
+    """
+    Database connection pool usage for the worker that serves the request
+    """
+    result = pool_metrics.snapshot()
+    if replica_pool_metrics.engine is not None:
+        result["replica"] = replica_pool_metrics.snapshot()
+    return jsonify(result)
+
+
+@app.route("/status/hashing")
+@metrics.internal
+def show_hashing():
+    """
+    Password hashing queue for the worker that serves the request
+    """
+    return jsonify(hasher.snapshot())
+
+
+@app.route("/metrics")
+@metrics.internal
+def show_metrics():
+    """
+    Request, database, upstream and template timings for all workers, in the
+    Prometheus text format
+    """
+    return Response(metrics.store.render(), mimetype="text/plain; version=0.0.4")
+
+
 #######################
 # Custom Error Routes ###########################################
 #######################
@@ -1206,3 +1499,25 @@ def server_error(e):
     Internal Error
     """
     return render_template("/errors/500.html"), 500
+
+
+@app.errorhandler(RateLimitExceeded)
+@app.errorhandler(UpstreamUnavailable)
+@app.errorhandler(HashingBusy)
+def upstream_unavailable(e):
+    """
+    Upstream API rate limited or unavailable, or password hashing backed up
+    """
+    return render_template("/errors/503.html"), 503
+
+
+@app.errorhandler(Throttled)
+def too_many_attempts(e):
+    """
+    Too many failed logins or password resets
+    """
+    return (
+        render_template("/errors/429.html"),
+        429,
+        {"Retry-After": str(max(int(e.retry_after), 1))},
+    )
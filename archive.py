@@ -0,0 +1,445 @@
+import array
+import io
+import json
+import os
+import sys
+import time
+import zipfile
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from sqlalchemy import Boolean, DateTime, Float, Integer, func, select, text
+
+from models import Album, Band, Playlist, Playlist_Song, Song, db
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Rows read, written and loaded at a time, memory use is bounded by it
+BATCH_ROWS = int(os.environ.get("ARCHIVE_BATCH_ROWS", 50000))
+# "parquet" needs pyarrow, "columnar" is a zip of typed column buffers
+FORMAT = os.environ.get("ARCHIVE_FORMAT", "parquet" if pyarrow else "columnar")
+# In load order, each table only references the ones before it
+TABLES = (Band, Album, Song, Playlist, Playlist_Song)
+MANIFEST = "manifest.json"
+EXTENSIONS = {"parquet": ".parquet", "columnar": ".cols"}
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class ArchiveError(Exception):
+    """
+    Raised when an archive can't be written or loaded
+    """
+
+
+def column_kind(column):
+    """
+    Returns how a column is stored: int, bool, float, time or text
+    """
+    if isinstance(column.type, Boolean):
+        return "bool"
+    if isinstance(column.type, Integer):
+        return "int"
+    if isinstance(column.type, Float):
+        return "float"
+    if isinstance(column.type, DateTime):
+        return "time"
+    return "text"
+
+
+def table_schema(model):
+    """
+    Returns the (name, kind) of each of the model's columns
+    """
+    return [(column.name, column_kind(column)) for column in model.__table__.columns]
+
+
+def export_filter(model):
+    """
+    Returns the rows of the model's table that are archived, users' edited
+    copies of playlists stay with the users
+    """
+    if model is Playlist:
+        return Playlist.__table__.c.owner_id.is_(None)
+    if model is Playlist_Song:
+        return Playlist_Song.__table__.c.playlist_id.in_(
+            select(Playlist.__table__.c.id).where(
+                Playlist.__table__.c.owner_id.is_(None)
+            )
+        )
+    return None
+
+
+def read_batches(model, batch_rows=None):
+    """
+    - Yields the model's archived rows BATCH_ROWS at a time as columns
+      (lists), in id order
+    - Each batch is one keyset query on the table, without the ORM
+    """
+    table = model.__table__
+    batch_rows = batch_rows or BATCH_ROWS
+    where = export_filter(model)
+    last = None
+    while True:
+        query = select(*table.columns).order_by(table.c.id).limit(batch_rows)
+        if where is not None:
+            query = query.where(where)
+        if last is not None:
+            query = query.where(table.c.id > last)
+        rows = db.session.execute(query).fetchall()
+        if not rows:
+            return
+        last = rows[-1].id
+        yield [list(values) for values in zip(*rows)]
+
+
+def encode_column(kind, values):
+    """
+    Returns a column's values as bytes: a null flag per row when there are
+    nulls, then the values in a typed array, text as offsets and UTF-8
+    """
+    nulls = any(value is None for value in values)
+    out = io.BytesIO()
+    out.write(b"\x01" if nulls else b"\x00")
+    if nulls:
+        out.write(bytes(value is None for value in values))
+
+    if kind == "text":
+        data = [(value or "").encode() for value in values]
+        offsets = array.array("q", [0])
+        offsets.extend(accumulate(map(len, data)))
+        out.write(offsets.tobytes())
+        out.write(b"".join(data))
+    elif kind == "float":
+        out.write(array.array("d", [value or 0.0 for value in values]).tobytes())
+    elif kind == "time":
+        micros = [
+            0 if value is None else (value - EPOCH) // MICROSECOND for value in values
+        ]
+        out.write(array.array("q", micros).tobytes())
+    else:
+        out.write(array.array("q", [int(value or 0) for value in values]).tobytes())
+    return out.getvalue()
+
+
+def decode_column(kind, data, rows):
+    """
+    Returns the values (list) of a column encoded by encode_column
+    """
+    nulls = None
+    start = 1
+    if data[0]:
+        nulls = data[1 : 1 + rows]
+        start += rows
+
+    if kind == "text":
+        offsets = array.array("q")
+        offsets.frombytes(data[start : start + 8 * (rows + 1)])
+        blob = data[start + 8 * (rows + 1) :]
+        values = [blob[offsets[i] : offsets[i + 1]].decode() for i in range(rows)]
+    else:
+        numbers = array.array("d" if kind == "float" else "q")
+        numbers.frombytes(data[start:])
+        if kind == "time":
+            values = [EPOCH + timedelta(microseconds=value) for value in numbers]
+        elif kind == "bool":
+            values = [bool(value) for value in numbers]
+        else:
+            values = numbers.tolist()
+
+    if nulls is not None:
+        values = [None if null else value for value, null in zip(values, nulls)]
+    return values
+
+
+class ColumnarWriter:
+    """
+    Writes a table to a zip holding each batch's columns as typed buffers,
+    the NPZ layout without needing numpy
+    """
+
+    def __init__(self, path, schema):
+        self.schema = schema
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        self.batches = []
+
+    def write(self, columns):
+        for (name, kind), values in zip(self.schema, columns):
+            self.zip.writestr(
+                f"{len(self.batches):06d}/{name}", encode_column(kind, values)
+            )
+        self.batches.append(len(columns[0]))
+
+    def close(self):
+        self.zip.writestr(
+            "schema.json",
+            json.dumps(
+                {
+                    "columns": self.schema,
+                    "batches": self.batches,
+                    "byteorder": sys.byteorder,
+                }
+            ),
+        )
+        self.zip.close()
+
+
+def read_columnar(path):
+    """
+    Yields the batches (lists of columns) of a table written by
+    ColumnarWriter, with the column names
+    """
+    with zipfile.ZipFile(path) as archive:
+        schema = json.loads(archive.read("schema.json"))
+        if schema["byteorder"] != sys.byteorder:
+            raise ArchiveError(
+                f"{path} was written on a {schema['byteorder']} endian machine"
+            )
+        names = [name for name, _ in schema["columns"]]
+        for i, rows in enumerate(schema["batches"]):
+            yield names, [
+                decode_column(kind, archive.read(f"{i:06d}/{name}"), rows)
+                for name, kind in schema["columns"]
+            ]
+
+
+ARROW_TYPES = {
+    "int": lambda: pyarrow.int64(),
+    "bool": lambda: pyarrow.bool_(),
+    "float": lambda: pyarrow.float64(),
+    "time": lambda: pyarrow.timestamp("us"),
+    "text": lambda: pyarrow.string(),
+}
+
+
+class ParquetWriter:
+    """
+    Writes a table to a Parquet file, one row group per batch
+    """
+
+    def __init__(self, path, schema):
+        self.schema = pyarrow.schema(
+            [(name, ARROW_TYPES[kind]()) for name, kind in schema]
+        )
+        self.writer = pyarrow.parquet.ParquetWriter(
+            path, self.schema, compression="zstd"
+        )
+
+    def write(self, columns):
+        self.writer.write_batch(
+            pyarrow.record_batch(
+                [
+                    pyarrow.array(values, type=field.type)
+                    for field, values in zip(self.schema, columns)
+                ],
+                schema=self.schema,
+            )
+        )
+
+    def close(self):
+        self.writer.close()
+
+
+def read_parquet(path, batch_rows=None):
+    """
+    Yields the batches (lists of columns) of a Parquet file, with the column
+    names
+    """
+    parquet = pyarrow.parquet.ParquetFile(path)
+    for batch in parquet.iter_batches(batch_size=batch_rows or BATCH_ROWS):
+        yield batch.schema.names, [column.to_pylist() for column in batch.columns]
+
+
+def export_tables(directory, format=None, batch_rows=None):
+    """
+    - Streams the archived tables into a file each in directory, batch by
+      batch, so memory doesn't grow with the tables
+    - Returns {table: {"rows", "bytes", "seconds"}}, also saved in the
+      directory's manifest
+    """
+    format = format or FORMAT
+    if format == "parquet" and pyarrow is None:
+        raise ArchiveError("The parquet format needs the pyarrow package")
+    if format not in EXTENSIONS:
+        raise ArchiveError(f"Unknown archive format {format}")
+    os.makedirs(directory, exist_ok=True)
+
+    tables = {}
+    for model in TABLES:
+        started = time.perf_counter()
+        name = model.__tablename__
+        path = os.path.join(directory, name + EXTENSIONS[format])
+        schema = table_schema(model)
+        writer = (ParquetWriter if format == "parquet" else ColumnarWriter)(
+            path, schema
+        )
+        rows = 0
+        try:
+            for columns in read_batches(model, batch_rows):
+                writer.write(columns)
+                rows += len(columns[0])
+        finally:
+            writer.close()
+        # Only the read transaction is open, don't hold it across tables
+        db.session.rollback()
+        tables[name] = {
+            "rows": rows,
+            "bytes": os.path.getsize(path),
+            "seconds": time.perf_counter() - started,
+        }
+
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(
+            {
+                "format": format,
+                "exported_at": datetime.utcnow().isoformat(),
+                "tables": {
+                    name: {"rows": table["rows"]} for name, table in tables.items()
+                },
+            },
+            f,
+        )
+    return tables
+
+
+def copy_value(value):
+    """
+    Returns a value in PostgreSQL's COPY text format
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_rows(table, names, rows):
+    """
+    - Bulk loads rows (tuples of the named columns) into a table, with COPY
+      on PostgreSQL and executemany INSERTs elsewhere
+    - The caller commits
+    """
+    if db.engine.dialect.name == "postgresql":
+        buffer = io.StringIO()
+        buffer.writelines(
+            "\t".join(copy_value(value) for value in row) + "\n" for row in rows
+        )
+        buffer.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(names)}) FROM STDIN", buffer)
+    else:
+        db.session.execute(table.insert(), [dict(zip(names, row)) for row in rows])
+
+
+def reset_sequence(table):
+    """
+    Moves a PostgreSQL table's id sequence past the loaded ids
+    """
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"COALESCE(MAX(id), 1)) FROM {table.name}"
+            )
+        )
+
+
+def import_tables(directory, batch_rows=None):
+    """
+    - Loads an archive written by export_tables into empty tables, keeping
+      the ids, batch by batch with COPY
+    - Every table is loaded in one transaction, committed only once each
+      table's rows match the manifest, so a short or bad archive loads
+      nothing
+    - Returns {table: {"rows", "seconds"}}
+    """
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    format = manifest["format"]
+    if format == "parquet" and pyarrow is None:
+        raise ArchiveError("The parquet format needs the pyarrow package")
+
+    for model in TABLES:
+        if db.session.query(func.count()).select_from(model.__table__).scalar():
+            raise ArchiveError(f"{model.__tablename__} already has rows")
+
+    tables = {}
+    try:
+        for model in TABLES:
+            started = time.perf_counter()
+            table = model.__table__
+            path = os.path.join(directory, table.name + EXTENSIONS[format])
+            batches = (
+                read_parquet(path, batch_rows)
+                if format == "parquet"
+                else read_columnar(path)
+            )
+            rows = 0
+            for names, columns in batches:
+                copy_rows(table, names, list(zip(*columns)))
+                rows += len(columns[0])
+
+            expected = manifest["tables"][table.name]["rows"]
+            if rows != expected:
+                raise ArchiveError(f"{table.name} has {rows} rows, expected {expected}")
+            reset_sequence(table)
+            tables[table.name] = {
+                "rows": rows,
+                "seconds": time.perf_counter() - started,
+            }
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.commit()
+    return tables
+
+
+def print_tables(action, tables):
+    """
+    Prints the rows and throughput of each table
+    """
+    for name, table in tables.items():
+        rate = table["rows"] / table["seconds"] if table["seconds"] else 0
+        size = f", {table['bytes'] / 1e6:.1f} MB" if "bytes" in table else ""
+        print(
+            f"{action} {name}: {table['rows']} rows in {table['seconds']:.2f}s "
+            f"({rate:,.0f} rows/s{size})"
+        )
+
+
+def main(argv):
+    """
+    - archive.py export <directory>: streams bands, albums, songs, playlists
+      and their songs to a file per table (ARCHIVE_FORMAT parquet or columnar)
+    - archive.py import <directory>: loads an export into empty tables
+    """
+    if len(argv) == 2 and argv[0] in ("export", "import"):
+        from app import app
+
+        with app.app_context():
+            try:
+                if argv[0] == "export":
+                    print_tables("Exported", export_tables(argv[1]))
+                else:
+                    print_tables("Imported", import_tables(argv[1]))
+            except ArchiveError as e:
+                print(e, file=sys.stderr)
+                return 1
+        return 0
+
+    print(main.__doc__, file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,361 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+import threading
+
+from flask import abort, request, send_from_directory
+
+import httpcache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC = os.path.join(ROOT, "static")
+DIST = os.path.join(STATIC, "dist")
+MANIFEST = "manifest.json"
+URL_PREFIX = "/assets/"
+
+COMPRESSIBLE = {".css", ".js", ".svg", ".ico", ".json", ".txt"}
+RESIZABLE = {".jpg", ".jpeg", ".png"}
+SKIP = {".map"}
+# Widths of the resized images, CSS backgrounds get the smallest and switch
+# to the larger ones at wider screens
+WIDTHS = (768, 1280, 1920)
+JPEG_QUALITY = 80
+WEBP_QUALITY = 75
+
+URL = re.compile(r"url\(\s*['\"]?([^'\")]+)['\"]?\s*\)")
+RULE = re.compile(r"([^{}]+)\{([^{}]*)\}")
+SOURCE_MAP = re.compile(r"/\*# sourceMappingURL=[^*]*\*/")
+
+
+def content_hash(data):
+    """
+    Returns a short digest of a file's contents
+    """
+    return hashlib.sha1(data).hexdigest()[:10]
+
+
+def hashed_name(name, data):
+    """
+    Returns "dir/stem.<hash>.ext" for name
+    """
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{content_hash(data)}{ext}"
+
+
+class Build:
+    """
+    One run of the asset build, from a static directory to an output
+    directory with content hashed files and a manifest
+    """
+
+    def __init__(self, static_dir, out_dir):
+        self.static_dir = static_dir
+        self.out_dir = out_dir
+        # logical name: {"file", "widths"}
+        self.assets = {}
+        # hashed file: {"encodings", "webp"}
+        self.files = {}
+
+    def write(self, name, data):
+        """
+        - Writes a hashed file and its gzip/brotli variants when they're smaller
+        - Returns the file's entry in the manifest
+        """
+        path = os.path.join(self.out_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+        entry = self.files.setdefault(name, {})
+        if os.path.splitext(name)[1] not in COMPRESSIBLE:
+            return entry
+
+        encodings = []
+        variants = [("gzip", ".gz", lambda d: gzip.compress(d, 9, mtime=0))]
+        if brotli is not None:
+            variants.insert(0, ("br", ".br", lambda d: brotli.compress(d)))
+        for encoding, ext, compress in variants:
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                with open(path + ext, "wb") as f:
+                    f.write(compressed)
+                encodings.append(encoding)
+        if encodings:
+            entry["encodings"] = encodings
+        return entry
+
+    def write_image(self, name, image, fmt, quality):
+        """
+        Saves a Pillow image under name
+        """
+        path = os.path.join(self.out_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fmt == "JPEG":
+            image.convert("RGB").save(
+                path, fmt, quality=quality, optimize=True, progressive=True
+            )
+        else:
+            image.save(path, fmt, quality=quality)
+
+    def image_variants(self, name, hashed):
+        """
+        - With Pillow, writes a WebP of the image plus JPEG/PNG and WebP copies
+          resized to each of WIDTHS narrower than the original
+        - Returns the files to use by width
+        """
+        if Image is None:
+            return {}
+
+        path = os.path.join(self.static_dir, name)
+        with Image.open(path) as original:
+            original.load()
+        fmt = "PNG" if hashed.lower().endswith(".png") else "JPEG"
+
+        webp = os.path.splitext(hashed)[0] + ".webp"
+        self.write_image(webp, original, "WEBP", WEBP_QUALITY)
+        self.files[hashed]["webp"] = webp
+
+        widths = {}
+        for width in WIDTHS:
+            if width >= original.width:
+                break
+            height = round(original.height * width / original.width)
+            resized = original.resize((width, height), Image.LANCZOS)
+            stem, ext = os.path.splitext(hashed)
+            resized_name = f"{stem}-{width}w{ext}"
+            resized_webp = f"{stem}-{width}w.webp"
+            self.write_image(resized_name, resized, fmt, JPEG_QUALITY)
+            self.write_image(resized_webp, resized, "WEBP", WEBP_QUALITY)
+            self.files[resized_name] = {"webp": resized_webp}
+            widths[str(width)] = resized_name
+        # Screens wider than the last resized copy get the original if it
+        # isn't bigger than the widest size
+        if widths and original.width <= WIDTHS[-1]:
+            widths[str(original.width)] = hashed
+        return widths
+
+    def resolve(self, css_name, ref):
+        """
+        Returns the logical name of a file a stylesheet references, or None if
+        it isn't one of the built assets
+        """
+        if ref.startswith("/static/"):
+            name = ref[len("/static/") :]
+        elif ref.startswith(("/", "http:", "https:", "data:", "//")):
+            return None
+        else:
+            name = os.path.normpath(os.path.join(os.path.dirname(css_name), ref))
+        name = name.replace(os.sep, "/")
+        return name if name in self.assets else None
+
+    def rewrite_css(self, css_name, css):
+        """
+        - Points a stylesheet's url()s at the hashed files
+        - Backgrounds with resized images start with the smallest and get a
+          media query for each larger width right after their rule
+        - Drops the source map comment, maps aren't built
+        """
+
+        def rule(match):
+            selector, body = match.groups()
+            extra = []
+
+            def url(url_match):
+                name = self.resolve(css_name, url_match.group(1))
+                if name is None:
+                    return url_match.group(0)
+                entry = self.assets[name]
+                widths = entry.get("widths")
+                if not widths or "background" not in body:
+                    return f'url("{URL_PREFIX}{entry["file"]}")'
+
+                target = selector.split(";")[-1].strip()
+                sizes = sorted(widths, key=int)
+                for smaller, width in zip(sizes, sizes[1:]):
+                    image = f'url("{URL_PREFIX}{widths[width]}")'
+                    extra.append(
+                        f"@media (min-width: {int(smaller) + 1}px) "
+                        f"{{ {target} {{ background-image: {image}; }} }}"
+                    )
+                return f'url("{URL_PREFIX}{widths[sizes[0]]}")'
+
+            body = URL.sub(url, body)
+            return selector + "{" + body + "}" + "".join(extra)
+
+        return RULE.sub(rule, SOURCE_MAP.sub("", css))
+
+    def run(self):
+        """
+        - Hashes every static file, stylesheets last so they can point at the
+          hashed images
+        - Writes the manifest and returns it
+        """
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+        names = []
+        for root, dirs, files in os.walk(self.static_dir):
+            if os.path.abspath(root).startswith(os.path.abspath(self.out_dir)):
+                continue
+            for file_name in files:
+                if os.path.splitext(file_name)[1] in SKIP:
+                    continue
+                path = os.path.join(root, file_name)
+                names.append(
+                    os.path.relpath(path, self.static_dir).replace(os.sep, "/")
+                )
+        names.sort(key=lambda name: (name.endswith(".css"), name))
+
+        for name in names:
+            with open(os.path.join(self.static_dir, name), "rb") as f:
+                data = f.read()
+            if name.endswith(".css"):
+                data = self.rewrite_css(name, data.decode()).encode()
+
+            hashed = hashed_name(name, data)
+            self.write(hashed, data)
+            entry = {"file": hashed}
+            if os.path.splitext(name)[1].lower() in RESIZABLE:
+                widths = self.image_variants(name, hashed)
+                if widths:
+                    entry["widths"] = widths
+            self.assets[name] = entry
+
+        manifest = {"assets": self.assets, "files": self.files}
+        with open(os.path.join(self.out_dir, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        return manifest
+
+
+def build(static_dir=STATIC, out_dir=DIST):
+    """
+    Builds the assets, returns the manifest
+    """
+    return Build(static_dir, out_dir).run()
+
+
+class Manifest:
+    """
+    The built manifest, reloaded when the build changes it
+    """
+
+    def __init__(self, out_dir=DIST):
+        self.out_dir = out_dir
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.data = {"assets": {}, "files": {}}
+
+    def get(self):
+        """
+        Returns the manifest, empty when the assets haven't been built
+        """
+        try:
+            mtime = os.stat(os.path.join(self.out_dir, MANIFEST)).st_mtime
+        except OSError:
+            mtime = None
+        with self.lock:
+            if mtime != self.mtime:
+                self.data = {"assets": {}, "files": {}}
+                if mtime is not None:
+                    with open(os.path.join(self.out_dir, MANIFEST)) as f:
+                        self.data = json.load(f)
+                self.mtime = mtime
+            return self.data
+
+
+manifest = Manifest()
+
+
+def asset_url(filename):
+    """
+    Returns the built, content hashed URL of a static file, used from
+    templates as asset_url('css/main.css'). Falls back to the fingerprinted
+    /static URL when the assets haven't been built.
+    """
+    entry = manifest.get()["assets"].get(filename)
+    if entry is None:
+        return httpcache.asset_url(filename)
+    return URL_PREFIX + entry["file"]
+
+
+def serve_asset(filename):
+    """
+    GET ROUTE:
+    - Serves a built file, picking the WebP variant of images for browsers
+      that accept it and the brotli or gzip variant of text files
+    - Hashed names never change, so every response is cached for a year
+    """
+    entry = manifest.get()["files"].get(filename)
+    if entry is None:
+        abort(404)
+
+    served = filename
+    mimetype = mimetypes.guess_type(filename)[0]
+    encoding = None
+    vary = []
+    if entry.get("webp"):
+        vary.append("Accept")
+        if "image/webp" in request.headers.get("Accept", ""):
+            served = entry["webp"]
+            mimetype = "image/webp"
+    if entry.get("encodings"):
+        vary.append("Accept-Encoding")
+        for candidate in entry["encodings"]:
+            if candidate in request.accept_encodings:
+                encoding = candidate
+                break
+        if encoding is not None:
+            served += ".br" if encoding == "br" else ".gz"
+
+    response = send_from_directory(
+        manifest.out_dir, served, mimetype=mimetype, max_age=httpcache.IMMUTABLE_MAX_AGE
+    )
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    for header in vary:
+        response.vary.add(header)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def install_app(app):
+    """
+    - Serves the built assets under URL_PREFIX
+    - Adds asset_url to templates
+    """
+    app.add_url_rule(URL_PREFIX + "<path:filename>", "assets", serve_asset)
+    app.add_template_global(asset_url)
+
+
+def main(argv):
+    """
+    - assets.py build: hashes, compresses and resizes static/ into static/dist/
+    """
+    if argv == ["build"]:
+        result = build()
+        print(
+            f"Built {len(result['assets'])} assets, "
+            f"{len(result['files'])} files into {DIST}"
+        )
+        return 0
+
+    print(main.__doc__, file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from flask import Flask
+
+import archive
+from bench.seed import seed_database
+from models import connect_db, db
+
+
+def bench_app(database_url):
+    """
+    Returns a bare app on the benchmark database, the archive only needs the
+    models
+    """
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    connect_db(app)
+    return app
+
+
+def orm_baseline():
+    """
+    Times reading the archived tables through the ORM, how they had to be
+    dumped before
+    """
+    tables = {}
+    for model in archive.TABLES:
+        started = time.perf_counter()
+        rows = sum(1 for _ in model.query.order_by(model.id).yield_per(1000))
+        db.session.rollback()
+        tables[model.__tablename__] = {
+            "rows": rows,
+            "seconds": time.perf_counter() - started,
+        }
+    return tables
+
+
+def totals(tables):
+    """
+    Returns the rows, seconds and rows per second across tables
+    """
+    rows = sum(table["rows"] for table in tables.values())
+    seconds = sum(table["seconds"] for table in tables.values())
+    return {"rows": rows, "seconds": seconds, "rows_per_second": rows / seconds}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark exporting and importing the playlist tables"
+    )
+    parser.add_argument("--database-url", help="defaults to SQLite in the workdir")
+    parser.add_argument(
+        "--format", choices=list(archive.EXTENSIONS), default=archive.FORMAT
+    )
+    parser.add_argument("--batch-rows", type=int, default=archive.BATCH_ROWS)
+    parser.add_argument("--bands", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--playlists", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-seed", action="store_true")
+    parser.add_argument("--workdir", help="defaults to a temporary directory")
+    parser.add_argument("--json", help="write the results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    - Seeds the database, then times reading the tables through the ORM,
+      exporting them and importing the export into a recreated schema
+    - Prints rows per second for each table and the export's size
+    """
+    opts = parse_args(argv)
+    workdir = opts.workdir or tempfile.mkdtemp(prefix="setplaylist-archive-")
+    os.makedirs(workdir, exist_ok=True)
+    database_url = opts.database_url or "sqlite:///" + os.path.join(
+        workdir, "archive.db"
+    )
+    export_dir = os.path.join(workdir, "export")
+
+    try:
+        with bench_app(database_url).app_context():
+            if not opts.skip_seed:
+                counts = seed_database(
+                    opts.bands, opts.users, opts.playlists, seed=opts.seed
+                )
+                print("Seeded " + ", ".join(f"{v} {k}" for k, v in counts.items()))
+
+            orm = orm_baseline()
+            archive.print_tables("ORM read", orm)
+
+            exported = archive.export_tables(export_dir, opts.format, opts.batch_rows)
+            archive.print_tables("Exported", exported)
+
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+            imported = archive.import_tables(export_dir, opts.batch_rows)
+            archive.print_tables("Imported", imported)
+    finally:
+        if not opts.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "format": opts.format,
+        "orm_read": totals(orm),
+        "export": dict(
+            totals(exported),
+            bytes=sum(table["bytes"] for table in exported.values()),
+        ),
+        "import": totals(imported),
+    }
+    for name in ("orm_read", "export", "import"):
+        print(
+            f"{name}: {results[name]['rows']} rows, "
+            f"{results[name]['rows_per_second']:,.0f} rows/s"
+        )
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
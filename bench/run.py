@@ -0,0 +1,426 @@
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from bench.seed import PASSWORD, band_spotify_id, setlist_id
+from bench.stubs import DEFAULT_LATENCIES, StubServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Token the app under test serves /metrics to
+METRICS_TOKEN = "bench"
+
+# name: (method, endpoint, needs login, path builder)
+SCENARIOS = {
+    "band_details": (
+        "GET",
+        "show_band_details",
+        False,
+        lambda rng, opts: f"/band/{band_id(rng, opts)}",
+    ),
+    "band_search": (
+        "GET",
+        "search_results",
+        False,
+        lambda rng, opts: f"/band/search?search=Bench+Band+{rng.randrange(opts.bands)}",
+    ),
+    "playlist_show": (
+        "GET",
+        "show_setlist",
+        True,
+        lambda rng, opts: f"/playlist/show/{playlist_path(rng, opts)}",
+    ),
+    "playlist_create": (
+        "POST",
+        "create_playlist",
+        True,
+        lambda rng, opts: f"/playlist/create/{playlist_path(rng, opts)}",
+    ),
+}
+
+
+def band_id(rng, opts):
+    """
+    Spotify id of a random seeded band
+    """
+    return band_spotify_id(rng.randrange(opts.bands))
+
+
+def playlist_path(rng, opts):
+    """
+    "<band>/<setlist>" for a seeded playlist half the time, otherwise a
+    setlist the app hasn't seen yet
+    """
+    if rng.random() < opts.saved_ratio:
+        n = rng.randrange(opts.playlists)
+        return f"{band_spotify_id(n % opts.bands)}/{setlist_id(n)}"
+    return f"{band_id(rng, opts)}/bench-new-{rng.getrandbits(48):x}"
+
+
+def free_port():
+    """
+    Returns a free local port
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a list of numbers
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[rank]
+
+
+def read_metrics(base_url):
+    """
+    Returns {(name, labels): value} from the app's /metrics endpoint
+    """
+    res = requests.get(
+        base_url + "/metrics", headers={"Authorization": f"Bearer {METRICS_TOKEN}"}
+    )
+    samples = {}
+    for line in res.text.splitlines():
+        match = re.match(r"^(\w+)\{(.*)\} (\S+)$", line)
+        if match:
+            samples[(match.group(1), match.group(2))] = float(match.group(3))
+    return samples
+
+
+def endpoint_totals(samples, endpoint):
+    """
+    Returns (requests, db queries) recorded for an endpoint
+    """
+    label = f'endpoint="{endpoint}"'
+    requests_total = sum(
+        value
+        for (name, labels), value in samples.items()
+        if name == "setplaylist_http_request_seconds_count" and label in labels
+    )
+    queries = samples.get(("setplaylist_request_db_queries_total", label), 0)
+    return requests_total, queries
+
+
+def server_env(opts, stub_url, workdir):
+    """
+    ENVs for the app under test
+    """
+    env = dict(os.environ)
+    env.update(
+        {
+            "PYTHONPATH": ROOT,
+            "DATABASE_URL": opts.database_url,
+            "BENCH_STUB_URL": stub_url,
+            "SETLIST_FM_BASE_URL": stub_url + "/setlistfm",
+            "SETLIST_FM_API_KEY": "bench",
+            "BANDSINTOWN_BASE_URL": stub_url + "/bandsintown",
+            "BIT_APP_ID": "bench",
+            "SPOTIFY_CLIENT_ID": "bench",
+            "SPOTIFY_CLIENT_SECRET": "bench",
+            "SPOTIFY_REDIRECT_URI": "http://127.0.0.1/callback",
+            "SECRET_KEY": "bench",
+            "CURR_USER_KEY": "curr_user",
+            "RATE_LIMIT_DB": os.path.join(workdir, "rate.db"),
+            "UPSTREAM_CACHE_DB": os.path.join(workdir, "upstream.db"),
+            "METRICS_DB": os.path.join(workdir, "metrics.db"),
+            "METRICS_TOKEN": METRICS_TOKEN,
+        }
+    )
+    if not opts.rate_limits:
+        for api in ("SPOTIFY", "SETLIST_FM", "BANDSINTOWN"):
+            env[f"{api}_RATE_LIMIT"] = "100000"
+            env[f"{api}_RATE_BURST"] = "100000"
+    return env
+
+
+def server_command(opts, port):
+    """
+    Command that serves the app on port with the chosen server
+    """
+    bind = f"127.0.0.1:{port}"
+    if opts.server == "werkzeug":
+        return [sys.executable, "-m", "bench.wsgi", str(port)]
+    return [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "bench.wsgi:app",
+        "-b",
+        bind,
+        "-w",
+        str(opts.workers),
+        "-k",
+        "gthread",
+        "--threads",
+        str(opts.threads),
+    ]
+
+
+def seed(opts, env):
+    """
+    Seeds the database in a separate process with the app's ENVs
+    """
+    code = (
+        "import json, bench.wsgi; from bench.seed import seed_database; "
+        "ctx = bench.wsgi.app.app_context(); ctx.push(); "
+        f"print(json.dumps(seed_database({opts.bands}, {opts.users}, "
+        f"{opts.playlists}, seed={opts.seed})))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        env=env,
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def wait_for(url, timeout=30):
+    """
+    Waits for the server to answer
+    """
+    give_up = time.time() + timeout
+    while time.time() < give_up:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} didn't start")
+
+
+def login(base_url, username):
+    """
+    Returns a session logged in as username
+    """
+    client = requests.Session()
+    res = client.post(
+        base_url + "/login",
+        data={"username": username, "password": PASSWORD},
+        allow_redirects=False,
+    )
+    if res.status_code != 302:
+        raise RuntimeError(f"Couldn't log in as {username}")
+    return client
+
+
+def run_scenario(name, opts, base_url, clients):
+    """
+    - Sends the scenario's requests from opts.concurrency threads for
+      opts.duration seconds
+    - Returns RPS, latency percentiles, errors and DB queries per request
+    """
+    method, endpoint, needs_login, build_path = SCENARIOS[name]
+    before = read_metrics(base_url)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    stop_at = time.time() + opts.duration
+
+    def worker(i):
+        rng = random.Random(f"{opts.seed}-{name}-{i}")
+        client = clients[i] if needs_login else requests.Session()
+        while time.time() < stop_at:
+            path = build_path(rng, opts)
+            started = time.perf_counter()
+            try:
+                res = client.request(method, base_url + path, allow_redirects=False)
+                failed = res.status_code >= 400
+            except requests.RequestException:
+                failed = True
+            elapsed = time.perf_counter() - started
+            with lock:
+                (errors if failed else latencies).append(elapsed)
+
+    started = time.time()
+    threads = [
+        threading.Thread(target=worker, args=(i,)) for i in range(opts.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    # Other workers flush their metrics on their next request after the interval
+    time.sleep(1.2)
+    for _ in range(opts.workers * 4):
+        read_metrics(base_url)
+    after = read_metrics(base_url)
+    requests_before, queries_before = endpoint_totals(before, endpoint)
+    requests_after, queries_after = endpoint_totals(after, endpoint)
+    served = requests_after - requests_before
+
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "db_queries_per_request": round((queries_after - queries_before) / served, 1)
+        if served
+        else None,
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Returns descriptions of scenarios that got slower or served less than the
+    baseline allows
+    """
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            found.append(f"{name}: p95 {base['p95_ms']}ms -> {result['p95_ms']}ms")
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            found.append(f"{name}: rps {base['rps']} -> {result['rps']}")
+        if (result["db_queries_per_request"] or 0) > (
+            base["db_queries_per_request"] or 0
+        ):
+            found.append(
+                f"{name}: db queries/request {base['db_queries_per_request']}"
+                f" -> {result['db_queries_per_request']}"
+            )
+    return found
+
+
+def print_table(results):
+    """
+    Prints the results as a table
+    """
+    columns = ["requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms"]
+    header = f"{'scenario':<18}" + "".join(f"{c:>10}" for c in columns)
+    print(header + f"{'queries/req':>13}")
+    for name, result in results.items():
+        row = f"{name:<18}" + "".join(f"{result[c]:>10}" for c in columns)
+        print(row + f"{str(result['db_queries_per_request']):>13}")
+
+
+def parse_latency(value):
+    """
+    Parses "api=median[:jitter]" in ms
+    """
+    api, _, times = value.partition("=")
+    median, _, jitter = times.partition(":")
+    return api, (float(median), float(jitter or 0))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the app's routes against stand-in upstream apis"
+    )
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--server", choices=["gunicorn", "werkzeug"], default="gunicorn"
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument(
+        "--latency",
+        type=parse_latency,
+        action="append",
+        default=[],
+        help="upstream latency in ms, e.g. setlistfm=300:80 (median:jitter)",
+    )
+    parser.add_argument("--database-url", help="defaults to SQLite in the workdir")
+    parser.add_argument("--bands", type=int, default=500)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--playlists", type=int, default=1000)
+    parser.add_argument("--saved-ratio", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-seed", action="store_true")
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="keep the app's upstream rate limits instead of lifting them",
+    )
+    parser.add_argument("--workdir", help="defaults to a temporary directory")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    - Starts the stand-in upstreams, seeds the database and starts the app
+    - Runs each scenario and prints RPS, latency percentiles and DB queries
+    - Exits 1 if a baseline was given and a scenario regressed past tolerance
+    """
+    opts = parse_args(argv)
+    workdir = opts.workdir or tempfile.mkdtemp(prefix="setplaylist-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    opts.database_url = opts.database_url or "sqlite:///" + os.path.join(
+        workdir, "bench.db"
+    )
+
+    latencies = dict(DEFAULT_LATENCIES, **dict(opts.latency))
+    stubs = StubServer(("127.0.0.1", 0), latencies).start()
+    env = server_env(opts, stubs.url, workdir)
+
+    if not opts.skip_seed:
+        counts = seed(opts, env)
+        print("Seeded " + ", ".join(f"{v} {k}" for k, v in counts.items()))
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(server_command(opts, port), env=env, cwd=ROOT)
+    try:
+        wait_for(base_url + "/")
+        clients = [
+            login(base_url, f"bench{i % opts.users}") for i in range(opts.concurrency)
+        ]
+
+        results = {}
+        for name in opts.scenarios:
+            results[name] = run_scenario(name, opts, base_url, clients)
+    finally:
+        server.terminate()
+        server.wait()
+        stubs.shutdown()
+        if not opts.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results)
+    print("Upstream calls: " + json.dumps(stubs.calls))
+
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            found = regressions(results, json.load(f), opts.tolerance)
+        for line in found:
+            print("REGRESSION " + line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
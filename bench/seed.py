@@ -0,0 +1,203 @@
+import json
+import random
+
+from matching import normalize_title
+from models import (
+    Album,
+    Band,
+    Favorite,
+    Playlist,
+    Playlist_Song,
+    Setlist,
+    Song,
+    User,
+    User_Playlist,
+    db,
+)
+
+PASSWORD = "benchpassword"
+CHUNK = 1000
+
+WORDS = (
+    "night fire paper glass river ghost summer electric golden wild broken "
+    "silver heart echo violet static ocean neon hollow shadow"
+).split()
+
+
+def band_spotify_id(n):
+    """
+    Spotify artist id of the nth seeded band
+    """
+    return f"bench{n:017d}"
+
+
+def setlist_id(n):
+    """
+    Setlist.fm setlist id of the nth seeded playlist
+    """
+    return f"bench-setlist-{n}"
+
+
+def song_name(rng):
+    """
+    Returns a made up song title
+    """
+    return " ".join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 3)))
+
+
+def insert(model, rows):
+    """
+    Bulk inserts rows (dicts) into the model's table in chunks
+    """
+    for i in range(0, len(rows), CHUNK):
+        db.session.execute(model.__table__.insert(), rows[i : i + CHUNK])
+
+
+def seed_database(bands=500, users=50, playlists=1000, songs_per_band=60, seed=1):
+    """
+    - Recreates the schema and fills it with a reproducible data set
+    - Every user's password is PASSWORD and they're all connected to Spotify
+    - Returns a dict of the counts seeded
+    """
+    rng = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+
+    insert(
+        Band,
+        [
+            {
+                "spotify_artist_id": band_spotify_id(n),
+                "setlistfm_artist_id": f"bench-mbid-{n}",
+                "name": f"Bench Band {n}",
+                "photo": "/static/img/rocco-dipoppa-_uDj_lyPVpA-unsplash.jpg",
+                "stats_setlist_count": 0,
+                "stats_song_total": 0,
+            }
+            for n in range(bands)
+        ],
+    )
+    band_ids = [id for (id,) in db.session.query(Band.id).order_by(Band.id)]
+
+    insert(
+        Album,
+        [
+            {
+                "spotify_album_id": f"bench-album-{band_id}-{a}",
+                "band_id": band_id,
+                "name": song_name(rng),
+                "album_type": "album",
+            }
+            for band_id in band_ids
+            for a in range(4)
+        ],
+    )
+
+    song_rows = []
+    for band_id in band_ids:
+        for s in range(songs_per_band):
+            name = song_name(rng)
+            song_rows.append(
+                {
+                    "spotify_song_id": f"bench{band_id:08d}{s:09d}",
+                    "name": name,
+                    "duration": rng.randint(120, 420),
+                    "band_id": band_id,
+                    "normalized_name": normalize_title(name),
+                }
+            )
+    insert(Song, song_rows)
+
+    password = User.hash_password(PASSWORD)
+    insert(
+        User,
+        [
+            {
+                "username": f"bench{n}",
+                "password": password,
+                "email": f"bench{n}@example.com",
+                "secret_question": "Bench?",
+                "secret_answer": password,
+                "spotify_user_token": "bench-refresh-token",
+                "spotify_user_id": "benchuser",
+            }
+            for n in range(users)
+        ],
+    )
+    user_ids = [id for (id,) in db.session.query(User.id).order_by(User.id)]
+
+    insert(
+        Favorite,
+        [
+            {"user_id": user_id, "band_id": band_id}
+            for user_id in user_ids
+            for band_id in rng.sample(band_ids, min(5, len(band_ids)))
+        ],
+    )
+
+    setlist_rows = []
+    playlist_rows = []
+    for n in range(playlists):
+        band_n = n % bands
+        setlist_rows.append(
+            {
+                "setlistfm_setlist_id": setlist_id(n),
+                "band_id": band_ids[band_n],
+                "event_date": f"{rng.randint(1, 28):02d}-06-2019",
+                "data": json.dumps(
+                    {
+                        "id": setlist_id(n),
+                        "sets": {
+                            "set": [
+                                {"song": [{"name": song_name(rng)} for _ in range(18)]}
+                            ]
+                        },
+                    }
+                ),
+                "counted": False,
+            }
+        )
+        playlist_rows.append(
+            {
+                "spotify_playlist_id": f"bench-playlist-{n}",
+                "spotify_playlist_url": "https://open.spotify.com/playlist/bench",
+                "setlistfm_setlist_id": setlist_id(n),
+                "name": f"Bench Band {band_n} @ Bench Venue",
+                "description": f"Bench Band {band_n} @ Bench Venue in Bench, BE",
+                "tour_name": "N/A",
+                "venue_name": "Bench Venue",
+                "event_date": "01-06-2019",
+                "venue_loc": "Bench, BE",
+                "length": 18,
+                "duration": "1hrs. 12min. 0sec.",
+                "band_id": band_ids[band_n],
+            }
+        )
+    insert(Setlist, setlist_rows)
+    insert(Playlist, playlist_rows)
+
+    songs_by_band = {}
+    for song_id, band_id in db.session.query(Song.id, Song.band_id):
+        songs_by_band.setdefault(band_id, []).append(song_id)
+    playlist_ids = db.session.query(Playlist.id, Playlist.band_id).order_by(Playlist.id)
+
+    playlist_song_rows = []
+    user_playlist_rows = []
+    for playlist_id, band_id in playlist_ids:
+        for song_id in rng.sample(songs_by_band[band_id], 18):
+            playlist_song_rows.append({"playlist_id": playlist_id, "song_id": song_id})
+        user_playlist_rows.append(
+            {"user_id": rng.choice(user_ids), "playlist_id": playlist_id}
+        )
+    insert(Playlist_Song, playlist_song_rows)
+    insert(User_Playlist, user_playlist_rows)
+
+    db.session.commit()
+
+    return {
+        "bands": bands,
+        "songs": len(song_rows),
+        "users": users,
+        "playlists": playlists,
+        "playlist_songs": len(playlist_song_rows),
+    }
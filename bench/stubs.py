@@ -0,0 +1,192 @@
+import copy
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PAYLOADS = os.path.join(os.path.dirname(__file__), "payloads")
+
+# api: (median latency ms, jitter ms)
+DEFAULT_LATENCIES = {
+    "spotify": (120, 40),
+    "setlistfm": (250, 100),
+    "bandsintown": (180, 60),
+}
+
+
+def load_payloads():
+    """
+    Returns the recorded payloads by file name (without .json)
+    """
+    payloads = {}
+    for file_name in os.listdir(PAYLOADS):
+        if file_name.endswith(".json"):
+            with open(os.path.join(PAYLOADS, file_name)) as f:
+                payloads[file_name[:-5]] = json.load(f)
+    return payloads
+
+
+def search_terms(query):
+    """
+    Splits a "track: title artist: name" Spotify query into (title, artist)
+    """
+    match = re.match(r"track: (.*) artist: (.*)", query)
+    if match is None:
+        return query, None
+    return match.group(1), match.group(2)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Replays recorded payloads for the Spotify, Setlist.fm and Bandsintown
+    calls the app makes
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    # (method, pattern, api, handler name)
+    ROUTES = [
+        ("POST", r"^/accounts/api/token$", "spotify", "token"),
+        ("GET", r"^/spotify/v1/artists/([^/]+)$", "spotify", "artist"),
+        ("GET", r"^/spotify/v1/artists/[^/]+/top-tracks$", "spotify", "top_tracks"),
+        ("GET", r"^/spotify/v1/search$", "spotify", "search"),
+        ("GET", r"^/spotify/v1/me$", "spotify", "me"),
+        ("POST", r"^/spotify/v1/users/[^/]+/playlists$", "spotify", "playlist"),
+        ("POST", r"^/spotify/v1/playlists/[^/]+/tracks$", "spotify", "snapshot"),
+        ("GET", r"^/setlistfm/search/artists$", "setlistfm", "fm_search"),
+        ("GET", r"^/setlistfm/artist/[^/]+/setlists$", "setlistfm", "fm_setlists"),
+        ("GET", r"^/setlistfm/setlist/([^/]+)$", "setlistfm", "fm_setlist"),
+        ("GET", r"^/bandsintown/artists/[^/]+/events/?$", "bandsintown", "events"),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        """
+        - Finds the route for the request and waits out the api's latency
+        - Replies with the route's payload, or 404 if nothing matches
+        """
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        url = urlparse(self.path)
+        for route_method, pattern, api, name in self.ROUTES:
+            match = re.match(pattern, url.path)
+            if route_method == method and match:
+                median, jitter = self.server.latencies[api]
+                time.sleep(max(0, random.gauss(median, jitter)) / 1000)
+                status, body = getattr(self, name)(match, parse_qs(url.query))
+                self.server.count(api)
+                return self.reply(status, body)
+
+        self.reply(404, {"error": "No stub for " + method + " " + url.path})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def payload(self, name):
+        return copy.deepcopy(self.server.payloads[name])
+
+    def token(self, match, query):
+        return 200, self.payload("spotify_token")
+
+    def artist(self, match, query):
+        artist = self.payload("spotify_artist")
+        artist["id"] = match.group(1)
+        return 200, artist
+
+    def top_tracks(self, match, query):
+        return 200, self.payload("spotify_top_tracks")
+
+    def search(self, match, query):
+        """
+        Artist searches replay the recording, track searches return a track
+        named after the searched title so matching succeeds
+        """
+        if query.get("type") != ["track"]:
+            return 200, self.payload("spotify_search_artists")
+
+        res = self.payload("spotify_search_tracks")
+        title, artist = search_terms(query.get("q", [""])[0])
+        for track in res["tracks"]["items"]:
+            track["name"] = title
+            track["id"] = hashlib.md5(title.encode()).hexdigest()[:22]
+            if artist is not None:
+                track["artists"][0]["name"] = artist
+        return 200, res
+
+    def me(self, match, query):
+        return 200, self.payload("spotify_me")
+
+    def playlist(self, match, query):
+        return 201, self.payload("spotify_playlist")
+
+    def snapshot(self, match, query):
+        return 201, self.payload("spotify_snapshot")
+
+    def fm_search(self, match, query):
+        res = self.payload("setlistfm_search_artists")
+        name = query.get("artistName", [None])[0]
+        if name is not None:
+            res["artist"][0]["name"] = name
+        return 200, res
+
+    def fm_setlists(self, match, query):
+        return 200, self.payload("setlistfm_setlists")
+
+    def fm_setlist(self, match, query):
+        setlist = self.payload("setlistfm_setlist")
+        setlist["id"] = match.group(1)
+        return 200, setlist
+
+    def events(self, match, query):
+        return 200, self.payload("bandsintown_events")
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Threaded stand-in server for all three upstream apis
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latencies=None):
+        super().__init__(address, StubHandler)
+        self.latencies = dict(DEFAULT_LATENCIES, **(latencies or {}))
+        self.payloads = load_payloads()
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def count(self, api):
+        with self.lock:
+            self.calls[api] = self.calls.get(api, 0) + 1
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Serves in a background thread, returns the server
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
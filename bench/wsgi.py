@@ -0,0 +1,27 @@
+# The app pointed at the benchmark's stand-in upstream servers. Expects
+# BENCH_STUB_URL plus the app's usual ENVs, bench/run.py sets them.
+import os
+import sys
+
+import tekore._auth.expiring.client as tekore_auth
+import tekore._client.base as tekore_base
+
+STUB_URL = os.environ["BENCH_STUB_URL"]
+
+# tekore reads these at call time, so every Spotify call goes to the stub
+tekore_base.prefix = STUB_URL + "/spotify/v1/"
+tekore_auth.OAUTH_TOKEN_URL = STUB_URL + "/accounts/api/token"
+
+from app import app  # noqa: E402
+
+app.config["WTF_CSRF_ENABLED"] = False
+app.config["SESSION_COOKIE_SECURE"] = False
+
+
+if __name__ == "__main__":
+    import logging
+
+    from werkzeug.serving import run_simple
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    run_simple("127.0.0.1", int(sys.argv[1]), app, threaded=True)
@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta
+from math import floor
+
+from matching import is_alt_version, normalize_title, song_queries
+from models import Album, Song, db
+
+ALBUM_PAGE_LIMIT = 50
+ALBUMS_PER_REQUEST = 20
+INCLUDE_GROUPS = ["album", "single"]
+
+
+def catalog_is_stale(band_db, max_age_hours):
+    """
+    Returns True if the band's catalog was never synced or is older than max age
+    """
+    if band_db.catalog_synced_at is None:
+        return True
+    return datetime.utcnow() - band_db.catalog_synced_at > timedelta(
+        hours=max_age_hours
+    )
+
+
+def fetch_album_ids(spotify, band_db):
+    """
+    - Pages through the band's albums and singles on Spotify
+    - Returns a list of Spotify album ids
+    """
+    ids = []
+    offset = 0
+
+    while True:
+        page = spotify.artist_albums(
+            band_db.spotify_artist_id,
+            include_groups=INCLUDE_GROUPS,
+            limit=ALBUM_PAGE_LIMIT,
+            offset=offset,
+        )
+        ids.extend(album.id for album in page.items)
+        offset += len(page.items)
+        if page.next is None or not page.items:
+            break
+
+    return ids
+
+
+def refresh_catalog(spotify, band_db):
+    """
+    - Fetches the band's album ids and skips albums already in the catalog
+    - Fetches new albums in batches of 20 and saves their tracks as songs
+    - Returns the number of songs added
+    """
+    album_ids = fetch_album_ids(spotify, band_db)
+    known = {
+        spotify_album_id
+        for (spotify_album_id,) in db.session.query(Album.spotify_album_id).filter(
+            Album.spotify_album_id.in_(album_ids)
+        )
+    }
+    new_ids = [album_id for album_id in album_ids if album_id not in known]
+
+    known_songs = {
+        spotify_song_id
+        for (spotify_song_id,) in db.session.query(Song.spotify_song_id).filter_by(
+            band_id=band_db.id
+        )
+    }
+    added = 0
+
+    for i in range(0, len(new_ids), ALBUMS_PER_REQUEST):
+        albums = spotify.albums(new_ids[i : i + ALBUMS_PER_REQUEST])
+
+        for album in albums:
+            album_db = Album(
+                spotify_album_id=album.id,
+                band_id=band_db.id,
+                name=album.name,
+                album_type=str(album.album_type),
+            )
+            db.session.add(album_db)
+            db.session.flush()
+
+            songs = []
+            for track in spotify.all_items(album.tracks):
+                if track.id is None or track.id in known_songs:
+                    continue
+                known_songs.add(track.id)
+                songs.append(
+                    Song(
+                        spotify_song_id=track.id,
+                        name=track.name,
+                        duration=floor(track.duration_ms / 1000),
+                        band_id=band_db.id,
+                        normalized_name=normalize_title(track.name),
+                        album_id=album_db.id,
+                    )
+                )
+            db.session.add_all(songs)
+            added += len(songs)
+
+    band_db.catalog_synced_at = datetime.utcnow()
+    db.session.add(band_db)
+    db.session.commit()
+
+    return added
+
+
+def resolve_local(band_db, song):
+    """
+    - Takes a Setlist.fm song (dict) and resolves it against the band's catalog
+    - Covers and songs missing from the catalog aren't resolved
+    - Returns a list of Song objects, or an empty list if any part is missing
+    """
+    queries = song_queries(song, band_db.name)
+    if any(artist != band_db.name for _, artist in queries):
+        return []
+
+    names = [normalize_title(title) for title, _ in queries]
+    rows = Song.query.filter(
+        Song.band_id == band_db.id, Song.normalized_name.in_(names)
+    ).all()
+
+    by_name = {}
+    for song_db in rows:
+        by_name.setdefault(song_db.normalized_name, []).append(song_db)
+
+    resolved = []
+    for (title, _), name in zip(queries, names):
+        options = by_name.get(name)
+        if not options:
+            return []
+        wants_alt = is_alt_version(title)
+        resolved.append(
+            min(
+                options,
+                key=lambda s: (is_alt_version(s.name) != wants_alt, s.id),
+            )
+        )
+
+    return resolved
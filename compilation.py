@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import re
+from datetime import datetime
+from math import ceil
+
+from sqlalchemy.exc import IntegrityError
+
+from models import Playlist, Setlist, db
+from playlists import fill_playlist, map_in_context, setlist_songs
+from ratelimit import RateLimitExceeded
+from setlist_stats import cache_setlists, count_setlists, extract_songs
+from upstream import UpstreamUnavailable, setlistfm_get
+
+# Most setlists one compilation is built from
+MAX_SETLISTS = int(os.environ.get("COMPILATION_MAX_SETLISTS", 300))
+# Setlist.fm setlists fetched at once
+CONCURRENCY = int(os.environ.get("COMPILATION_CONCURRENCY", 8))
+COMPILATION_PREFIX = "Compilation:"
+
+
+def parse_setlist_ids(values):
+    """
+    Returns the setlist ids in form values, each may hold several separated
+    by commas or whitespace, in order without repeats, at most MAX_SETLISTS
+    """
+    ids = []
+    for value in values:
+        for setlist_id in re.split(r"[\s,]+", value):
+            if setlist_id and setlist_id not in ids:
+                ids.append(setlist_id)
+    return ids[:MAX_SETLISTS]
+
+
+def fetch_setlist(setlist_id):
+    """
+    Returns a Setlist.fm setlist (dict), or None if it can't be fetched or
+    doesn't exist
+    """
+    try:
+        setlist = setlistfm_get(f"/setlist/{setlist_id}")
+    except (UpstreamUnavailable, RateLimitExceeded):
+        return None
+    return setlist if "sets" in setlist else None
+
+
+def get_setlists(setlist_ids):
+    """
+    - Returns the setlists (dicts) with setlist_ids that could be found, from
+      the setlists cache where possible
+    - The rest are fetched from Setlist.fm CONCURRENCY at a time
+    """
+    cached = {
+        setlist_db.setlistfm_setlist_id: json.loads(setlist_db.data)
+        for setlist_db in Setlist.query.filter(
+            Setlist.setlistfm_setlist_id.in_(setlist_ids)
+        )
+    }
+    missing = [setlist_id for setlist_id in setlist_ids if setlist_id not in cached]
+    fetched = dict(zip(missing, map_in_context(fetch_setlist, missing, CONCURRENCY)))
+    return [
+        cached.get(setlist_id) or fetched[setlist_id]
+        for setlist_id in setlist_ids
+        if cached.get(setlist_id) or fetched[setlist_id]
+    ]
+
+
+def tour_page(mbid, tour_name, page):
+    """
+    Returns a page of Setlist.fm's search for the artist's setlists on a tour
+    """
+    return setlistfm_get(
+        "/search/setlists",
+        params=[("artistMbid", mbid), ("tourName", tour_name), ("p", page)],
+    )
+
+
+def tour_setlists(mbid, tour_name):
+    """
+    - Returns up to MAX_SETLISTS of the artist's setlists on a tour, newest
+      first
+    - After the first page the rest are fetched CONCURRENCY at a time
+    """
+    try:
+        first = tour_page(mbid, tour_name, 1)
+    except (UpstreamUnavailable, RateLimitExceeded):
+        return []
+    # Setlist.fm answers a search without results with an error object
+    setlists = first.get("setlist", [])
+    if not setlists:
+        return []
+
+    per_page = first.get("itemsPerPage") or len(setlists)
+    pages = ceil(min(first.get("total", 0), MAX_SETLISTS) / per_page)
+
+    def fetch_page(page):
+        try:
+            return tour_page(mbid, tour_name, page).get("setlist", [])
+        except (UpstreamUnavailable, RateLimitExceeded):
+            return []
+
+    for rest in map_in_context(fetch_page, range(2, pages + 1), CONCURRENCY):
+        setlists.extend(rest)
+    return setlists[:MAX_SETLISTS]
+
+
+def event_day(setlist):
+    """
+    Returns the day of a setlist's show, for sorting
+    """
+    try:
+        return datetime.strptime(setlist["eventDate"], "%d-%m-%Y")
+    except (KeyError, ValueError):
+        return datetime.min
+
+
+def compile_songs(setlists):
+    """
+    - Merges the setlists into one list of songs (dicts), each song once
+    - Most played first, songs played as often ordered by where they usually
+      come in the set, then by when they were first played
+    """
+    song_lists = [extract_songs(setlist) for setlist in setlists]
+    plays, positions, _, _ = count_setlists(song_lists)
+
+    first_seen = {}
+    for setlist in setlists:
+        for song in setlist_songs(setlist):
+            first_seen.setdefault(song.get("name", "").strip(), song)
+
+    order = sorted(
+        plays, key=lambda name: (-plays[name], positions[name] / plays[name])
+    )
+    return [first_seen[name] for name in order]
+
+
+def compilation_id(setlists):
+    """
+    Returns the setlistfm_setlist_id of the compilation of the setlists, the
+    same for the same shows in any order
+    """
+    ids = ",".join(sorted(setlist["id"] for setlist in setlists))
+    return COMPILATION_PREFIX + hashlib.sha1(ids.encode()).hexdigest()[:16]
+
+
+def compilation_details(band, setlists, tour_name=None):
+    """
+    Returns the Playlist columns describing a compilation of the setlists
+    """
+    days = sorted(setlists, key=event_day)
+    first, last = days[0]["eventDate"], days[-1]["eventDate"]
+    tours = {setlist.get("tour", {}).get("name") for setlist in setlists}
+    tour_name = tour_name or (tours.pop() if len(tours) == 1 else None) or "N/A"
+    cities = {setlist["venue"]["city"]["name"] for setlist in setlists}
+
+    shows = f"{len(setlists)} shows" if len(setlists) > 1 else "1 show"
+    if tour_name != "N/A":
+        name = f"{band.name} - {tour_name} ({shows})"
+    else:
+        name = f"{band.name} @ {shows}"
+    return {
+        "setlistfm_setlist_id": compilation_id(setlists),
+        "name": name,
+        "description": (
+            name
+            + ". Every song played from "
+            + first
+            + " to "
+            + last
+            + ", most played first. Tour - "
+            + tour_name
+        ),
+        "tour_name": tour_name,
+        "venue_name": shows,
+        "event_date": first if first == last else f"{first} - {last}",
+        "venue_loc": (
+            f"{len(cities)} cities" if len(cities) > 1 else next(iter(cities))
+        ),
+    }
+
+
+def build_compilation(spotify, band, setlists, tour_name=None):
+    """
+    - Returns the shared playlist compiling the band's setlists (dicts),
+      building it if nobody has yet
+    - Songs are resolved once each however many shows played them
+    - Caches the setlists for the band's stats and commits
+    """
+    setlists = [
+        setlist
+        for setlist in setlists
+        if setlist.get("artist", {}).get("mbid") == band.setlistfm_artist_id
+    ]
+    if not setlists:
+        return None
+
+    details = compilation_details(band, setlists, tour_name)
+    playlist = (
+        Playlist.shared()
+        .filter_by(
+            setlistfm_setlist_id=details["setlistfm_setlist_id"], band_id=band.id
+        )
+        .first()
+    )
+    if playlist is not None:
+        return playlist
+
+    playlist = Playlist(
+        spotify_playlist_id="None Yet", length=0, band_id=band.id, **details
+    )
+    fill_playlist(spotify, band, playlist, compile_songs(setlists))
+    db.session.commit()
+
+    try:
+        cache_setlists(band, setlists)
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent request cached them first
+        db.session.rollback()
+    return playlist
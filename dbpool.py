@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import NullPool
+
+# "queue" keeps a connection pool in each worker, "pgbouncer" leaves pooling to
+# an external pgbouncer running in transaction mode
+POOL_MODE = os.environ.get("DB_POOL_MODE", "queue")
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 5))
+POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 10))
+POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true") == "true"
+STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 15000))
+
+
+def engine_options(uri):
+    """
+    - Builds SQLALCHEMY_ENGINE_OPTIONS for the database uri from the DB_* envs
+    - Queue mode: a bounded pool per worker with pre-ping and recycling, and a
+      statement timeout set when each connection opens
+    - pgbouncer mode: no pool in the worker, pgbouncer hands out server
+      connections per transaction so the timeout is set per transaction
+      (see install_statement_timeout)
+    - SQLite only gets what it needs to be shared by async view threads
+    """
+    if uri.startswith("sqlite"):
+        return {"connect_args": {"check_same_thread": False}}
+
+    if POOL_MODE == "pgbouncer":
+        return {"poolclass": NullPool, "pool_pre_ping": POOL_PRE_PING}
+
+    options = {
+        "pool_size": POOL_SIZE,
+        "max_overflow": MAX_OVERFLOW,
+        "pool_timeout": POOL_TIMEOUT,
+        "pool_recycle": POOL_RECYCLE,
+        "pool_pre_ping": POOL_PRE_PING,
+    }
+    if STATEMENT_TIMEOUT_MS:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"
+        }
+    return options
+
+
+def install_statement_timeout(engine):
+    """
+    - pgbouncer in transaction mode rejects startup options and shares server
+      connections between clients, so a session level SET would leak
+    - Sets the timeout with SET LOCAL at the start of every transaction instead
+    """
+    if (
+        POOL_MODE != "pgbouncer"
+        or not STATEMENT_TIMEOUT_MS
+        or engine.dialect.name != "postgresql"
+    ):
+        return
+
+    @event.listens_for(engine, "begin")
+    def set_local_timeout(conn):
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {STATEMENT_TIMEOUT_MS}")
+
+
+class PoolMetrics:
+    """
+    Connection pool usage for this worker, collected from pool events
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {
+            "connects": 0,
+            "checkouts": 0,
+            "checkins": 0,
+            "invalidations": 0,
+            "forked_discards": 0,
+        }
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.checkout_seconds = 0.0
+        self.engine = None
+
+    def _add(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def install(self, engine):
+        """
+        - Listens to the engine's pool events
+        - Connections opened by a parent process are discarded on checkout so
+          forked workers never share a socket
+        """
+        self.engine = engine
+
+        @event.listens_for(engine, "connect")
+        def on_connect(dbapi_conn, record):
+            record.info["pid"] = os.getpid()
+            self._add("connects")
+
+        @event.listens_for(engine, "checkout")
+        def on_checkout(dbapi_conn, record, proxy):
+            pid = os.getpid()
+            if record.info.get("pid", pid) != pid:
+                self._add("forked_discards")
+                record.connection = proxy.connection = None
+                raise exc.DisconnectionError(
+                    "Connection belongs to a different process"
+                )
+
+            record.info["checked_out_at"] = time.monotonic()
+            with self.lock:
+                self.counts["checkouts"] += 1
+                self.checked_out += 1
+                self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+        @event.listens_for(engine, "checkin")
+        def on_checkin(dbapi_conn, record):
+            started = record.info.pop("checked_out_at", None)
+            if started is None:
+                return
+            with self.lock:
+                self.counts["checkins"] += 1
+                self.checked_out -= 1
+                self.checkout_seconds += time.monotonic() - started
+
+        @event.listens_for(engine, "invalidate")
+        def on_invalidate(dbapi_conn, record, exception):
+            self._add("invalidations")
+
+    def snapshot(self):
+        """
+        Returns this worker's pool numbers as a dict
+        """
+        with self.lock:
+            result = dict(self.counts)
+            result["checked_out"] = self.checked_out
+            result["peak_checked_out"] = self.peak_checked_out
+            result["checkout_seconds"] = round(self.checkout_seconds, 3)
+
+        result["pid"] = os.getpid()
+        result["mode"] = POOL_MODE
+        pool = self.engine.pool if self.engine is not None else None
+        if pool is not None and hasattr(pool, "size"):
+            result["size"] = pool.size()
+            result["overflow"] = pool.overflow()
+            result["idle"] = pool.checkedin()
+        return result
+
+
+pool_metrics = PoolMetrics()
+replica_pool_metrics = PoolMetrics()
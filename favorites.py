@@ -0,0 +1,222 @@
+import logging
+import os
+import queue
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+import metrics
+import shows
+from models import Band, Favorite, db
+from ratelimit import RateLimitExceeded, background
+from upstream import UpstreamUnavailable, setlistfm_get
+
+DEFAULT_PHOTO = "/static/img/rocco-dipoppa-_uDj_lyPVpA-unsplash.jpg"
+# Band.setlistfm_artist_id until the band has been found on Setlist.fm
+PENDING = ""
+# Bands one request can add, remove or toggle
+MAX_BATCH = int(os.environ.get("FAVORITES_MAX_BATCH", 200))
+ACTIONS = ("add", "remove", "toggle")
+
+log = logging.getLogger("setplaylist.favorites")
+
+
+def favorited(user_id, band_ids):
+    """
+    Returns the ids of the bands that are among the user's favorites
+    """
+    if not band_ids:
+        return set()
+    return {
+        band_id
+        for (band_id,) in db.session.query(Favorite.band_id).filter(
+            Favorite.user_id == user_id, Favorite.band_id.in_(band_ids)
+        )
+    }
+
+
+def known_bands(spotify_ids):
+    """
+    Returns the bands already in the database by Spotify artist id
+    """
+    if not spotify_ids:
+        return {}
+    return {
+        band.spotify_artist_id: band
+        for band in Band.query.filter(Band.spotify_artist_id.in_(spotify_ids))
+    }
+
+
+def artist_photo(artist):
+    """
+    Returns a Spotify artist's (dict) first image, or the default photo
+    """
+    try:
+        return artist["images"][0]["url"]
+    except (IndexError, KeyError):
+        return DEFAULT_PHOTO
+
+
+def band_from_artist(artist):
+    """
+    Returns a new band for a Spotify artist (dict), to be found on Setlist.fm
+    later
+    """
+    return Band(
+        spotify_artist_id=artist["id"],
+        setlistfm_artist_id=PENDING,
+        name=artist["name"],
+        photo=artist_photo(artist),
+    )
+
+
+def update_favorites(user_id, bands, action):
+    """
+    - Adds, removes or toggles the bands in the user's favorites with one
+      query to find the current ones and one to delete
+    - Returns the bands (added, removed), the caller commits
+    """
+    current = favorited(user_id, [band.id for band in bands])
+    added = [band for band in bands if band.id not in current and action != "remove"]
+    removed = [band for band in bands if band.id in current and action != "add"]
+
+    if removed:
+        Favorite.query.filter(
+            Favorite.user_id == user_id,
+            Favorite.band_id.in_([band.id for band in removed]),
+        ).delete(synchronize_session=False)
+    db.session.add_all(Favorite(user_id=user_id, band_id=band.id) for band in added)
+    return added, removed
+
+
+def save_favorites(user, spotify_ids, action, fetch_artists):
+    """
+    - Adds, removes or toggles ("add", "remove", "toggle") the bands in the
+      user's favorites in one transaction
+    - Bands that aren't in the database are added from
+      fetch_artists(spotify_ids), which returns Spotify artists (dicts), and
+      found on Setlist.fm in the background
+    - Returns {"added": [...], "removed": [...]} Spotify artist ids
+    """
+    spotify_ids = list(dict.fromkeys(spotify_ids))
+
+    for attempt in range(2):
+        try:
+            bands = known_bands(spotify_ids)
+            missing = [
+                spotify_id for spotify_id in spotify_ids if spotify_id not in bands
+            ]
+            if missing and action != "remove":
+                for artist in fetch_artists(missing):
+                    if artist is not None and artist["id"] not in bands:
+                        bands[artist["id"]] = band_from_artist(artist)
+                        db.session.add(bands[artist["id"]])
+                db.session.flush()
+
+            added, removed = update_favorites(user.id, list(bands.values()), action)
+            result = {
+                "added": [band.spotify_artist_id for band in added],
+                "removed": [band.spotify_artist_id for band in removed],
+            }
+            pending = [
+                band.id
+                for band in bands.values()
+                if band.setlistfm_artist_id == PENDING
+            ]
+            db.session.commit()
+            break
+        except IntegrityError:
+            # A concurrent request added one of the bands or favorites first
+            db.session.rollback()
+            if attempt:
+                raise
+
+    enricher.add(pending)
+    shows.refresh_user(user.id)
+    return result
+
+
+def find_setlistfm_artist(name):
+    """
+    Returns the Setlist.fm mbid of the artist named name, or None
+    """
+    res = setlistfm_get(
+        "/search/artists", params=[("artistName", name), ("sort", "relevance")]
+    )
+    for artist in res.get("artist", []):
+        if artist["name"].lower() == name.lower():
+            return artist["mbid"]
+    return None
+
+
+class Enricher:
+    """
+    One background thread per worker that finds newly added bands on
+    Setlist.fm, so adding favorites never waits on it
+    """
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.queued = set()
+        self.thread = None
+
+    def add(self, band_ids):
+        """
+        Queues bands to be found, starting the thread on first use
+        """
+        with self.lock:
+            for band_id in band_ids:
+                if band_id not in self.queued:
+                    self.queued.add(band_id)
+                    self.queue.put(band_id)
+            if self.queued and (self.thread is None or not self.thread.is_alive()):
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        """
+        Finds queued bands one at a time, as background upstream work
+        """
+        while True:
+            band_id = self.queue.get()
+            try:
+                with self.app.app_context(), background():
+                    self.enrich(band_id)
+            except Exception:
+                log.exception("Finding band %s on Setlist.fm failed", band_id)
+            finally:
+                with self.lock:
+                    self.queued.discard(band_id)
+
+    def enrich(self, band_id):
+        """
+        - Saves the band's Setlist.fm mbid if it's still pending
+        - Bands Setlist.fm doesn't know, or that can't be looked up right now,
+          stay pending and are queued again the next time they're favorited
+        """
+        band = Band.query.get(band_id)
+        if band is None or band.setlistfm_artist_id != PENDING:
+            return
+
+        try:
+            mbid = find_setlistfm_artist(band.name)
+        except (UpstreamUnavailable, RateLimitExceeded):
+            result = "unavailable"
+        else:
+            result = "not_found" if mbid is None else "found"
+            if mbid is not None:
+                band.setlistfm_artist_id = mbid
+                db.session.commit()
+        metrics.store.add("setplaylist_band_enrich_total", {"result": result})
+
+
+enricher = Enricher()
+
+
+def install_app(app):
+    """
+    Gives the enricher the app its thread works in
+    """
+    enricher.app = app
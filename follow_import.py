@@ -0,0 +1,224 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import tekore
+
+import metrics
+import shows
+from favorites import PENDING, artist_photo, enricher, find_setlistfm_artist
+from models import Band, Favorite, Import_Job, db, insert_ignoring_conflicts
+from ratelimit import RateLimitExceeded, background
+from upstream import UpstreamUnavailable
+
+# Imports running at once per worker, more wait in the queue
+WORKERS = int(os.environ.get("FOLLOW_IMPORT_WORKERS", 2))
+# Setlist.fm lookups in flight per worker, the governor still paces them
+RESOLVE_CONCURRENCY = int(os.environ.get("FOLLOW_IMPORT_RESOLVE_CONCURRENCY", 4))
+# A running import that hasn't reported progress for this long is presumed
+# lost with its worker, and the user can start another
+STALE_SECONDS = int(os.environ.get("FOLLOW_IMPORT_STALE_SECONDS", 600))
+
+log = logging.getLogger("setplaylist.follow_import")
+
+
+def band_row(artist):
+    """
+    Returns the bands row for a Spotify artist (dict)
+    """
+    return {
+        "spotify_artist_id": artist["id"],
+        "setlistfm_artist_id": PENDING,
+        "name": artist["name"],
+        "photo": artist_photo(artist),
+    }
+
+
+def import_page(user_id, artists):
+    """
+    - Adds the artists missing from bands and the user's favorites with one
+      INSERT ... ON CONFLICT each, so concurrent imports and favorites can't
+      collide
+    - Returns (favorites added, [(band id, name)] still pending on Setlist.fm),
+      the caller commits
+    """
+    spotify_ids = list({artist["id"]: None for artist in artists})
+    insert_ignoring_conflicts(Band, [band_row(artist) for artist in artists])
+
+    bands = (
+        db.session.query(Band.id, Band.name, Band.setlistfm_artist_id)
+        .filter(Band.spotify_artist_id.in_(spotify_ids))
+        .all()
+    )
+    band_ids = [band_id for band_id, _, _ in bands]
+    already = {
+        band_id
+        for (band_id,) in db.session.query(Favorite.band_id).filter(
+            Favorite.user_id == user_id, Favorite.band_id.in_(band_ids)
+        )
+    }
+    insert_ignoring_conflicts(
+        Favorite,
+        [
+            {"user_id": user_id, "band_id": band_id}
+            for band_id in band_ids
+            if band_id not in already
+        ],
+    )
+    pending = [(band_id, name) for band_id, name, mbid in bands if mbid == PENDING]
+    return len(band_ids) - len(already), pending
+
+
+def resolve(name):
+    """
+    Looks a band up on Setlist.fm as background work, returns its mbid, None
+    if Setlist.fm doesn't know it or False if Setlist.fm can't be asked now
+    """
+    try:
+        with background():
+            return find_setlistfm_artist(name)
+    except (UpstreamUnavailable, RateLimitExceeded):
+        return False
+
+
+class Importer:
+    """
+    Runs followed artist imports on a small pool of threads per worker,
+    committing each page of artists with the job's progress
+    """
+
+    def __init__(self, workers=WORKERS, concurrency=RESOLVE_CONCURRENCY):
+        self.app = None
+        self.workers = workers
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.pool = None
+        self.resolvers = None
+        self.pid = None
+
+    def executors(self):
+        """
+        Returns this process's (job pool, Setlist.fm lookup pool), started on
+        first use since threads don't survive gunicorn forking workers
+        """
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = ThreadPoolExecutor(self.workers)
+                self.resolvers = ThreadPoolExecutor(self.concurrency)
+                self.pid = os.getpid()
+            return self.pool, self.resolvers
+
+    def start(self, user_id, pages):
+        """
+        - Queues an import of pages, an iterable of (artists, total) pages
+          of Spotify artists (dicts), fetched as the import goes
+        - Returns the user's unfinished import instead if they have one
+        """
+        job = (
+            Import_Job.query.filter(
+                Import_Job.user_id == user_id,
+                Import_Job.status.in_(["queued", "running"]),
+                Import_Job.updated_at
+                > datetime.utcnow() - timedelta(seconds=STALE_SECONDS),
+            )
+            .order_by(Import_Job.id.desc())
+            .first()
+        )
+        if job is not None:
+            return job
+
+        job = Import_Job(user_id=user_id)
+        db.session.add(job)
+        db.session.commit()
+        self.executors()[0].submit(self.run, job.id, pages)
+        return job
+
+    def run(self, job_id, pages):
+        """
+        Runs an import in the app's context, recording why it failed if it does
+        """
+        with self.app.app_context():
+            job = Import_Job.query.get(job_id)
+            try:
+                self.import_pages(job, pages)
+            except Exception as e:
+                db.session.rollback()
+                if isinstance(e, (tekore.Unauthorised, tekore.Forbidden)):
+                    job.error = "Reconnect Spotify to allow importing followed artists"
+                else:
+                    log.exception("Import %s failed", job_id)
+                    job.error = "The import failed, try again later"
+                job.status = "failed"
+                job.updated_at = datetime.utcnow()
+                db.session.commit()
+                metrics.store.add(
+                    "setplaylist_follow_import_total", {"result": "failed"}
+                )
+
+    def import_pages(self, job, pages):
+        """
+        - Saves each page of artists as it's fetched, looking up the new bands
+          on Setlist.fm concurrently while the next page is saved
+        - Commits each page with the job's progress
+        """
+        job.status = "running"
+        db.session.commit()
+        resolvers = self.executors()[1]
+        lookups = []
+
+        for artists, total in pages:
+            added, pending = import_page(job.user_id, artists)
+            lookups.extend(
+                (band_id, resolvers.submit(resolve, name)) for band_id, name in pending
+            )
+            job.total = total
+            job.imported += len(artists)
+            job.added += added
+            job.resolved += self.save_resolved(lookups)
+            job.updated_at = datetime.utcnow()
+            db.session.commit()
+
+        for _, lookup in lookups:
+            lookup.result()
+        job.resolved += self.save_resolved(lookups)
+        job.status = "done"
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+        shows.refresh_user(job.user_id)
+        metrics.store.add("setplaylist_follow_import_total", {"result": "done"})
+
+    def save_resolved(self, lookups):
+        """
+        - Saves the mbids of finished lookups, removing them from lookups
+        - Bands Setlist.fm couldn't be asked about are handed to the background
+          enricher to try again
+        - Returns how many were found
+        """
+        done = [(band_id, lookup) for band_id, lookup in lookups if lookup.done()]
+        lookups[:] = [
+            (band_id, lookup) for band_id, lookup in lookups if not lookup.done()
+        ]
+
+        resolved = 0
+        for band_id, lookup in done:
+            mbid = lookup.result()
+            if mbid is False:
+                enricher.add([band_id])
+            elif mbid is not None:
+                db.session.query(Band).filter(
+                    Band.id == band_id, Band.setlistfm_artist_id == PENDING
+                ).update({"setlistfm_artist_id": mbid}, synchronize_session=False)
+                resolved += 1
+        return resolved
+
+
+importer = Importer()
+
+
+def install_app(app):
+    """
+    Gives the importer the app its threads work in
+    """
+    importer.app = app
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from flask import render_template
+from markupsafe import Markup
+
+import metrics
+
+MAX_ENTRIES = int(os.environ.get("FRAGMENT_CACHE_MAX_ENTRIES", 2000))
+
+
+class FragmentCache:
+    """
+    Rendered template fragments, kept per worker in least recently used order.
+    Keys include a version of the fragment's content, changed content gets a
+    new key so nothing has to be invalidated, old versions just age out.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the cached html for a key, or None
+        """
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        """
+        Caches the html for a key, dropping the least recently used past
+        max_entries
+        """
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def render(self, name, version, template, context_fn):
+        """
+        - Returns the fragment's html from the cache if this version is cached
+        - Otherwise renders the template with the context from context_fn and
+          caches it, context_fn only runs on a miss
+        """
+        key = (name, version)
+        html = self.get(key)
+        metrics.store.add(
+            "setplaylist_fragment_cache_total",
+            {"fragment": name, "result": "miss" if html is None else "hit"},
+        )
+        if html is None:
+            html = Markup(render_template(template, **context_fn()))
+            self.set(key, html)
+        return html
+
+
+cache = FragmentCache()
+
+
+def content_version(*parts):
+    """
+    Returns a short digest of a fragment's inputs
+    """
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+
+def setlist_display(set):
+    """
+    Returns setlist details arranged in venue name - event date - venue location
+    """
+    venue_name = set["venue"]["name"]
+    event_date = set["eventDate"]
+    try:
+        state_code = set["venue"]["city"]["stateCode"]
+    except KeyError:
+        state_code = ""
+    venue_loc = (
+        set["venue"]["city"]["name"]
+        + ", "
+        + state_code
+        + ", "
+        + set["venue"]["city"]["country"]["code"]
+    )
+    if venue_name == "":
+        venue_name = "Venue Unknown"
+    return f"{venue_name} - {event_date} - {venue_loc}"
+
+
+def show_display(show):
+    """
+    Returns upcoming show details arranged in date - venue name - venue location
+    """
+    return (
+        f"{show['datetime'][:10]} - {show['venue']['name']} - "
+        f"{show['venue']['location']}"
+    )
+
+
+def band_setlists(band, setlists):
+    """
+    The band's setlist links, setlist.fm bumps a setlist's versionId whenever
+    it's edited so ids and versions stand in for the content
+    """
+    version = content_version(
+        band["id"],
+        None
+        if setlists is None
+        else [
+            (set["id"], set.get("versionId"), set.get("lastUpdated"))
+            for set in setlists
+        ],
+    )
+
+    def context():
+        if setlists is None:
+            return {"band": band, "setlists": None}
+        return {
+            "band": band,
+            "setlists": [
+                {"id": set["id"], "display": setlist_display(set)} for set in setlists
+            ],
+        }
+
+    return cache.render("band_setlists", version, "/band/_setlists.html", context)
+
+
+def band_upcoming_shows(band, upcoming_shows):
+    """
+    The band's upcoming shows
+    """
+    shows = [
+        (
+            show.get("url") or "",
+            show["datetime"],
+            show["venue"]["name"],
+            show["venue"]["location"],
+        )
+        for show in upcoming_shows or []
+    ]
+    version = content_version(band["name"], shows)
+
+    def context():
+        return {
+            "band": band,
+            "upcoming_shows": [
+                {"url": show.get("url") or "", "display": show_display(show)}
+                for show in upcoming_shows or []
+            ],
+        }
+
+    return cache.render("band_upcoming", version, "/band/_upcoming.html", context)
+
+
+def playlist_songs(playlist):
+    """
+    - The playlist's song list
+    - Unsaved playlists carry their song names, they're the version
+    - A saved playlist's version is bumped whenever its songs change, so its
+      id and version stand in for the songs and they're only loaded on a miss
+    """
+    songz = getattr(playlist, "songz", None)
+    if songz:
+        version = content_version("unsaved", songz)
+    else:
+        version = content_version(playlist.id, playlist.version)
+
+    def context():
+        if songz:
+            return {"songs": songz}
+        return {"songs": [song.name for song in playlist.songs]}
+
+    return cache.render("playlist_songs", version, "/playlist/_songs.html", context)
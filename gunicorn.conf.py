@@ -0,0 +1,9 @@
+import os
+
+# Threaded workers: each request gets its own thread, so requests waiting on
+# upstream APIs in the async views don't hold up the worker's other requests
+worker_class = "gthread"
+
+# Requests each worker serves at once, keep under the database pool's
+# DB_POOL_SIZE + DB_MAX_OVERFLOW. Workers come from WEB_CONCURRENCY
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
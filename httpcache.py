@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, request, session
+
+# Seconds browsers may reuse a public page before revalidating
+PAGE_MAX_AGE = int(os.environ.get("HTTP_PAGE_MAX_AGE", 60))
+# Seconds a CDN may serve a public page, also how long pages built from
+# upstream data keep their version
+CDN_MAX_AGE = int(os.environ.get("HTTP_CDN_MAX_AGE", 300))
+# Seconds browsers may reuse static files that aren't fingerprinted
+ASSET_MAX_AGE = int(os.environ.get("HTTP_ASSET_MAX_AGE", 86400))
+IMMUTABLE_MAX_AGE = 31536000
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+release_version = None
+asset_versions = {}
+asset_lock = threading.Lock()
+
+
+def digest(*parts):
+    """
+    Returns a short digest of parts
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+
+def release():
+    """
+    - The deployed release, pages change with it
+    - RELEASE_VERSION or Heroku's HEROKU_SLUG_COMMIT when set, otherwise a
+      digest of the templates
+    """
+    global release_version
+    if release_version is None:
+        release_version = os.environ.get("RELEASE_VERSION") or os.environ.get(
+            "HEROKU_SLUG_COMMIT"
+        )
+    if release_version is None:
+        sha = hashlib.sha1()
+        for root, dirs, files in sorted(os.walk(TEMPLATES)):
+            for file_name in sorted(files):
+                with open(os.path.join(root, file_name), "rb") as f:
+                    sha.update(f.read())
+        release_version = sha.hexdigest()[:16]
+    return release_version
+
+
+def upstream_window():
+    """
+    Version for pages built from upstream data, changes every CDN_MAX_AGE
+    seconds. The page can be that stale at a CDN anyway, so answering a
+    revalidation with 304 inside the window adds no staleness.
+    """
+    return int(time.time() // CDN_MAX_AGE)
+
+
+def page_etag(version_fn, kwargs):
+    """
+    Returns the page's ETag for signed out users, or None for signed in
+    users since their pages are personalized
+    """
+    if g.get("user"):
+        return None
+    parts = version_fn(**kwargs) if version_fn is not None else ()
+    return digest(release(), request.path, parts)
+
+
+def not_modified(etag):
+    """
+    Returns a 304 for the ETag
+    """
+    response = current_app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def cache_page(version_fn=None):
+    """
+    - Marks a view as cacheable for signed out users, version_fn gets the
+      view's arguments and returns the versions of the data the page shows
+    - A request whose If-None-Match has the page's ETag gets a 304 before the
+      view runs, so no upstream or database work is done
+    - Pages for signed in users are personalized and stay private
+    """
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+
+            @wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                etag = g.page_etag = page_etag(version_fn, kwargs)
+                if etag is not None and request.if_none_match.contains_weak(etag):
+                    return not_modified(etag)
+                return await view(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = g.page_etag = page_etag(version_fn, kwargs)
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def asset_version(filename):
+    """
+    Returns a digest of a static file's contents, recomputed when it changes
+    """
+    path = os.path.join(current_app.static_folder, filename)
+    mtime = os.stat(path).st_mtime
+    with asset_lock:
+        cached = asset_versions.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as f:
+        version = hashlib.sha1(f.read()).hexdigest()[:12]
+    with asset_lock:
+        asset_versions[filename] = (mtime, version)
+    return version
+
+
+def asset_url(filename):
+    """
+    Returns a static file's URL fingerprinted with its contents, for when
+    the assets haven't been built
+    """
+    return f"/static/{filename}?v={asset_version(filename)}"
+
+
+def static_policy(response):
+    """
+    - Fingerprinted URLs never change, they're cached for a year
+    - Other static files are cached for ASSET_MAX_AGE, then revalidated with
+      the Last-Modified header Flask already sends
+    """
+    if response.status_code not in (200, 304):
+        return
+    filename = request.view_args.get("filename", "")
+    fingerprinted = False
+    if request.args.get("v"):
+        try:
+            fingerprinted = request.args["v"] == asset_version(filename)
+        except OSError:
+            fingerprinted = False
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    if fingerprinted:
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = ASSET_MAX_AGE
+
+
+def page_policy(response):
+    """
+    - Public caching for signed out users' successful responses that don't
+      set a cookie, shared caches keep them for CDN_MAX_AGE
+    - Everything else from a cacheable view is private and revalidated
+    - Errors aren't stored
+    """
+    etag = g.page_etag
+    if response.status_code >= 400:
+        response.cache_control.no_store = True
+        return
+    if (
+        etag is None
+        or response.status_code not in (200, 304)
+        or session.modified
+        or "Set-Cookie" in response.headers
+    ):
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return
+
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = PAGE_MAX_AGE
+    response.cache_control.s_maxage = CDN_MAX_AGE
+    response.vary.add("Cookie")
+
+
+def apply_policy(response):
+    """
+    after_request hook, sets the caching headers for static files and
+    cacheable views
+    """
+    if request.endpoint == "static":
+        static_policy(response)
+    elif "page_etag" in g:
+        page_policy(response)
+    return response
+
+
+def install_app(app):
+    """
+    - Applies the caching policy to the app's responses
+    - The hook goes first in the list so it runs after every other
+      after_request hook, which may still change the session
+    """
+    app.after_request_funcs.setdefault(None, []).insert(0, apply_policy)
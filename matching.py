@@ -0,0 +1,148 @@
+import json
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+SEARCH_LIMIT = 5
+MIN_SCORE = 0.6
+
+QUALIFIER_RE = re.compile(r"\s*[\(\[][^\)\]]*[\)\]]")
+SUFFIX_RE = re.compile(
+    r"\s+-\s+(?:(?:\d{4}\s+)?remaster(?:ed)?|live|acoustic|demo|single|"
+    r"radio edit|mono|stereo|version|edit|bonus)\b.*$"
+)
+MEDLEY_RE = re.compile(r"\s+(?:/|>|->)\s+")
+PUNCTUATION_RE = re.compile(r"[^\w\s]")
+SPACE_RE = re.compile(r"\s+")
+ALT_VERSION_WORDS = (
+    "live",
+    "acoustic",
+    "demo",
+    "remix",
+    "karaoke",
+    "instrumental",
+    "rehearsal",
+    "commentary",
+)
+
+
+def normalize_title(name):
+    """
+    - Lowercases the title and strips accents and punctuation
+    - Removes qualifiers like "(acoustic)", "[live]" and " - 2011 Remaster"
+    - Returns the normalized title
+    """
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(c for c in name if not unicodedata.combining(c)).lower()
+    name = QUALIFIER_RE.sub("", name)
+    name = SUFFIX_RE.sub("", name)
+    name = name.replace("&", " and ")
+    name = PUNCTUATION_RE.sub("", name)
+    return SPACE_RE.sub(" ", name).strip()
+
+
+def strip_qualifiers(title):
+    """
+    Removes bracketed qualifiers like "(acoustic)" from a title for searching
+    """
+    return QUALIFIER_RE.sub("", title).strip() or title
+
+
+def split_medley(name):
+    """
+    - Splits a medley or segue ("Song A / Song B", "Song A > Song B")
+    - Returns the list of song titles
+    """
+    return [part for part in MEDLEY_RE.split(name) if part.strip()]
+
+
+def song_queries(song, band_name):
+    """
+    - Takes a Setlist.fm song (dict) and the band's name
+    - Covers are searched under the original artist
+    - Returns a list of (title, artist) pairs, one per song in a medley
+    """
+    cover = song.get("cover")
+    artist = cover["name"] if cover and cover.get("name") else band_name
+    return [(title, artist) for title in split_medley(song["name"])]
+
+
+def is_alt_version(title):
+    """
+    Returns True if the title is a live/acoustic/demo/etc. version
+    """
+    lowered = title.lower()
+    return any(re.search(rf"\b{word}\b", lowered) for word in ALT_VERSION_WORDS)
+
+
+def score_candidates(title, artist, candidates):
+    """
+    - Scores every Spotify track candidate against the title and artist
+    - Title similarity is weighted most, then artist match
+    - Studio versions are preferred over live/acoustic/etc. versions
+      unless the setlist asked for one
+    - Returns a list of scores in candidate order
+    """
+    wanted = normalize_title(title)
+    wanted_artist = normalize_title(artist)
+    wants_alt = is_alt_version(title)
+
+    scores = []
+    for track in candidates:
+        similarity = SequenceMatcher(
+            None, wanted, normalize_title(track["name"])
+        ).ratio()
+        artists = [normalize_title(a["name"]) for a in track.get("artists", [])]
+        artist_match = 1.0 if wanted_artist in artists else 0.0
+        alt_penalty = 0.15 if is_alt_version(track["name"]) and not wants_alt else 0.0
+        compilation_penalty = (
+            0.05 if track.get("album", {}).get("album_type") == "compilation" else 0.0
+        )
+        scores.append(
+            0.7 * similarity + 0.3 * artist_match - alt_penalty - compilation_penalty
+        )
+
+    return scores
+
+
+def best_match(title, artist, candidates):
+    """
+    - Picks the highest scoring candidate
+    - Returns the track (dict) or None if nothing scores above MIN_SCORE
+    """
+    if not candidates:
+        return None
+
+    scores = score_candidates(title, artist, candidates)
+    best = max(range(len(candidates)), key=lambda i: scores[i])
+
+    if scores[best] < MIN_SCORE:
+        return None
+    return candidates[best]
+
+
+def search_tracks(spotify, title, artist):
+    """
+    - Searches Spotify for a title by an artist
+    - Returns a list of track candidates (dicts)
+    """
+    res = spotify.search(
+        query=("track: " + strip_qualifiers(title) + " artist: " + artist),
+        types=["track"],
+        limit=SEARCH_LIMIT,
+    )
+    json_res = res[0].json()
+    return json.loads(json_res)["items"]
+
+
+def find_tracks(spotify, song, band_name):
+    """
+    - Takes a Setlist.fm song (dict) and the band's name
+    - Returns a list of matching Spotify tracks (dicts), one per song found
+    """
+    tracks = []
+    for title, artist in song_queries(song, band_name):
+        track = best_match(title, artist, search_tracks(spotify, title, artist))
+        if track is not None:
+            tracks.append(track)
+    return tracks
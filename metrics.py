@@ -0,0 +1,453 @@
+import hmac
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import (
+    abort,
+    before_render_template,
+    current_app,
+    g,
+    request,
+    template_rendered,
+)
+from sqlalchemy import event
+
+import profiler
+
+# Seconds between each worker writing its numbers to the shared metrics file
+FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+LOG_REQUESTS = os.environ.get("METRICS_LOG", "") == "true"
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name: (type, help)
+FAMILIES = {
+    "setplaylist_http_request_seconds": (
+        "histogram",
+        "Wall time of each request",
+    ),
+    "setplaylist_request_db_seconds": (
+        "histogram",
+        "Time each request spent in database queries",
+    ),
+    "setplaylist_request_db_queries_total": (
+        "counter",
+        "Database queries run by requests",
+    ),
+    "setplaylist_request_upstream_seconds": (
+        "histogram",
+        "Time each request spent waiting on an upstream api",
+    ),
+    "setplaylist_request_template_seconds": (
+        "histogram",
+        "Time each request spent rendering templates",
+    ),
+    "setplaylist_db_query_seconds": (
+        "histogram",
+        "Duration of each database query",
+    ),
+    "setplaylist_upstream_seconds": (
+        "histogram",
+        "Duration of each upstream api call by cache outcome",
+    ),
+    "setplaylist_template_seconds": (
+        "histogram",
+        "Duration of each template render",
+    ),
+    "setplaylist_fragment_cache_total": (
+        "counter",
+        "Template fragment cache lookups by result",
+    ),
+    "setplaylist_password_hash_seconds": (
+        "histogram",
+        "Duration of each password hash or check, including the trip to the pool",
+    ),
+    "setplaylist_password_hash_wait_seconds": (
+        "histogram",
+        "Time each password hash waited for a free hashing process",
+    ),
+    "setplaylist_password_hash_rejected_total": (
+        "counter",
+        "Password hashes turned away because the hashing queue was full",
+    ),
+    "setplaylist_rate_limit_total": (
+        "counter",
+        "Upstream rate limiter tokens by outcome, throttled ones waited first",
+    ),
+    "setplaylist_rate_limit_wait_seconds": (
+        "histogram",
+        "Time throttled upstream calls waited for a rate limiter token",
+    ),
+    "setplaylist_auth_throttle_total": (
+        "counter",
+        "Login and password reset attempts by outcome, rejected ones were locked out",
+    ),
+    "setplaylist_band_enrich_total": (
+        "counter",
+        "Background Setlist.fm lookups of newly added bands by outcome",
+    ),
+    "setplaylist_follow_import_total": (
+        "counter",
+        "Followed artist imports by outcome",
+    ),
+    "setplaylist_shows_sweep_bands_total": (
+        "counter",
+        "Bands whose upcoming shows the sweep fetched, or failed to",
+    ),
+    "setplaylist_auto_playlist_total": (
+        "counter",
+        "Playlists of new setlists built once, and saved to subscribers' Spotify or failed",
+    ),
+}
+
+log = logging.getLogger("setplaylist.requests")
+
+current_request = ContextVar("current_request", default=None)
+
+
+def format_labels(labels):
+    """
+    Returns labels as a Prometheus label string, sorted by name
+    """
+    return ",".join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+
+
+def sample_order(row):
+    """
+    Sort key that keeps a histogram's buckets in ascending order
+    """
+    name, labels, _ = row
+    match = re.search(r'le="([^"]*)"', labels)
+    if match is None:
+        return name, labels, 0
+    return name, labels.replace(match.group(0), ""), float(match.group(1))
+
+
+class MetricsStore:
+    """
+    Counters and histograms kept in memory by each worker and added into a
+    SQLite file shared by every worker
+    """
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flushed_at = time.time()
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        Returns this thread's connection, creating the table on first use
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS metrics "
+                "(name TEXT NOT NULL, labels TEXT NOT NULL, value REAL NOT NULL, "
+                "PRIMARY KEY (name, labels))"
+            )
+            self.local.conn = conn
+        return conn
+
+    def add(self, name, labels, amount=1):
+        """
+        Adds to a counter
+        """
+        key = (name, format_labels(labels))
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0) + amount
+        self.flush()
+
+    def observe(self, name, labels, seconds):
+        """
+        Records a histogram observation as bucket, sum and count counters
+        """
+        with self.lock:
+            for le in BUCKETS:
+                key = (f"{name}_bucket", format_labels({**labels, "le": le}))
+                self.pending[key] = self.pending.get(key, 0) + (seconds <= le)
+            for suffix, amount in (("_bucket", 1), ("_sum", seconds), ("_count", 1)):
+                key_labels = {**labels, "le": "+Inf"} if suffix == "_bucket" else labels
+                key = (name + suffix, format_labels(key_labels))
+                self.pending[key] = self.pending.get(key, 0) + amount
+        self.flush()
+
+    def flush(self, force=False):
+        """
+        Writes pending numbers to the shared file at most once per interval
+        """
+        with self.lock:
+            if not force and time.time() - self.flushed_at < self.flush_interval:
+                return
+            pending, self.pending = self.pending, {}
+            self.flushed_at = time.time()
+
+        if not pending:
+            return
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value",
+                [(name, labels, value) for (name, labels), value in pending.items()],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def render(self):
+        """
+        Returns every worker's totals in the Prometheus text format
+        """
+        self.flush(force=True)
+        rows = self.connection().execute("SELECT name, labels, value FROM metrics")
+
+        by_family = {}
+        for name, labels, value in sorted(rows, key=sample_order):
+            family = name
+            for suffix in ("_bucket", "_sum", "_count"):
+                if name.endswith(suffix) and name[: -len(suffix)] in FAMILIES:
+                    family = name[: -len(suffix)]
+            by_family.setdefault(family, []).append((name, labels, value))
+
+        lines = []
+        for family, samples in by_family.items():
+            kind, description = FAMILIES.get(family, ("untyped", family))
+            lines.append(f"# HELP {family} {description}")
+            lines.append(f"# TYPE {family} {kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+store = MetricsStore(
+    os.environ.get(
+        "METRICS_DB", os.path.join(tempfile.gettempdir(), "setplaylist-metrics.db")
+    )
+)
+
+
+class RequestMetrics:
+    """
+    Time spent by one request, shared by any threads it runs work in
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.upstream = {}
+        self.upstream_calls = {}
+        self.template_seconds = 0.0
+        self.template_started = {}
+
+    def add_query(self, seconds):
+        """
+        Counts a database query
+        """
+        with self.lock:
+            self.db_seconds += seconds
+            self.db_queries += 1
+
+    def add_upstream(self, api, cache, seconds):
+        """
+        Counts an upstream call and adds to the time spent on the api
+        """
+        with self.lock:
+            self.upstream[api] = self.upstream.get(api, 0.0) + seconds
+            calls = self.upstream_calls.setdefault(api, {})
+            calls[cache] = calls.get(cache, 0) + 1
+
+
+class UpstreamCall:
+    """
+    Set cache on the call to record how it was answered
+    """
+
+    def __init__(self):
+        self.cache = "miss"
+
+
+@contextmanager
+def upstream_timer(api):
+    """
+    - Times an upstream api call made inside the block
+    - The cache outcome (hit, stale, shared, miss) is read from the yielded
+      call, failures are recorded as "error"
+    """
+    call = UpstreamCall()
+    started = time.perf_counter()
+    try:
+        with profiler.track():
+            yield call
+    except Exception:
+        call.cache = "error"
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        profiler.record("upstream", f"{api} {call.cache}", started, seconds)
+        store.observe(
+            "setplaylist_upstream_seconds", {"api": api, "cache": call.cache}, seconds
+        )
+        metrics = current_request.get()
+        if metrics is not None:
+            metrics.add_upstream(api, call.cache, seconds)
+
+
+def install_engine(engine, bind):
+    """
+    Times every query run on the engine
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        seconds = time.perf_counter() - started
+        store.observe("setplaylist_db_query_seconds", {"bind": bind}, seconds)
+        profiler.record("sql", statement[:200], started, seconds)
+        metrics = current_request.get()
+        if metrics is not None:
+            metrics.add_query(seconds)
+
+
+def start_request():
+    """
+    before_request hook, starts collecting the request's timings
+    """
+    g.metrics_token = current_request.set(RequestMetrics())
+
+
+def finish_request(response):
+    """
+    after_request hook, records the request's timings and logs them if enabled
+    """
+    metrics = current_request.get()
+    if metrics is None:
+        return response
+
+    seconds = time.perf_counter() - metrics.started
+    endpoint = request.endpoint or "none"
+    labels = {"endpoint": endpoint}
+
+    store.observe(
+        "setplaylist_http_request_seconds",
+        {**labels, "method": request.method, "status": response.status_code},
+        seconds,
+    )
+    store.observe("setplaylist_request_db_seconds", labels, metrics.db_seconds)
+    store.add("setplaylist_request_db_queries_total", labels, metrics.db_queries)
+    store.observe(
+        "setplaylist_request_template_seconds", labels, metrics.template_seconds
+    )
+    for api, api_seconds in metrics.upstream.items():
+        store.observe(
+            "setplaylist_request_upstream_seconds",
+            {**labels, "api": api},
+            api_seconds,
+        )
+
+    if LOG_REQUESTS:
+        log.info(
+            json.dumps(
+                {
+                    "endpoint": endpoint,
+                    "method": request.method,
+                    "path": request.path,
+                    "status": response.status_code,
+                    "seconds": round(seconds, 4),
+                    "db_seconds": round(metrics.db_seconds, 4),
+                    "db_queries": metrics.db_queries,
+                    "upstream_seconds": {
+                        api: round(value, 4) for api, value in metrics.upstream.items()
+                    },
+                    "upstream_calls": metrics.upstream_calls,
+                    "template_seconds": round(metrics.template_seconds, 4),
+                }
+            )
+        )
+    return response
+
+
+def end_request(error):
+    """
+    teardown_request hook, stops collecting for the request
+    """
+    token = g.pop("metrics_token", None)
+    if token is not None:
+        current_request.reset(token)
+
+
+def template_started(sender, template, context, **extra):
+    """
+    before_render_template signal, notes when the render started
+    """
+    metrics = current_request.get()
+    if metrics is not None:
+        metrics.template_started[template.name] = time.perf_counter()
+
+
+def template_finished(sender, template, context, **extra):
+    """
+    template_rendered signal, records how long the render took
+    """
+    metrics = current_request.get()
+    started = metrics.template_started.pop(template.name, None) if metrics else None
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    with metrics.lock:
+        metrics.template_seconds += seconds
+    profiler.record("template", template.name, started, seconds)
+    store.observe("setplaylist_template_seconds", {"template": template.name}, seconds)
+
+
+def internal(view):
+    """
+    - Serves the view only to requests with the app's METRICS_TOKEN as a
+      bearer token
+    - Anything else, or no METRICS_TOKEN set, gets a 404 so the endpoint
+      doesn't show it exists
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config.get("METRICS_TOKEN")
+        header = request.headers.get("Authorization", "")
+        if not token or not hmac.compare_digest(
+            header.encode(), f"Bearer {token}".encode()
+        ):
+            abort(404)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def install_app(app):
+    """
+    Collects request, template and upstream timings for the app
+    """
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(end_request)
+    before_render_template.connect(template_started, app)
+    template_rendered.connect(template_finished, app)
@@ -0,0 +1,274 @@
+import os
+import sys
+
+from sqlalchemy import inspect, text
+
+from matching import normalize_title
+from models import Song, db
+
+# Rows backfilled per UPDATE batch
+BATCH_ROWS = int(os.environ.get("MIGRATE_BATCH_ROWS", 5000))
+
+
+def columns(table):
+    """
+    Returns the names of a table's columns as the database has them
+    """
+    inspector = inspect(db.session.connection())
+    return {column["name"] for column in inspector.get_columns(table)}
+
+
+def add_column(table, column, ddl):
+    """
+    - ALTER TABLE ADD COLUMN unless the table already has the column
+    - NOT NULL columns need a DEFAULT in their ddl for the existing rows
+    - Returns whether the column was added
+    """
+    if column in columns(table):
+        return False
+    db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return True
+
+
+def add_index(table, name, column_names):
+    """
+    - CREATE INDEX unless the table already has an index by that name
+    - Returns whether the index was added
+    """
+    inspector = inspect(db.session.connection())
+    if name in {index["name"] for index in inspector.get_indexes(table)}:
+        return False
+    db.session.execute(
+        text(f"CREATE INDEX {name} ON {table} ({', '.join(column_names)})")
+    )
+    return True
+
+
+def has_unique(table, column_names):
+    """
+    Returns whether a unique constraint or index covers exactly the columns
+    """
+    inspector = inspect(db.session.connection())
+    found = [c["column_names"] for c in inspector.get_unique_constraints(table)]
+    found += [i["column_names"] for i in inspector.get_indexes(table) if i["unique"]]
+    return list(column_names) in found
+
+
+def add_unique(table, name, column_names):
+    """
+    - ALTER TABLE ADD CONSTRAINT UNIQUE, SQLite can't add constraints so it
+      gets a unique index instead
+    - The caller checks has_unique and removes duplicates first
+    """
+    columns = ", ".join(column_names)
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(
+            text(f"ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE ({columns})")
+        )
+    else:
+        db.session.execute(text(f"CREATE UNIQUE INDEX {name} ON {table} ({columns})"))
+
+
+def band_stats():
+    """
+    Song-frequency stats of each band's cached setlists
+    """
+    return any(
+        [
+            add_column("bands", "stats_setlist_count", "INTEGER NOT NULL DEFAULT 0"),
+            add_column("bands", "stats_song_total", "INTEGER NOT NULL DEFAULT 0"),
+        ]
+    )
+
+
+def song_catalog():
+    """
+    - Albums of songs from a band's preloaded Spotify catalog, and when it was
+      last synced
+    - Songs' normalized names, backfilled for the existing songs, and the
+      index the catalog matches them on
+    """
+    changed = any(
+        [
+            add_column("bands", "catalog_synced_at", "TIMESTAMP"),
+            add_column("songs", "normalized_name", "TEXT"),
+            add_column("songs", "album_id", "INTEGER REFERENCES albums (id)"),
+            add_index(
+                "songs",
+                "ix_songs_band_id_normalized_name",
+                ["band_id", "normalized_name"],
+            ),
+        ]
+    )
+    while True:
+        songs = (
+            db.session.query(Song.id, Song.name)
+            .filter(Song.normalized_name.is_(None))
+            .limit(BATCH_ROWS)
+            .all()
+        )
+        if not songs:
+            return changed
+        db.session.bulk_update_mappings(
+            Song,
+            [
+                {"id": id, "normalized_name": normalize_title(name)}
+                for id, name in songs
+            ],
+        )
+        changed = True
+
+
+def merge_duplicate_bands():
+    """
+    Points every reference to a band at the oldest band of its Spotify artist,
+    then deletes the newer duplicates
+    """
+    kept = "SELECT MIN(id) FROM bands GROUP BY spotify_artist_id"
+    duplicates = f"SELECT id FROM bands WHERE id NOT IN ({kept})"
+    for table in db.metadata.sorted_tables:
+        for fk in table.foreign_keys:
+            if fk.column.table.name != "bands":
+                continue
+            column = fk.parent.name
+            db.session.execute(
+                text(
+                    f"UPDATE {table.name} SET {column} = ("
+                    "SELECT MIN(kept.id) FROM bands kept JOIN bands duplicate "
+                    "ON kept.spotify_artist_id = duplicate.spotify_artist_id "
+                    f"WHERE duplicate.id = {table.name}.{column}"
+                    f") WHERE {column} IN ({duplicates})"
+                )
+            )
+    db.session.execute(text(f"DELETE FROM bands WHERE id NOT IN ({kept})"))
+
+
+def unique_favorites():
+    """
+    - One band per Spotify artist and one favorite per user and band, so
+      favorites are added with INSERT ... ON CONFLICT DO NOTHING
+    - Duplicate bands are merged into the oldest one and duplicate favorites
+      dropped before the constraints are added
+    """
+    changed = False
+    if not has_unique("bands", ["spotify_artist_id"]):
+        merge_duplicate_bands()
+        add_unique("bands", "bands_spotify_artist_id_key", ["spotify_artist_id"])
+        changed = True
+    if not has_unique("favorites", ["user_id", "band_id"]):
+        db.session.execute(
+            text(
+                "DELETE FROM favorites WHERE id NOT IN "
+                "(SELECT MIN(id) FROM favorites GROUP BY user_id, band_id)"
+            )
+        )
+        add_unique("favorites", "favorites_user_id_band_id_key", ["user_id", "band_id"])
+        changed = True
+    return changed
+
+
+def auto_playlists():
+    """
+    Users' opt in to playlists of new setlists by their favorite bands
+    """
+    return add_column("users", "auto_playlists", "BOOLEAN NOT NULL DEFAULT false")
+
+
+def playlist_copies():
+    """
+    - Users' own edited copies of shared playlists and what they were copied
+      from
+    - The version cached song lists are keyed on
+    """
+    return any(
+        [
+            add_column("playlists", "owner_id", "INTEGER REFERENCES users (id)"),
+            add_column(
+                "playlists", "forked_from_id", "INTEGER REFERENCES playlists (id)"
+            ),
+            add_index("playlists", "ix_playlists_forked_from_id", ["forked_from_id"]),
+            add_column("playlists", "version", "INTEGER NOT NULL DEFAULT 1"),
+        ]
+    )
+
+
+def spotify_copies():
+    """
+    - Saves made before playlists were shared each wrote their own playlist
+      to Spotify, their Spotify_Copy is backfilled from the user's playlists
+      so saving again returns it rather than writing another
+    - Saves that never got a Spotify playlist get none, saving again writes it
+    """
+    result = db.session.execute(
+        text(
+            "INSERT INTO spotify_copies (playlist_id, user_id, status, "
+            "spotify_playlist_id, spotify_playlist_url, attempts, created_at, "
+            "updated_at) "
+            "SELECT saved.playlist_id, saved.user_id, 'done', "
+            "MIN(playlists.spotify_playlist_id), "
+            "MIN(playlists.spotify_playlist_url), 0, CURRENT_TIMESTAMP, "
+            "CURRENT_TIMESTAMP "
+            "FROM users_playlists saved "
+            "JOIN playlists ON playlists.id = saved.playlist_id "
+            "WHERE playlists.spotify_playlist_id NOT IN ('pending', 'None Yet') "
+            "AND NOT EXISTS (SELECT 1 FROM spotify_copies existing "
+            "WHERE existing.playlist_id = saved.playlist_id "
+            "AND existing.user_id = saved.user_id) "
+            "GROUP BY saved.playlist_id, saved.user_id"
+        )
+    )
+    return result.rowcount > 0
+
+
+# In the order they were added, each one is safe to run again
+MIGRATIONS = (
+    band_stats,
+    song_catalog,
+    unique_favorites,
+    auto_playlists,
+    playlist_copies,
+    spotify_copies,
+)
+
+
+def migrate():
+    """
+    - Brings a database made by an older version up to the models: creates
+      the missing tables, then runs each migration, committing after each
+    - Changes that are already there are skipped, so it's safe to run on
+      every release and on a fresh database
+    - Returns the names of the migrations that changed something
+    """
+    db.create_all()
+    db.session.commit()
+    applied = []
+    for migration in MIGRATIONS:
+        try:
+            changed = migration()
+        except Exception:
+            db.session.rollback()
+            raise
+        db.session.commit()
+        if changed:
+            applied.append(migration.__name__)
+    return applied
+
+
+def main(argv):
+    """
+    - migrate.py: brings the database's tables up to the models
+    """
+    if argv:
+        print(main.__doc__, file=sys.stderr)
+        return 1
+
+    from app import app
+
+    with app.app_context():
+        applied = migrate()
+    print("Applied " + (", ".join(applied) or "nothing, already up to date"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,10 +1,45 @@
+import threading
+from datetime import datetime
 from math import floor
 
-from flask_bcrypt import Bcrypt
+from flask import _app_ctx_stack
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql, sqlite
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import metrics
+import passwords
+from dbpool import (
+    install_statement_timeout,
+    pool_metrics,
+    replica_pool_metrics,
+)
+from routing import REPLICA_BIND, RoutingSession, remember_write
+
+
+def session_scope():
+    """
+    - Scopes database sessions to the Flask app context instead of the thread
+    - Async views run in their own thread, this keeps them on the request's
+      session so it's still cleaned up at the end of the request
+    - Outside an app context sessions are scoped to the thread
+    """
+    ctx = _app_ctx_stack.top
+    if ctx is None:
+        return threading.get_ident()
+    return id(ctx)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with sessions that can read from a replica
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy(session_options={"scopefunc": session_scope})
 
 
 class Favorite(db.Model):
@@ -20,6 +55,8 @@ class Favorite(db.Model):
 
     band_id = db.Column(db.Integer, db.ForeignKey("bands.id"))
 
+    __table_args__ = (db.UniqueConstraint("user_id", "band_id"),)
+
     def __repr__(self):
         """
         A more readable representation of the instance
@@ -70,6 +107,9 @@ class User(db.Model):
 
     spotify_user_id = db.Column(db.Text, default=None)
 
+    # Playlists of new setlists by favorited bands are saved to their Spotify
+    auto_playlists = db.Column(db.Boolean, default=False, nullable=False)
+
     favorites = db.relationship("Band", secondary="favorites")
 
     playlists = db.relationship(
@@ -87,11 +127,10 @@ class User(db.Model):
     ):
         """
         - Sign up user
-        - Hash password & secret question
+        - Hash password & secret answer together in one trip to the hashing pool
         - Add user to database
         """
-        hashed_pwd = bcrypt.generate_password_hash(password).decode("UTF-8")
-        hashed_answer = bcrypt.generate_password_hash(secret_answer).decode("UTF-8")
+        hashed_pwd, hashed_answer = passwords.hash_passwords(password, secret_answer)
 
         user = cls(
             username=username,
@@ -109,6 +148,8 @@ class User(db.Model):
         """
         - Find user with username and password
         - If user
+            - Rehash the password if it was hashed with an old scheme or cost
+              (caller commits)
             - Return user
         - If not user
             - Return False
@@ -116,8 +157,11 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.verify_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
+                    db.session.add(user)
                 return user
         return False
 
@@ -126,6 +170,8 @@ class User(db.Model):
         """
         - Find user with username
         - If answer
+            - Rehash the answer if it was hashed with an old scheme or cost
+              (caller commits)
             - Return True
         - If not answer
             - Return False
@@ -133,8 +179,11 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_answer = bcrypt.check_password_hash(user.secret_answer, answer)
+            is_answer = passwords.verify_password(user.secret_answer, answer)
             if is_answer:
+                if passwords.needs_rehash(user.secret_answer):
+                    user.secret_answer = passwords.hash_password(answer)
+                    db.session.add(user)
                 return True
         return False
 
@@ -144,7 +193,7 @@ class User(db.Model):
         - Hash the given password
         - Return the hashed password
         """
-        return bcrypt.generate_password_hash(password).decode("UTF-8")
+        return passwords.hash_password(password)
 
     def __repr__(self):
         """
@@ -162,12 +211,22 @@ class Playlist(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
 
+    # Only set on playlists saved before they were shared, migrate.py copies
+    # them into Spotify_Copy, each user's Spotify playlist now is one
     spotify_playlist_id = db.Column(db.Text, default="pending", nullable=False)
 
     spotify_playlist_url = db.Column(db.Text, default="pending", nullable=False)
 
     setlistfm_setlist_id = db.Column(db.Text, nullable=False)
 
+    # None for the playlist shared by everyone who saves the setlist, the user
+    # for their own edited copy of it
+    owner_id = db.Column(db.Integer, db.ForeignKey("users.id"), default=None)
+
+    forked_from_id = db.Column(
+        db.Integer, db.ForeignKey("playlists.id"), default=None, index=True
+    )
+
     name = db.Column(db.Text, nullable=False)
 
     description = db.Column(db.Text, nullable=False)
@@ -184,12 +243,23 @@ class Playlist(db.Model):
 
     duration = db.Column(db.Text, default=None)
 
+    # Bumped whenever the songs change, cached song lists are keyed on it
+    version = db.Column(db.Integer, default=1, nullable=False)
+
     band_id = db.Column(db.Integer, db.ForeignKey("bands.id"))
 
     songs = db.relationship("Song", secondary="playlists_songs", backref="playlists")
 
     band = db.relationship("Band")
 
+    @classmethod
+    def shared(cls):
+        """
+        Returns a query of the shared playlists, leaving out users' edited
+        copies
+        """
+        return cls.query.filter(cls.owner_id.is_(None))
+
     def add_songs(self, songs):
         """
         Add a list of songs to the playlist object (not saved to the db)
@@ -250,14 +320,21 @@ class Band(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
 
-    spotify_artist_id = db.Column(db.Text, nullable=False)
+    spotify_artist_id = db.Column(db.Text, nullable=False, unique=True)
 
+    # Empty until the band has been found on Setlist.fm
     setlistfm_artist_id = db.Column(db.Text, nullable=False)
 
     name = db.Column(db.Text, nullable=False)
 
     photo = db.Column(db.Text)
 
+    stats_setlist_count = db.Column(db.Integer, default=0, nullable=False)
+
+    stats_song_total = db.Column(db.Integer, default=0, nullable=False)
+
+    catalog_synced_at = db.Column(db.DateTime, default=None)
+
     @classmethod
     def bit_prep_band_name(cls, name):
         """
@@ -302,6 +379,14 @@ class Song(db.Model):
 
     band_id = db.Column(db.Integer, db.ForeignKey("bands.id"))
 
+    normalized_name = db.Column(db.Text, default=None)
+
+    album_id = db.Column(db.Integer, db.ForeignKey("albums.id"), default=None)
+
+    __table_args__ = (
+        db.Index("ix_songs_band_id_normalized_name", "band_id", "normalized_name"),
+    )
+
     def __repr__(self):
         """
         A more readable representation of the instance
@@ -309,9 +394,282 @@ class Song(db.Model):
         return f"<Song id={self.id} name={self.name} duration={self.duration} band_id={self.band_id}>"
 
 
+class Album(db.Model):
+    """
+    Album from a band's Spotify catalog
+    """
+
+    __tablename__ = "albums"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    spotify_album_id = db.Column(db.Text, nullable=False, unique=True)
+
+    band_id = db.Column(db.Integer, db.ForeignKey("bands.id"), index=True)
+
+    name = db.Column(db.Text, nullable=False)
+
+    album_type = db.Column(db.Text, default=None)
+
+    synced_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        """
+        A more readable representation of the instance
+        """
+        return f"<Album id={self.id} name={self.name} band_id={self.band_id}>"
+
+
+class Setlist(db.Model):
+    """
+    Cached Setlist.fm setlist
+    """
+
+    __tablename__ = "setlists"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    setlistfm_setlist_id = db.Column(db.Text, nullable=False, unique=True)
+
+    band_id = db.Column(db.Integer, db.ForeignKey("bands.id"), index=True)
+
+    event_date = db.Column(db.Text, default=None)
+
+    data = db.Column(db.Text, nullable=False)
+
+    counted = db.Column(db.Boolean, default=False, nullable=False)
+
+    band = db.relationship("Band")
+
+    def __repr__(self):
+        """
+        A more readable representation of the instance
+        """
+        return f"<Setlist id={self.id} setlistfm_setlist_id={self.setlistfm_setlist_id} band_id={self.band_id}>"
+
+
+class Song_Stat(db.Model):
+    """
+    Play statistics for a song across a band's cached setlists
+    """
+
+    __tablename__ = "song_stats"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    band_id = db.Column(db.Integer, db.ForeignKey("bands.id"), index=True)
+
+    name = db.Column(db.Text, nullable=False)
+
+    plays = db.Column(db.Integer, default=0, nullable=False)
+
+    position_total = db.Column(db.Float, default=0, nullable=False)
+
+    openers = db.Column(db.Integer, default=0, nullable=False)
+
+    closers = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (db.UniqueConstraint("band_id", "name"),)
+
+    def __repr__(self):
+        """
+        A more readable representation of the instance
+        """
+        return f"<Song_Stat id={self.id} name={self.name} plays={self.plays} band_id={self.band_id}>"
+
+
+class Spotify_Copy(db.Model):
+    """
+    A playlist saved to a user's Spotify, queued until it's been written
+    """
+
+    __tablename__ = "spotify_copies"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    playlist_id = db.Column(db.Integer, db.ForeignKey("playlists.id"), index=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
+
+    # pending, done or failed
+    status = db.Column(db.Text, default="pending", nullable=False)
+
+    spotify_playlist_id = db.Column(db.Text, default=None)
+
+    spotify_playlist_url = db.Column(db.Text, default=None)
+
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+
+    error = db.Column(db.Text, default=None)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    playlist = db.relationship("Playlist")
+
+    user = db.relationship("User")
+
+    __table_args__ = (db.UniqueConstraint("playlist_id", "user_id"),)
+
+    def __repr__(self):
+        """
+        A more readable representation of the instance
+        """
+        return f"<Spotify_Copy id={self.id} playlist_id={self.playlist_id} user_id={self.user_id} status={self.status}>"
+
+
+class Event(db.Model):
+    """
+    Upcoming Bandsintown event of a favorited band, refreshed by the shows sweep
+    """
+
+    __tablename__ = "events"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    bandsintown_event_id = db.Column(db.Text, nullable=False)
+
+    band_id = db.Column(db.Integer, db.ForeignKey("bands.id"), index=True)
+
+    # The venue's local time, as Bandsintown gives it
+    starts_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    venue_name = db.Column(db.Text, nullable=False)
+
+    venue_location = db.Column(db.Text, default=None)
+
+    url = db.Column(db.Text, default=None)
+
+    __table_args__ = (db.UniqueConstraint("band_id", "bandsintown_event_id"),)
+
+    def __repr__(self):
+        """
+        A more readable representation of the instance
+        """
+        return f"<Event id={self.id} band_id={self.band_id} starts_at={self.starts_at}>"
+
+
+class User_Upcoming(db.Model):
+    """
+    A user's precomputed "your bands playing soon" list for the home page
+    """
+
+    __tablename__ = "users_upcoming"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+
+    # JSON list of shows, soonest first
+    data = db.Column(db.Text, nullable=False)
+
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        """
+        A more readable representation of the instance
+        """
+        return f"<User_Upcoming user_id={self.user_id} computed_at={self.computed_at}>"
+
+
+class Import_Job(db.Model):
+    """
+    Import of a user's followed Spotify artists as favorites, and its progress
+    """
+
+    __tablename__ = "import_jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
+
+    # queued, running, done or failed
+    status = db.Column(db.Text, default="queued", nullable=False)
+
+    # Artists the user follows, known once the first page is fetched
+    total = db.Column(db.Integer, default=None)
+
+    imported = db.Column(db.Integer, default=0, nullable=False)
+
+    added = db.Column(db.Integer, default=0, nullable=False)
+
+    resolved = db.Column(db.Integer, default=0, nullable=False)
+
+    error = db.Column(db.Text, default=None)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def serialize(self):
+        """
+        The job's progress as a dict
+        """
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "imported": self.imported,
+            "added": self.added,
+            "resolved": self.resolved,
+            "error": self.error,
+        }
+
+    def __repr__(self):
+        """
+        A more readable representation of the instance
+        """
+        return f"<Import_Job id={self.id} user_id={self.user_id} status={self.status}>"
+
+
+def insert_ignoring_conflicts(model, rows):
+    """
+    INSERT ... ON CONFLICT DO NOTHING the rows (dicts) in one statement, on
+    PostgreSQL or SQLite
+    """
+    if not rows:
+        return
+    dialect = postgresql if db.engine.dialect.name == "postgresql" else sqlite
+    db.session.execute(dialect.insert(model.__table__).on_conflict_do_nothing(), rows)
+
+
+def insert_adding_on_conflict(model, rows, index_elements, columns):
+    """
+    INSERT ... ON CONFLICT DO UPDATE the rows (dicts) in one statement, rows
+    already stored get the new rows' columns added to theirs, on PostgreSQL
+    or SQLite
+    """
+    if not rows:
+        return
+    dialect = postgresql if db.engine.dialect.name == "postgresql" else sqlite
+    insert = dialect.insert(model.__table__)
+    table = model.__table__
+    db.session.execute(
+        insert.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={
+                column: table.c[column] + insert.excluded[column] for column in columns
+            },
+        ),
+        rows,
+    )
+
+
 def connect_db(app):
     """
     Connect database to Flask
     """
     db.app = app
     db.init_app(app)
+
+    engine = db.get_engine(app)
+    install_statement_timeout(engine)
+    pool_metrics.install(engine)
+    metrics.install_engine(engine, "primary")
+
+    if REPLICA_BIND in (app.config.get("SQLALCHEMY_BINDS") or {}):
+        replica = db.get_engine(app, bind=REPLICA_BIND)
+        install_statement_timeout(replica)
+        replica_pool_metrics.install(replica)
+        metrics.install_engine(replica, REPLICA_BIND)
+
+    app.after_request(remember_write)
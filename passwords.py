@@ -0,0 +1,230 @@
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+import metrics
+
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+
+# "bcrypt" or "argon2", new hashes use it and old ones are rehashed on login
+SCHEME = os.environ.get("PASSWORD_HASHER", "bcrypt")
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+ARGON2_TIME_COST = int(os.environ.get("ARGON2_TIME_COST", 3))
+ARGON2_MEMORY_COST = int(os.environ.get("ARGON2_MEMORY_COST", 65536))
+ARGON2_PARALLELISM = int(os.environ.get("ARGON2_PARALLELISM", 1))
+# Hashing processes per worker, 0 hashes in the request thread
+WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+# Hashes a worker lets wait for a process before turning requests away
+MAX_WAITING = int(os.environ.get("PASSWORD_HASH_MAX_WAITING", 32))
+WAIT_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10))
+
+BCRYPT_COST = re.compile(r"^\$2[abxy]?\$(\d+)\$")
+
+if SCHEME not in ("bcrypt", "argon2"):
+    raise RuntimeError(f"Unknown PASSWORD_HASHER {SCHEME}")
+if SCHEME == "argon2" and argon2 is None:
+    raise RuntimeError("PASSWORD_HASHER=argon2 needs the argon2-cffi package")
+
+
+class HashingBusy(Exception):
+    """
+    Raised when too many hashes are already waiting for a process
+    """
+
+
+def argon2_hasher():
+    """
+    Returns an argon2 PasswordHasher with the configured costs
+    """
+    return argon2.PasswordHasher(
+        time_cost=ARGON2_TIME_COST,
+        memory_cost=ARGON2_MEMORY_COST,
+        parallelism=ARGON2_PARALLELISM,
+    )
+
+
+def make_hashes(*passwords):
+    """
+    Hashes passwords with the configured scheme, runs in the pool
+    """
+    if SCHEME == "argon2":
+        hasher = argon2_hasher()
+        return [hasher.hash(password) for password in passwords]
+    hashes = []
+    for password in passwords:
+        salt = bcrypt.gensalt(BCRYPT_ROUNDS)
+        hashes.append(bcrypt.hashpw(password.encode("UTF-8"), salt).decode("UTF-8"))
+    return hashes
+
+
+def check_hash(hashed, password):
+    """
+    Checks a password against a bcrypt or argon2 hash, runs in the pool
+    """
+    if hashed.startswith("$argon2"):
+        if argon2 is None:
+            return False
+        try:
+            return argon2.PasswordHasher().verify(hashed, password)
+        except argon2.exceptions.VerificationError:
+            return False
+        except argon2.exceptions.InvalidHash:
+            return False
+    try:
+        return bcrypt.checkpw(password.encode("UTF-8"), hashed.encode("UTF-8"))
+    except ValueError:
+        return False
+
+
+def needs_rehash(hashed):
+    """
+    True when a hash was made with another scheme or cost than the
+    configured one
+    """
+    if SCHEME == "argon2":
+        return not hashed.startswith("$argon2") or argon2_hasher().check_needs_rehash(
+            hashed
+        )
+    match = BCRYPT_COST.match(hashed)
+    return match is None or int(match.group(1)) != BCRYPT_ROUNDS
+
+
+class Hasher:
+    """
+    Runs password hashes in a process pool so they don't hold up the worker's
+    other requests, with a bounded number of hashes waiting for it
+    """
+
+    def __init__(self, workers=WORKERS, max_waiting=MAX_WAITING, timeout=WAIT_TIMEOUT):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max(workers, 1))
+        self.pool = None
+        self.pid = None
+        self.waiting = 0
+        self.running = 0
+
+    def executor(self):
+        """
+        - Returns this process's pool, pools don't survive gunicorn forking
+          workers so each worker starts its own on first use
+        - Processes are spawned rather than forked from the threaded worker
+        """
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                self.pid = os.getpid()
+            return self.pool
+
+    def run(self, kind, func, *args):
+        """
+        - Runs func in the pool once one of its processes is free
+        - Raises HashingBusy if max_waiting hashes are already queued, or no
+          process frees up within timeout
+        """
+        if self.workers <= 0:
+            return self.timed(kind, lambda: func(*args))
+
+        with self.lock:
+            if self.waiting >= self.max_waiting:
+                metrics.store.add("setplaylist_password_hash_rejected_total", {})
+                raise HashingBusy()
+            self.waiting += 1
+
+        started = time.perf_counter()
+        try:
+            acquired = self.slots.acquire(timeout=self.timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        metrics.store.observe(
+            "setplaylist_password_hash_wait_seconds",
+            {"kind": kind},
+            time.perf_counter() - started,
+        )
+        if not acquired:
+            metrics.store.add("setplaylist_password_hash_rejected_total", {})
+            raise HashingBusy()
+
+        try:
+            return self.timed(
+                kind, lambda: self.executor().submit(func, *args).result()
+            )
+        except BrokenProcessPool:
+            # A hashing process died, start a new pool for the next hash
+            with self.lock:
+                self.pool = None
+            raise
+        finally:
+            self.slots.release()
+
+    def timed(self, kind, call):
+        """
+        Runs call, recording how long the hash took
+        """
+        with self.lock:
+            self.running += 1
+        started = time.perf_counter()
+        try:
+            return call()
+        finally:
+            with self.lock:
+                self.running -= 1
+            metrics.store.observe(
+                "setplaylist_password_hash_seconds",
+                {"kind": kind, "scheme": SCHEME},
+                time.perf_counter() - started,
+            )
+
+    def snapshot(self):
+        """
+        Returns the worker's hashing queue as a dict
+        """
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "running": self.running,
+                "waiting": self.waiting,
+                "max_waiting": self.max_waiting,
+                "scheme": SCHEME,
+                "bcrypt_rounds": BCRYPT_ROUNDS,
+            }
+
+
+hasher = Hasher()
+
+
+def hash_password(password):
+    """
+    Returns the hash of a password
+    """
+    return hasher.run("hash", make_hashes, password)[0]
+
+
+def hash_passwords(*passwords):
+    """
+    Returns the hashes of several passwords, hashed together in one trip to
+    the pool
+    """
+    return hasher.run("hash", make_hashes, *passwords)
+
+
+def verify_password(hashed, password):
+    """
+    Returns True if the password matches the hash
+    """
+    return hasher.run("verify", check_hash, hashed, password)
@@ -0,0 +1,376 @@
+import contextvars
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from math import floor
+
+from flask import current_app
+
+from catalog import catalog_is_stale, refresh_catalog, resolve_local
+from matching import find_tracks, normalize_title
+from models import (
+    Playlist,
+    Playlist_Song,
+    Song,
+    Spotify_Copy,
+    User_Playlist,
+    db,
+    insert_ignoring_conflicts,
+)
+from upstream import REQUEST_CONCURRENCY
+
+# Most tracks Spotify adds to a playlist in one request
+SPOTIFY_ADD_LIMIT = 100
+
+
+def setlist_details(band, setlist):
+    """
+    Returns the Playlist columns describing a Setlist.fm setlist (dict)
+    """
+    venue_name = setlist["venue"]["name"]
+    city = setlist["venue"]["city"]
+    venue_loc = city["name"] + ", " + (city.get("state") or city.get("stateCode") or "")
+    tour_name = setlist.get("tour", {}).get("name", "N/A")
+    name = band.name + " @ " + venue_name
+    return {
+        "setlistfm_setlist_id": setlist["id"],
+        "name": name,
+        "description": (
+            name
+            + " in "
+            + venue_loc
+            + " on "
+            + setlist["eventDate"]
+            + ". Tour - "
+            + tour_name
+        ),
+        "tour_name": tour_name,
+        "venue_name": venue_name,
+        "event_date": setlist["eventDate"],
+        "venue_loc": venue_loc,
+    }
+
+
+def setlist_songs(setlist):
+    """
+    Returns the songs (dicts) of every set of a Setlist.fm setlist
+    """
+    return [song for set in setlist["sets"]["set"] for song in set["song"]]
+
+
+def map_in_context(fn, items, concurrency=REQUEST_CONCURRENCY):
+    """
+    Calls fn for every item on a thread pool, each call in a copy of the
+    caller's context so Spotify tokens and upstream priority carry over
+    """
+    with ThreadPoolExecutor(max(concurrency, 1)) as pool:
+        futures = [
+            pool.submit(contextvars.copy_context().run, fn, item) for item in items
+        ]
+        return [future.result() for future in futures]
+
+
+def songs_for_tracks(band, tracks):
+    """
+    - Takes a list of Spotify tracks (dicts) for each song
+    - Reuses the Song rows tracks already have, adding the missing ones in
+      one flush
+    - Returns a list of Songs for each song
+    """
+    keys = {
+        (track["id"], track["name"], floor(track["duration_ms"] / 1000))
+        for song_tracks in tracks
+        for track in song_tracks
+    }
+    known = {
+        (song.spotify_song_id, song.name, song.duration): song
+        for song in Song.query.filter(
+            Song.spotify_song_id.in_([key[0] for key in keys])
+        )
+    }
+    for key in keys - set(known):
+        spotify_song_id, name, duration = key
+        known[key] = Song(
+            spotify_song_id=spotify_song_id,
+            name=name,
+            duration=duration,
+            band_id=band.id,
+            normalized_name=normalize_title(name),
+        )
+        db.session.add(known[key])
+    db.session.flush()
+
+    return [
+        [
+            known[(track["id"], track["name"], floor(track["duration_ms"] / 1000))]
+            for track in song_tracks
+        ]
+        for song_tracks in tracks
+    ]
+
+
+def resolve_songs(spotify, band, songs, concurrency=REQUEST_CONCURRENCY):
+    """
+    - Resolves Setlist.fm songs (dicts) against the band's catalog when it's
+      preloaded, searching Spotify concurrently for the rest
+    - Returns a list of Songs for each song, empty when it wasn't found
+    """
+    use_catalog = current_app.config.get("CATALOG_PRELOAD")
+    if use_catalog and catalog_is_stale(
+        band, current_app.config["CATALOG_MAX_AGE_HOURS"]
+    ):
+        refresh_catalog(spotify, band)
+
+    local = [resolve_local(band, song) if use_catalog else [] for song in songs]
+    searched = iter(
+        map_in_context(
+            lambda song: find_tracks(spotify, song, band.name),
+            [song for song, songs_db in zip(songs, local) if not songs_db],
+            concurrency,
+        )
+    )
+    tracks = [[] if songs_db else next(searched) for songs_db in local]
+
+    return [
+        songs_db or found
+        for songs_db, found in zip(local, songs_for_tracks(band, tracks))
+    ]
+
+
+def fill_playlist(spotify, band, playlist, songs, tracks=None):
+    """
+    - Resolves the songs (dicts) and adds them to the playlist in order with
+      one bulk insert, tracks (a Spotify track dict per song) skips resolving
+      songs already found on Spotify
+    - The playlist is only added to the session once its songs are resolved,
+      so a failed search never leaves an empty playlist behind
+    - Returns the names of the songs that weren't found, the caller commits
+    """
+    if tracks is None:
+        resolved = resolve_songs(spotify, band, songs)
+    else:
+        resolved = songs_for_tracks(band, [[track] for track in tracks])
+    songs_db = [song_db for songs_db in resolved for song_db in songs_db]
+
+    db.session.add(playlist)
+    db.session.flush()
+    db.session.bulk_insert_mappings(
+        Playlist_Song,
+        [{"playlist_id": playlist.id, "song_id": song.id} for song in songs_db],
+    )
+    playlist.length = len(songs_db)
+    playlist.duration = Playlist.format_duration(
+        sum(song.duration for song in songs_db)
+    )
+    return [song["name"] for song, songs_db in zip(songs, resolved) if not songs_db]
+
+
+def build_setlist_playlist(spotify, band, setlist):
+    """
+    - Builds the shared playlist of a Setlist.fm setlist (dict), its songs
+      resolved once for every user who saves it
+    - Returns the playlist, the caller commits
+    """
+    playlist = Playlist(
+        spotify_playlist_id="None Yet",
+        length=0,
+        band_id=band.id,
+        **setlist_details(band, setlist),
+    )
+    fill_playlist(spotify, band, playlist, setlist_songs(setlist))
+    return playlist
+
+
+def playlist_uris(playlist_id):
+    """
+    Returns the Spotify URIs of a playlist's songs in order
+    """
+    return [
+        "spotify:track:" + spotify_song_id
+        for (spotify_song_id,) in db.session.query(Song.spotify_song_id)
+        .join(Playlist_Song, Playlist_Song.song_id == Song.id)
+        .filter(Playlist_Song.playlist_id == playlist_id)
+        .order_by(Playlist_Song.id)
+    ]
+
+
+def write_to_spotify(spotify, spotify_user_id, name, description, uris):
+    """
+    - Creates a private playlist in the user's Spotify (with the token in use)
+      and adds the tracks SPOTIFY_ADD_LIMIT at a time
+    - Returns the Spotify playlist's (id, url)
+    """
+    res = json.loads(
+        spotify.playlist_create(
+            user_id=spotify_user_id, name=name, public=False, description=description
+        ).json()
+    )
+    for i in range(0, len(uris), SPOTIFY_ADD_LIMIT):
+        spotify.playlist_add(
+            playlist_id=res["id"], uris=uris[i : i + SPOTIFY_ADD_LIMIT]
+        )
+    return res["id"], res["external_urls"]["spotify"]
+
+
+def replace_on_spotify(spotify, spotify_playlist_id, uris):
+    """
+    Replaces the tracks of a playlist in the user's Spotify (with the token in
+    use), SPOTIFY_ADD_LIMIT at a time
+    """
+    spotify.playlist_replace(spotify_playlist_id, uris[:SPOTIFY_ADD_LIMIT])
+    for i in range(SPOTIFY_ADD_LIMIT, len(uris), SPOTIFY_ADD_LIMIT):
+        spotify.playlist_add(
+            playlist_id=spotify_playlist_id, uris=uris[i : i + SPOTIFY_ADD_LIMIT]
+        )
+
+
+def user_version(user_id, playlist):
+    """
+    Returns the user's edited copy of a shared playlist if they have one,
+    otherwise the playlist
+    """
+    if playlist.owner_id is not None:
+        return playlist
+    fork = Playlist.query.filter_by(
+        forked_from_id=playlist.id, owner_id=user_id
+    ).first()
+    return fork or playlist
+
+
+def add_user_playlist(user_id, playlist_id):
+    """
+    Adds the playlist to the user's playlists unless it's already there, the
+    caller commits
+    """
+    if not User_Playlist.query.filter_by(
+        user_id=user_id, playlist_id=playlist_id
+    ).first():
+        db.session.add(User_Playlist(user_id=user_id, playlist_id=playlist_id))
+
+
+def save_to_spotify(spotify, user, playlist):
+    """
+    - Saves the playlist, or the user's edited copy of it, to the user's
+      playlists and Spotify (with the token in use)
+    - The shared playlist isn't written to, each user's Spotify playlist is a
+      Spotify_Copy, saving it again returns the one already written
+    - A failed write marks the copy failed, so subscription delivery doesn't
+      retry it, and raises
+    - Returns the Spotify_Copy
+    """
+    playlist = user_version(user.id, playlist)
+    copy = Spotify_Copy.query.filter_by(
+        playlist_id=playlist.id, user_id=user.id
+    ).first()
+    if copy is not None and copy.status == "done":
+        return copy
+
+    if copy is None:
+        insert_ignoring_conflicts(
+            Spotify_Copy,
+            [
+                {
+                    "playlist_id": playlist.id,
+                    "user_id": user.id,
+                    "status": "pending",
+                    "attempts": 0,
+                    "created_at": datetime.utcnow(),
+                    "updated_at": datetime.utcnow(),
+                }
+            ],
+        )
+        add_user_playlist(user.id, playlist.id)
+        db.session.commit()
+        copy = Spotify_Copy.query.filter_by(
+            playlist_id=playlist.id, user_id=user.id
+        ).one()
+
+    copy.attempts += 1
+    copy.updated_at = datetime.utcnow()
+    try:
+        copy.spotify_playlist_id, copy.spotify_playlist_url = write_to_spotify(
+            spotify,
+            user.spotify_user_id,
+            playlist.name,
+            playlist.description,
+            playlist_uris(playlist.id),
+        )
+    except Exception as e:
+        copy.status = "failed"
+        copy.error = repr(e)[:500]
+        db.session.commit()
+        raise
+    copy.status = "done"
+    copy.error = None
+    db.session.commit()
+    return copy
+
+
+def edit_for_user(spotify, user, playlist, song_ids):
+    """
+    - Sets the songs of the user's version of a playlist to song_ids, which
+      may drop and reorder its songs but not add new ones
+    - Copy on write: the first edit of a shared playlist gives the user their
+      own copy, moving their saved playlist and Spotify playlist onto it, so
+      nobody else's playlist changes
+    - Updates their Spotify playlist if they've saved it (with the token in
+      use)
+    - Returns the edited playlist, raises ValueError for songs it doesn't
+      have
+    """
+    playlist = user_version(user.id, playlist)
+    if playlist.owner_id not in (None, user.id):
+        raise ValueError("Not the user's playlist")
+
+    current = {
+        song_id
+        for (song_id,) in db.session.query(Playlist_Song.song_id).filter_by(
+            playlist_id=playlist.id
+        )
+    }
+    if not set(song_ids) <= current:
+        raise ValueError("Songs can only be removed or reordered")
+
+    if playlist.owner_id is None:
+        fork = Playlist(
+            **{
+                column.name: getattr(playlist, column.name)
+                for column in Playlist.__table__.columns
+                if column.name != "id"
+            }
+        )
+        fork.owner_id = user.id
+        fork.forked_from_id = playlist.id
+        db.session.add(fork)
+        db.session.flush()
+        for model in (Spotify_Copy, User_Playlist):
+            model.query.filter_by(playlist_id=playlist.id, user_id=user.id).update(
+                {"playlist_id": fork.id}, synchronize_session=False
+            )
+        playlist = fork
+
+    Playlist_Song.query.filter_by(playlist_id=playlist.id).delete(
+        synchronize_session=False
+    )
+    db.session.bulk_insert_mappings(
+        Playlist_Song,
+        [{"playlist_id": playlist.id, "song_id": song_id} for song_id in song_ids],
+    )
+    durations = dict(
+        db.session.query(Song.id, Song.duration).filter(Song.id.in_(song_ids))
+    )
+    playlist.length = len(song_ids)
+    playlist.duration = Playlist.format_duration(
+        sum(durations[song_id] for song_id in song_ids)
+    )
+    playlist.version = Playlist.version + 1
+    db.session.commit()
+
+    copy = Spotify_Copy.query.filter_by(
+        playlist_id=playlist.id, user_id=user.id, status="done"
+    ).first()
+    if copy is not None:
+        replace_on_spotify(
+            spotify, copy.spotify_playlist_id, playlist_uris(playlist.id)
+        )
+    return playlist
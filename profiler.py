@@ -0,0 +1,398 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import g, request
+
+# Share of requests profiled, 0 turns profiling off
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+# Profiled requests slower than this are saved
+THRESHOLD = float(os.environ.get("PROFILE_THRESHOLD_MS", 2000)) / 1000
+INTERVAL = float(os.environ.get("PROFILE_INTERVAL_MS", 10)) / 1000
+MAX_KEEP = int(os.environ.get("PROFILE_MAX_KEEP", 500))
+MAX_DEPTH = 64
+MAX_EVENTS = 2000
+
+current_profile = ContextVar("current_profile", default=None)
+
+
+class Profile:
+    """
+    Stack samples and a SQL/upstream/template timeline for one request
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.threads = Counter()
+        self.stacks = Counter()
+        self.timeline = []
+
+    def attach(self, ident):
+        """
+        Starts sampling a thread for this request
+        """
+        with self.lock:
+            self.threads[ident] += 1
+
+    def detach(self, ident):
+        """
+        Stops sampling a thread once it's left every block it was attached in
+        """
+        with self.lock:
+            self.threads[ident] -= 1
+
+    def record(self, kind, name, started, seconds):
+        """
+        Adds an event to the timeline, started is a perf_counter value
+        """
+        with self.lock:
+            if len(self.timeline) < MAX_EVENTS:
+                self.timeline.append(
+                    {
+                        "kind": kind,
+                        "name": name,
+                        "start_ms": round((started - self.started) * 1000, 2),
+                        "ms": round(seconds * 1000, 2),
+                    }
+                )
+
+    def samples(self):
+        """
+        Returns the number of stack samples taken
+        """
+        with self.lock:
+            return sum(self.stacks.values())
+
+    def folded(self):
+        """
+        Returns the samples as folded stacks, the input format of flamegraph.pl,
+        speedscope and inferno
+        """
+        with self.lock:
+            stacks = list(self.stacks.items())
+        return "\n".join(f"{stack} {count}" for stack, count in stacks)
+
+
+def fold(frame):
+    """
+    Returns a frame's stack as "outermost;...;innermost"
+    """
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        names.append(f"{module}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler:
+    """
+    One background thread per worker that samples the stacks of threads
+    working on profiled requests
+    """
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.profiles = set()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self, profile):
+        """
+        Starts sampling for a profile, starting the thread on first use
+        """
+        with self.lock:
+            self.profiles.add(profile)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def stop(self, profile):
+        """
+        Stops sampling for a profile
+        """
+        with self.lock:
+            self.profiles.discard(profile)
+
+    def run(self):
+        """
+        - Samples every interval while any request is being profiled
+        - Sleeps until woken when nothing is
+        """
+        while True:
+            with self.lock:
+                profiles = list(self.profiles)
+            if not profiles:
+                self.wake.clear()
+                self.wake.wait()
+                continue
+
+            frames = sys._current_frames()
+            for profile in profiles:
+                with profile.lock:
+                    idents = [ident for ident, n in profile.threads.items() if n]
+                stacks = [fold(frames[i]) for i in idents if i in frames]
+                with profile.lock:
+                    profile.stacks.update(stacks)
+            del frames
+            time.sleep(self.interval)
+
+
+sampler = Sampler()
+
+
+@contextmanager
+def track():
+    """
+    Samples the current thread while inside the block if it's working on a
+    profiled request
+    """
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+
+    ident = threading.get_ident()
+    profile.attach(ident)
+    try:
+        yield
+    finally:
+        profile.detach(ident)
+
+
+def record(kind, name, started, seconds):
+    """
+    Adds an event to the current request's timeline if it's being profiled
+    """
+    profile = current_profile.get()
+    if profile is not None:
+        profile.record(kind, name, started, seconds)
+
+
+class ProfileStore:
+    """
+    Saved profiles of slow requests, in a SQLite file shared by every worker
+    """
+
+    def __init__(self, path, max_keep=MAX_KEEP):
+        self.path = path
+        self.max_keep = max_keep
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        Returns this thread's connection, creating the table on first use
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS profiles "
+                "(id INTEGER PRIMARY KEY, created REAL NOT NULL, "
+                "endpoint TEXT, method TEXT NOT NULL, path TEXT NOT NULL, "
+                "params TEXT NOT NULL, seconds REAL NOT NULL, "
+                "samples INTEGER NOT NULL, folded TEXT NOT NULL, "
+                "timeline TEXT NOT NULL)"
+            )
+            self.local.conn = conn
+        return conn
+
+    def save(self, profile, endpoint, method, path, params, seconds):
+        """
+        Saves a profile, dropping the oldest past max_keep
+        """
+        conn = self.connection()
+        cur = conn.execute(
+            "INSERT INTO profiles (created, endpoint, method, path, params, "
+            "seconds, samples, folded, timeline) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                time.time(),
+                endpoint,
+                method,
+                path,
+                json.dumps(params),
+                seconds,
+                profile.samples(),
+                profile.folded(),
+                json.dumps(profile.timeline),
+            ),
+        )
+        conn.execute(
+            "DELETE FROM profiles WHERE id <= ?", (cur.lastrowid - self.max_keep,)
+        )
+        return cur.lastrowid
+
+    def list(self, limit=50):
+        """
+        Returns the newest profiles' summaries as dicts
+        """
+        rows = self.connection().execute(
+            "SELECT id, created, endpoint, method, path, params, seconds, samples "
+            "FROM profiles ORDER BY id DESC LIMIT ?",
+            (limit,),
+        )
+        keys = ["id", "created", "endpoint", "method", "path", "params"]
+        keys += ["seconds", "samples"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def get(self, profile_id):
+        """
+        Returns a saved profile as a dict, or None
+        """
+        row = (
+            self.connection()
+            .execute(
+                "SELECT id, created, endpoint, method, path, params, seconds, "
+                "samples, folded, timeline FROM profiles WHERE id = ?",
+                (profile_id,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        keys = ["id", "created", "endpoint", "method", "path", "params", "seconds"]
+        keys += ["samples", "folded", "timeline"]
+        result = dict(zip(keys, row))
+        result["params"] = json.loads(result["params"])
+        result["timeline"] = json.loads(result["timeline"])
+        return result
+
+
+store = ProfileStore(
+    os.environ.get(
+        "PROFILE_DB", os.path.join(tempfile.gettempdir(), "setplaylist-profiles.db")
+    )
+)
+
+
+def start_request():
+    """
+    before_request hook, profiles a SAMPLE_RATE share of requests
+    """
+    if SAMPLE_RATE <= 0 or random.random() >= SAMPLE_RATE:
+        return
+    profile = Profile()
+    profile.attach(threading.get_ident())
+    g.profile_token = current_profile.set(profile)
+    sampler.start(profile)
+
+
+def request_params():
+    """
+    - The request's route params and the names of its query args
+    - Arg values are left out, they can be OAuth codes, state or search terms
+      that don't belong in a file kept on disk
+    """
+    return {"view_args": request.view_args or {}, "args": sorted(request.args)}
+
+
+def end_request(error):
+    """
+    teardown_request hook, saves the profile if the request was slow
+    """
+    token = g.pop("profile_token", None)
+    if token is None:
+        return
+    profile = current_profile.get()
+    profile.detach(threading.get_ident())
+    current_profile.reset(token)
+    sampler.stop(profile)
+
+    seconds = time.perf_counter() - profile.started
+    if seconds < THRESHOLD:
+        return
+    store.save(
+        profile,
+        request.endpoint,
+        request.method,
+        request.path,
+        request_params(),
+        seconds,
+    )
+
+
+def install_app(app):
+    """
+    - Profiles a share of the app's requests, saving the slow ones
+    - Async views run in their own thread, that thread is sampled instead of
+      the request thread waiting on it
+    """
+    app.before_request(start_request)
+    app.teardown_request(end_request)
+
+    ensure_sync = app.ensure_sync
+
+    def tracked_ensure_sync(func):
+        if not asyncio.iscoroutinefunction(func):
+            return ensure_sync(func)
+
+        @wraps(func)
+        async def tracked(*args, **kwargs):
+            with track():
+                return await func(*args, **kwargs)
+
+        run_view = ensure_sync(tracked)
+
+        @wraps(func)
+        def waiting(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is None:
+                return run_view(*args, **kwargs)
+            ident = threading.get_ident()
+            profile.detach(ident)
+            try:
+                return run_view(*args, **kwargs)
+            finally:
+                profile.attach(ident)
+
+        return waiting
+
+    app.ensure_sync = tracked_ensure_sync
+
+
+def main(argv):
+    """
+    - profiler.py list: the newest saved profiles
+    - profiler.py folded <id>: a profile's folded stacks for a flame graph
+    - profiler.py timeline <id>: a profile's SQL/upstream/template timeline
+    """
+    if len(argv) >= 1 and argv[0] == "list":
+        for row in store.list():
+            print(
+                f"{row['id']:>6}  {row['seconds']:8.2f}s  {row['samples']:>6} samples  "
+                f"{row['method']} {row['path']}"
+            )
+        return 0
+
+    if len(argv) == 2 and argv[0] in ("folded", "timeline"):
+        profile = store.get(int(argv[1]))
+        if profile is None:
+            print(f"No profile {argv[1]}", file=sys.stderr)
+            return 1
+        if argv[0] == "folded":
+            print(profile["folded"])
+        else:
+            print(json.dumps(profile["timeline"], indent=2))
+        return 0
+
+    print(main.__doc__, file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
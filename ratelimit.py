@@ -0,0 +1,169 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import metrics
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# api: (tokens added per second, bucket size)
+BUDGETS = {
+    "spotify": (
+        float(os.environ.get("SPOTIFY_RATE_LIMIT", 10)),
+        int(os.environ.get("SPOTIFY_RATE_BURST", 20)),
+    ),
+    "setlistfm": (
+        float(os.environ.get("SETLIST_FM_RATE_LIMIT", 2)),
+        int(os.environ.get("SETLIST_FM_RATE_BURST", 2)),
+    ),
+    "bandsintown": (
+        float(os.environ.get("BANDSINTOWN_RATE_LIMIT", 5)),
+        int(os.environ.get("BANDSINTOWN_RATE_BURST", 10)),
+    ),
+}
+
+# Share of each bucket only interactive requests may use
+BACKGROUND_RESERVE = 0.5
+
+DEADLINES = {INTERACTIVE: 10.0, BACKGROUND: 120.0}
+
+current_priority = ContextVar("current_priority", default=INTERACTIVE)
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a token can't be acquired before the deadline
+    """
+
+    def __init__(self, api):
+        super().__init__(f"Rate limit for {api} exceeded")
+        self.api = api
+
+
+@contextmanager
+def background():
+    """
+    Marks upstream calls made inside the block as background work
+    """
+    token = current_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class Governor:
+    """
+    Token buckets shared by every worker process through a SQLite file
+    """
+
+    def __init__(self, path, budgets):
+        self.path = path
+        self.budgets = budgets
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        Returns this thread's connection, creating the tables on first use
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(api TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self.local.conn = conn
+        return conn
+
+    def _take(self, api, priority):
+        """
+        - Refills the bucket and takes a token if one is available
+        - Background requests can't dip into the interactive reserve
+        - Returns 0 if a token was taken, otherwise the seconds to wait
+        """
+        rate, size = self.budgets[api]
+        floor = size * BACKGROUND_RESERVE if priority == BACKGROUND else 0
+        conn = self.connection()
+        now = time.time()
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE api = ?", (api,)
+            ).fetchone()
+            tokens = size if row is None else min(size, row[0] + (now - row[1]) * rate)
+
+            if tokens - 1 >= floor:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (floor + 1 - tokens) / rate
+
+            conn.execute(
+                "INSERT INTO buckets (api, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (api) DO UPDATE "
+                "SET tokens = excluded.tokens, updated = excluded.updated",
+                (api, tokens, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def acquire(self, api, priority=None, deadline=None):
+        """
+        - Waits for a token from the api's bucket
+        - Raises RateLimitExceeded if none is free before the deadline
+        """
+        priority = priority or current_priority.get()
+        if deadline is None:
+            deadline = DEADLINES[priority]
+        started = time.time()
+        give_up = started + deadline
+        throttled = False
+
+        while True:
+            wait = self._take(api, priority)
+            if wait == 0:
+                break
+
+            throttled = True
+            if time.time() + wait > give_up:
+                self.record(api, priority, "rejected")
+                raise RateLimitExceeded(api)
+            time.sleep(wait)
+
+        self.record(api, priority, "acquired")
+        if throttled:
+            self.record(api, priority, "throttled")
+            metrics.store.observe(
+                "setplaylist_rate_limit_wait_seconds",
+                {"api": api, "priority": priority},
+                time.time() - started,
+            )
+
+    def record(self, api, priority, result):
+        """
+        Counts an acquire in the metrics served at /metrics
+        """
+        metrics.store.add(
+            "setplaylist_rate_limit_total",
+            {"api": api, "priority": priority, "result": result},
+        )
+
+
+governor = Governor(
+    os.environ.get(
+        "RATE_LIMIT_DB", os.path.join(tempfile.gettempdir(), "setplaylist-rate.db")
+    ),
+    BUDGETS,
+)
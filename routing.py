@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession
+
+REPLICA_BIND = "replica"
+
+# Seconds a user's reads stay on the primary after they write, long enough to
+# cover replication lag
+STICKY_SECONDS = int(os.environ.get("DB_REPLICA_STICKY_SECONDS", 10))
+STICKY_KEY = "read_primary_until"
+
+
+def replica_reads(view):
+    """
+    - Marks a view as read-only so its queries can be served by the replica
+    - Only GET/HEAD requests are routed, anything else stays on the primary
+    """
+    if asyncio.iscoroutinefunction(view):
+
+        @wraps(view)
+        async def async_wrapper(*args, **kwargs):
+            g.replica_reads = True
+            return await view(*args, **kwargs)
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.replica_reads = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def mark_written():
+    """
+    - Pins the rest of the request, and the user's next few requests, to the
+      primary
+    - Inside shared_writes only the rest of the request is pinned
+    """
+    if not has_request_context():
+        return
+    if g.get("shared_writes"):
+        g.read_primary = True
+    else:
+        g.db_wrote = True
+
+
+@contextmanager
+def shared_writes():
+    """
+    - Writes inside the block fill shared caches (like a band's setlists) as a
+      side effect of a read, they aren't the user's writes
+    - They don't start the user's read-your-writes window, so they don't set
+      a cookie or make a cacheable page private
+    """
+    g.shared_writes = True
+    try:
+        yield
+    finally:
+        g.shared_writes = False
+
+
+def read_primary():
+    """
+    Sends the rest of the request's queries to the primary without starting the
+    user's read-your-writes window
+    """
+    if has_request_context():
+        g.read_primary = True
+
+
+def use_replica(app):
+    """
+    - True when the current request is a read-only view and the user hasn't
+      written recently
+    - Always False when no replica is configured
+    """
+    if REPLICA_BIND not in (app.config.get("SQLALCHEMY_BINDS") or {}):
+        return False
+    if not has_request_context() or request.method not in ("GET", "HEAD"):
+        return False
+    if not g.get("replica_reads") or g.get("db_wrote") or g.get("read_primary"):
+        return False
+    return session.get(STICKY_KEY, 0) < time.time()
+
+
+def remember_write(response):
+    """
+    after_request hook, starts the read-your-writes window when the request wrote
+    """
+    if g.get("db_wrote"):
+        session[STICKY_KEY] = time.time() + STICKY_SECONDS
+    return response
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends read-only views' queries to the replica and everything
+    else to the primary
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        """
+        - Flushes and INSERT/UPDATE/DELETE statements always go to the primary
+          and pin the request to it
+        - Other queries go to the replica when use_replica allows it
+        """
+        if self._flushing or getattr(clause, "is_dml", False):
+            mark_written()
+        elif use_replica(self.app):
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
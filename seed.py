@@ -1,4 +1,310 @@
-from app import app
-from models import db
+import argparse
+import os
+import random
+import sys
+import time
 
-db.create_all()
+from sqlalchemy import func
+
+from archive import copy_rows, reset_sequence
+from matching import normalize_title
+from models import (
+    Band,
+    Favorite,
+    Playlist,
+    Playlist_Song,
+    Song,
+    User,
+    User_Playlist,
+    db,
+)
+
+# Rows generated and loaded at a time, memory use is bounded by it
+BATCH_ROWS = int(os.environ.get("SEED_BATCH_ROWS", 20000))
+PASSWORD = "syntheticpassword"
+PHOTO = "/static/img/rocco-dipoppa-_uDj_lyPVpA-unsplash.jpg"
+
+WORDS = (
+    "night fire paper glass river ghost summer electric golden wild broken "
+    "silver heart echo violet static ocean neon hollow shadow midnight velvet "
+    "thunder crystal desert black blue red satellite garden"
+).split()
+CITIES = (
+    ("Seattle", "WA"),
+    ("Portland", "OR"),
+    ("Austin", "TX"),
+    ("Chicago", "IL"),
+    ("Brooklyn", "NY"),
+    ("Denver", "CO"),
+    ("Nashville", "TN"),
+    ("Oakland", "CA"),
+)
+
+
+def zipf_rank(rng, n, skew):
+    """
+    - Returns a rank from 1 to n, rank r drawn about as often as 1 / r**skew
+      so a few ranks (popular bands, setlists, songs) get most of the draws
+    - Inverts the continuous power law, so it needs no table of n weights
+    """
+    u = rng.random()
+    if abs(skew - 1) < 1e-9:
+        rank = n**u
+    else:
+        rank = ((n ** (1 - skew) - 1) * u + 1) ** (1 / (1 - skew))
+    return min(int(rank), n)
+
+
+def song_name(rng):
+    """
+    Returns a made up song title
+    """
+    return " ".join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 3)))
+
+
+class BatchLoader:
+    """
+    - Buffers generated rows (dicts) for a table and bulk loads them
+      BATCH_ROWS at a time, committing each batch
+    - Parents' buffered rows are loaded first, so rows referencing them never
+      go in before they do
+    """
+
+    def __init__(self, model, batch_rows=None, parents=()):
+        self.table = model.__table__
+        self.batch_rows = batch_rows or BATCH_ROWS
+        self.parents = parents
+        self.rows = []
+        self.count = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        for parent in self.parents:
+            parent.flush()
+        if not self.rows:
+            return
+        names = list(self.rows[0])
+        copy_rows(
+            self.table, names, [tuple(row[name] for name in names) for row in self.rows]
+        )
+        db.session.commit()
+        self.count += len(self.rows)
+        self.rows = []
+
+
+def next_id(model):
+    """
+    Returns the first id after the model's existing rows, generated rows get
+    explicit ids so nothing has to be read back
+    """
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def generate(
+    users=1000,
+    bands=200,
+    songs_per_band=40,
+    playlists=2000,
+    songs_per_playlist=18,
+    favorites_per_user=5,
+    saves_per_user=3,
+    skew=1.1,
+    seed=1,
+    batch_rows=None,
+):
+    """
+    - Streams a reproducible synthetic data set into the database, adding to
+      any rows already there
+    - Popularity is skewed: a few bands get most favorites and playlists, a
+      few playlists get most saves, and each band's hits open most setlists
+    - Rows are generated and loaded batch by batch with COPY, so memory
+      doesn't grow with the counts
+    - Returns a dict of the rows added per table
+    """
+    rng = random.Random(seed)
+    first = {model: next_id(model) for model in (User, Band, Song, Playlist)}
+    db.session.commit()
+    loaders = {model: BatchLoader(model, batch_rows) for model in (Band, User)}
+    loaders[Song] = BatchLoader(Song, batch_rows, [loaders[Band]])
+    loaders[Favorite] = BatchLoader(
+        Favorite, batch_rows, [loaders[User], loaders[Band]]
+    )
+    loaders[Playlist] = BatchLoader(Playlist, batch_rows, [loaders[Song]])
+    loaders[Playlist_Song] = BatchLoader(Playlist_Song, batch_rows, [loaders[Playlist]])
+    loaders[User_Playlist] = BatchLoader(
+        User_Playlist, batch_rows, [loaders[User], loaders[Playlist]]
+    )
+
+    def band_id(rank):
+        return first[Band] + rank - 1
+
+    def song_id(band_id, rank):
+        return first[Song] + (band_id - first[Band]) * songs_per_band + rank - 1
+
+    for n in range(bands):
+        id = first[Band] + n
+        loaders[Band].add(
+            {
+                "id": id,
+                "spotify_artist_id": f"synth{id:017d}",
+                "setlistfm_artist_id": f"synth-mbid-{id}",
+                "name": f"Synthetic Band {id}",
+                "photo": PHOTO,
+                "stats_setlist_count": 0,
+                "stats_song_total": 0,
+            }
+        )
+
+    for n in range(bands):
+        id = band_id(n + 1)
+        for rank in range(1, songs_per_band + 1):
+            name = song_name(rng)
+            duration = rng.randint(120, 420)
+            loaders[Song].add(
+                {
+                    "id": song_id(id, rank),
+                    "spotify_song_id": f"synth{id:08d}{rank:09d}",
+                    "name": name,
+                    "duration": duration,
+                    "band_id": id,
+                    "normalized_name": normalize_title(name),
+                }
+            )
+
+    password = User.hash_password(PASSWORD)
+    for n in range(users):
+        id = first[User] + n
+        loaders[User].add(
+            {
+                "id": id,
+                "username": f"synth{id}",
+                "password": password,
+                "email": f"synth{id}@example.com",
+                "secret_question": "Synthetic?",
+                "secret_answer": password,
+                "spotify_user_token": "synthetic-refresh-token",
+                "spotify_user_id": f"synthuser{id}",
+                "auto_playlists": rng.random() < 0.1,
+            }
+        )
+        favorites = {
+            band_id(zipf_rank(rng, bands, skew))
+            for _ in range(rng.randint(0, 2 * favorites_per_user))
+        }
+        for favorite in favorites:
+            loaders[Favorite].add({"user_id": id, "band_id": favorite})
+
+    for n in range(playlists):
+        id = first[Playlist] + n
+        band = band_id(zipf_rank(rng, bands, skew))
+        length = max(1, songs_per_playlist + rng.randint(-4, 4))
+        songs = dict.fromkeys(
+            song_id(band, zipf_rank(rng, songs_per_band, skew)) for _ in range(length)
+        )
+        city, state = rng.choice(CITIES)
+        day, month = rng.randint(1, 28), rng.randint(1, 12)
+        event_date = f"{day:02d}-{month:02d}-{rng.randint(2010, 2030)}"
+        name = f"Synthetic Band {band} @ The {city} Venue"
+        loaders[Playlist].add(
+            {
+                "id": id,
+                "spotify_playlist_id": "pending",
+                "spotify_playlist_url": "pending",
+                "setlistfm_setlist_id": f"synth-setlist-{id}",
+                "name": name,
+                "description": f"{name} in {city}, {state} on {event_date}. Tour - N/A",
+                "tour_name": "N/A",
+                "venue_name": f"The {city} Venue",
+                "event_date": event_date,
+                "venue_loc": f"{city}, {state}",
+                "length": len(songs),
+                "duration": Playlist.format_duration(len(songs) * 240),
+                "version": 1,
+                "band_id": band,
+            }
+        )
+        for song in songs:
+            loaders[Playlist_Song].add({"playlist_id": id, "song_id": song})
+
+    if playlists:
+        for n in range(users):
+            saved = {
+                first[Playlist] + zipf_rank(rng, playlists, skew) - 1
+                for _ in range(rng.randint(0, 2 * saves_per_user))
+            }
+            for playlist in saved:
+                loaders[User_Playlist].add(
+                    {"user_id": first[User] + n, "playlist_id": playlist}
+                )
+    for loader in loaders.values():
+        loader.flush()
+
+    for model in (User, Band, Song, Playlist):
+        reset_sequence(model.__table__)
+    db.session.commit()
+    return {model.__tablename__: loader.count for model, loader in loaders.items()}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Create the tables, optionally filled with synthetic data"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    synthetic = subparsers.add_parser(
+        "synthetic", help="stream a skewed synthetic data set into the database"
+    )
+    synthetic.add_argument("--users", type=int, default=1000)
+    synthetic.add_argument("--bands", type=int, default=200)
+    synthetic.add_argument("--songs-per-band", type=int, default=40)
+    synthetic.add_argument("--playlists", type=int, default=2000)
+    synthetic.add_argument("--songs-per-playlist", type=int, default=18)
+    synthetic.add_argument("--favorites-per-user", type=int, default=5)
+    synthetic.add_argument("--saves-per-user", type=int, default=3)
+    synthetic.add_argument(
+        "--skew", type=float, default=1.1, help="power law exponent of popularity"
+    )
+    synthetic.add_argument("--seed", type=int, default=1)
+    synthetic.add_argument("--batch-rows", type=int, default=BATCH_ROWS)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    """
+    - seed.py: creates the tables
+    - seed.py synthetic --users 1000000 --bands 50000 --playlists 2000000:
+      also streams a synthetic data set into them, see --help
+    """
+    opts = parse_args(argv)
+    from app import app
+
+    with app.app_context():
+        db.create_all()
+        if opts.command != "synthetic":
+            return 0
+
+        started = time.perf_counter()
+        counts = generate(
+            users=opts.users,
+            bands=opts.bands,
+            songs_per_band=opts.songs_per_band,
+            playlists=opts.playlists,
+            songs_per_playlist=opts.songs_per_playlist,
+            favorites_per_user=opts.favorites_per_user,
+            saves_per_user=opts.saves_per_user,
+            skew=opts.skew,
+            seed=opts.seed,
+            batch_rows=opts.batch_rows,
+        )
+    seconds = time.perf_counter() - started
+    rows = sum(counts.values())
+    print("Seeded " + ", ".join(f"{v} {k}" for k, v in counts.items()))
+    print(f"{rows} rows in {seconds:.1f}s ({rows / seconds:,.0f} rows/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
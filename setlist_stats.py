@@ -0,0 +1,181 @@
+import json
+from collections import Counter
+
+from models import Band, Setlist, Song_Stat, db, insert_adding_on_conflict
+
+PREDICTED_ID = "Predicted"
+
+
+def extract_songs(setlist):
+    """
+    - Takes a Setlist.fm setlist (dict)
+    - Returns the song names in play order, skipping tapes and repeats
+    """
+    songs = []
+    try:
+        sets = setlist["sets"]["set"]
+    except (KeyError, TypeError):
+        return songs
+
+    for set in sets:
+        for song in set.get("song", []):
+            name = song.get("name", "").strip()
+            if name == "" or song.get("tape") or name in songs:
+                continue
+            songs.append(name)
+
+    return songs
+
+
+def cache_setlists(band_db, setlists):
+    """
+    - Takes a band from the database and a list of Setlist.fm setlists
+    - Saves any setlists not already cached (not committed)
+    - Returns the newly cached Setlist objects
+    """
+    ids = [setlist["id"] for setlist in setlists]
+    cached = {
+        setlistfm_setlist_id
+        for (setlistfm_setlist_id,) in db.session.query(
+            Setlist.setlistfm_setlist_id
+        ).filter(Setlist.setlistfm_setlist_id.in_(ids))
+    }
+
+    new_setlists = []
+    for setlist in setlists:
+        if setlist["id"] in cached:
+            continue
+        cached.add(setlist["id"])
+        setlist_db = Setlist(
+            setlistfm_setlist_id=setlist["id"],
+            band_id=band_db.id,
+            event_date=setlist.get("eventDate"),
+            data=json.dumps(setlist),
+        )
+        db.session.add(setlist_db)
+        new_setlists.append(setlist_db)
+
+    return new_setlists
+
+
+def count_setlists(song_lists):
+    """
+    - Takes a list of song name lists, one per setlist
+    - Returns Counters of plays, relative position totals, openers and closers
+    """
+    plays = Counter()
+    positions = Counter()
+    openers = Counter()
+    closers = Counter()
+
+    for songs in song_lists:
+        if not songs:
+            continue
+        last = len(songs) - 1
+        plays.update(songs)
+        positions.update(
+            {song: (i / last if last else 0.0) for i, song in enumerate(songs)}
+        )
+        openers[songs[0]] += 1
+        closers[songs[-1]] += 1
+
+    return plays, positions, openers, closers
+
+
+def refresh_song_stats(band_db):
+    """
+    - Counts the band's cached setlists that haven't been counted yet
+    - Merges the counts into the band's stored song stats
+    - Only new setlists are scanned, history is never recounted
+    - Setlists are claimed before counting and stats are upserted, adding to
+      the stored counts in SQL, so concurrent requests never count a setlist
+      twice, lose an update or collide adding the same new song
+    - Returns the number of setlists counted
+    """
+    new_setlists = Setlist.query.filter_by(band_id=band_db.id, counted=False).all()
+    if not new_setlists:
+        return 0
+
+    ids = [setlist_db.id for setlist_db in new_setlists]
+    claimed = Setlist.query.filter(
+        Setlist.id.in_(ids), Setlist.counted.is_(False)
+    ).update({"counted": True}, synchronize_session=False)
+    if claimed != len(ids):
+        # Another request is counting them
+        db.session.rollback()
+        return 0
+
+    song_lists = [extract_songs(json.loads(s.data)) for s in new_setlists]
+    plays, positions, openers, closers = count_setlists(song_lists)
+
+    insert_adding_on_conflict(
+        Song_Stat,
+        [
+            {
+                "band_id": band_db.id,
+                "name": name,
+                "plays": count,
+                "position_total": positions[name],
+                "openers": openers[name],
+                "closers": closers[name],
+            }
+            for name, count in plays.items()
+        ],
+        ["band_id", "name"],
+        ["plays", "position_total", "openers", "closers"],
+    )
+
+    played = [songs for songs in song_lists if songs]
+    band_db.stats_setlist_count = Band.stats_setlist_count + len(played)
+    band_db.stats_song_total = Band.stats_song_total + sum(
+        len(songs) for songs in played
+    )
+    db.session.add(band_db)
+
+    db.session.commit()
+    return len(new_setlists)
+
+
+def predicted_setlist(band_db):
+    """
+    - Builds the most likely setlist from the band's stored song stats
+    - Length is the band's average setlist length
+    - Opener and closer are the songs most often played in those slots,
+      the rest are ordered by their average position
+    - Returns a list of song names
+    """
+    if not band_db.stats_setlist_count:
+        return []
+
+    length = round(band_db.stats_song_total / band_db.stats_setlist_count)
+    stats = (
+        Song_Stat.query.filter_by(band_id=band_db.id)
+        .order_by(Song_Stat.plays.desc(), Song_Stat.name)
+        .limit(length)
+        .all()
+    )
+    if not stats:
+        return []
+
+    opener = max(stats, key=lambda stat: stat.openers)
+    rest = [stat for stat in stats if stat is not opener]
+    closer = max(rest, key=lambda stat: stat.closers) if rest else None
+    middle = sorted(
+        (stat for stat in rest if stat is not closer),
+        key=lambda stat: stat.position_total / stat.plays,
+    )
+
+    ordered = [opener] + middle
+    if closer is not None:
+        ordered.append(closer)
+
+    return [stat.name for stat in ordered]
+
+
+def predicted_id(band_db):
+    """
+    - Returns the setlistfm_setlist_id of the band's predicted playlist
+    - It changes with the band's stats, so newly counted setlists give a new
+      prediction instead of the one built from older stats
+    """
+    return f"{PREDICTED_ID}:{band_db.stats_setlist_count}"
@@ -0,0 +1,224 @@
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import groupby, islice
+
+import metrics
+from models import Band, Event, Favorite, User_Upcoming, db
+from ratelimit import RateLimitExceeded, background
+from upstream import UpstreamUnavailable, bandsintown_get
+
+# Bands fetched and stored together, each batch is one transaction
+BATCH_SIZE = int(os.environ.get("SHOWS_SWEEP_BATCH", 50))
+# Bandsintown requests in flight during a sweep, the governor still paces them
+CONCURRENCY = int(os.environ.get("SHOWS_SWEEP_CONCURRENCY", 8))
+# Shows kept in each user's home page list
+HOME_LIMIT = int(os.environ.get("HOME_UPCOMING_SHOWS", 10))
+USERS_PER_COMMIT = 500
+
+
+def fetch_events(name):
+    """
+    - Returns the band's upcoming Bandsintown events
+    - None if Bandsintown can't be asked right now, the band's stored events
+      are kept until the next sweep
+    """
+    try:
+        with background():
+            events = bandsintown_get(
+                "/artists/" + Band.bit_prep_band_name(name) + "/events/"
+            )
+    except (UpstreamUnavailable, RateLimitExceeded):
+        return None
+    # Artists Bandsintown doesn't know get an error object
+    return events if isinstance(events, list) else []
+
+
+def event_row(band_id, show):
+    """
+    Returns the events row for a Bandsintown event, or None if it's missing
+    the details the home page shows
+    """
+    try:
+        return {
+            "bandsintown_event_id": str(show["id"]),
+            "band_id": band_id,
+            "starts_at": datetime.fromisoformat(show["datetime"][:19]),
+            "venue_name": show["venue"]["name"],
+            "venue_location": show["venue"].get("location"),
+            "url": show.get("url"),
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def store_events(results):
+    """
+    - Replaces the stored events of each band in results, [(band id, events)],
+      skipping bands that couldn't be fetched
+    - Returns the number of events stored, the caller commits
+    """
+    fetched = [band_id for band_id, events in results if events is not None]
+    if not fetched:
+        return 0
+
+    rows = {}
+    for band_id, events in results:
+        for show in events or []:
+            row = event_row(band_id, show)
+            if row is not None:
+                rows[(band_id, row["bandsintown_event_id"])] = row
+
+    Event.query.filter(Event.band_id.in_(fetched)).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(Event, list(rows.values()))
+    return len(rows)
+
+
+def show_display(band_name, spotify_artist_id, starts_at, venue, location, url):
+    """
+    Returns a show in a user's list
+    """
+    return {
+        "band": band_name,
+        "band_id": spotify_artist_id,
+        "date": starts_at.isoformat(),
+        "venue": venue,
+        "location": location,
+        "url": url,
+    }
+
+
+def rebuild_upcoming(now, user_ids=None):
+    """
+    - Recomputes the soonest HOME_LIMIT shows of the favorited bands of each
+      user, or just of user_ids, from the stored events in one query
+    - Users without any are left without a list
+    - Returns the number of lists saved
+    """
+    started = datetime.utcnow()
+    query = (
+        db.session.query(
+            Favorite.user_id,
+            Band.name,
+            Band.spotify_artist_id,
+            Event.starts_at,
+            Event.venue_name,
+            Event.venue_location,
+            Event.url,
+        )
+        .join(Event, Event.band_id == Favorite.band_id)
+        .join(Band, Band.id == Event.band_id)
+        .filter(Event.starts_at >= now)
+        .order_by(Favorite.user_id, Event.starts_at, Event.id)
+    )
+    if user_ids is not None:
+        query = query.filter(Favorite.user_id.in_(user_ids))
+
+    lists = []
+    for user_id, rows in groupby(query.yield_per(1000), key=lambda row: row[0]):
+        upcoming = [show_display(*row[1:]) for row in islice(rows, HOME_LIMIT)]
+        lists.append(
+            {"user_id": user_id, "data": json.dumps(upcoming), "computed_at": started}
+        )
+
+    for i in range(0, len(lists), USERS_PER_COMMIT):
+        chunk = lists[i : i + USERS_PER_COMMIT]
+        User_Upcoming.query.filter(
+            User_Upcoming.user_id.in_([row["user_id"] for row in chunk])
+        ).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(User_Upcoming, chunk)
+        db.session.commit()
+
+    stale = User_Upcoming.query.filter(User_Upcoming.computed_at < started)
+    if user_ids is not None:
+        stale = stale.filter(User_Upcoming.user_id.in_(user_ids))
+    stale.delete(synchronize_session=False)
+    db.session.commit()
+    return len(lists)
+
+
+def refresh_user(user_id):
+    """
+    Recomputes one user's list after their favorites change
+    """
+    rebuild_upcoming(datetime.utcnow(), [user_id])
+
+
+def user_upcoming(user_id, now=None):
+    """
+    Returns the user's precomputed list of shows that haven't happened yet
+    """
+    row = User_Upcoming.query.get(user_id)
+    if row is None:
+        return []
+    today = (now or datetime.utcnow()).isoformat()
+    return [show for show in json.loads(row.data) if show["date"] >= today]
+
+
+def sweep(now=None):
+    """
+    - Fetches the upcoming events of every favorited band once however many
+      users favorite it, BATCH_SIZE bands at a time with CONCURRENCY requests
+      in flight
+    - Stores each batch as it arrives, drops past events, then rebuilds every
+      user's list
+    - Returns the sweep's counts as a dict
+    """
+    now = now or datetime.utcnow()
+    bands = (
+        db.session.query(Band.id, Band.name)
+        .filter(Band.id.in_(db.session.query(Favorite.band_id)))
+        .order_by(Band.id)
+        .all()
+    )
+    counts = {"bands": len(bands), "failed": 0, "events": 0}
+
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        for i in range(0, len(bands), BATCH_SIZE):
+            batch = bands[i : i + BATCH_SIZE]
+            events = pool.map(fetch_events, [name for _, name in batch])
+            results = list(zip([band_id for band_id, _ in batch], events))
+            counts["events"] += store_events(results)
+            db.session.commit()
+
+            failed = sum(1 for _, events in results if events is None)
+            counts["failed"] += failed
+            metrics.store.add(
+                "setplaylist_shows_sweep_bands_total", {"result": "failed"}, failed
+            )
+            metrics.store.add(
+                "setplaylist_shows_sweep_bands_total",
+                {"result": "fetched"},
+                len(batch) - failed,
+            )
+
+    Event.query.filter(Event.starts_at < now).delete(synchronize_session=False)
+    db.session.commit()
+    counts["users"] = rebuild_upcoming(now)
+    return counts
+
+
+def main(argv):
+    """
+    - shows.py sweep: refreshes the favorited bands' upcoming shows and every
+      user's home page list, run it from a scheduler (e.g. hourly)
+    """
+    if argv == ["sweep"]:
+        from app import app
+
+        with app.app_context():
+            counts = sweep()
+        print(
+            f"Swept {counts['bands']} bands ({counts['failed']} failed), "
+            f"{counts['events']} events, {counts['users']} user lists"
+        )
+        return 0
+
+    print(main.__doc__, file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,302 @@
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+
+import metrics
+from favorites import PENDING
+from models import (
+    Band,
+    Favorite,
+    Playlist,
+    Spotify_Copy,
+    User,
+    db,
+    insert_ignoring_conflicts,
+)
+from playlists import (
+    add_user_playlist,
+    build_setlist_playlist,
+    map_in_context,
+    playlist_uris,
+    setlist_songs,
+    write_to_spotify,
+)
+from ratelimit import RateLimitExceeded, background
+from upstream import UpstreamUnavailable, setlistfm_get
+
+# Setlists of shows older than this aren't built, so a band's back catalog
+# isn't built when someone first favorites it
+MAX_AGE_DAYS = int(os.environ.get("AUTO_PLAYLIST_MAX_AGE_DAYS", 7))
+# Setlist.fm requests in flight while looking for new setlists
+CHECK_CONCURRENCY = int(os.environ.get("AUTO_PLAYLIST_CHECK_CONCURRENCY", 4))
+# Playlists written to Spotify per batch, and at once within a batch
+DELIVERY_BATCH = int(os.environ.get("AUTO_PLAYLIST_DELIVERY_BATCH", 25))
+DELIVERY_CONCURRENCY = int(os.environ.get("AUTO_PLAYLIST_DELIVERY_CONCURRENCY", 4))
+MAX_ATTEMPTS = int(os.environ.get("AUTO_PLAYLIST_MAX_ATTEMPTS", 3))
+
+log = logging.getLogger("setplaylist.subscriptions")
+
+
+def subscribers():
+    """
+    Returns a query of the users who want auto playlists and have connected
+    Spotify
+    """
+    return db.session.query(User.id).filter(
+        User.auto_playlists.is_(True),
+        User.spotify_user_token.isnot(None),
+        User.spotify_user_id.isnot(None),
+    )
+
+
+def subscribed_bands():
+    """
+    Returns the bands favorited by at least one subscriber that are known on
+    Setlist.fm, each once
+    """
+    return (
+        Band.query.filter(
+            Band.id.in_(
+                db.session.query(Favorite.band_id).filter(
+                    Favorite.user_id.in_(subscribers())
+                )
+            ),
+            Band.setlistfm_artist_id != PENDING,
+        )
+        .order_by(Band.id)
+        .all()
+    )
+
+
+def recent_setlists(mbid, today):
+    """
+    - Returns the band's setlists from the last MAX_AGE_DAYS that have songs,
+      Setlist.fm publishes setlists before they're filled in
+    - None if Setlist.fm can't be asked right now
+    """
+    try:
+        res = setlistfm_get(f"/artist/{mbid}/setlists")
+    except (UpstreamUnavailable, RateLimitExceeded):
+        return None
+
+    since = today - timedelta(days=MAX_AGE_DAYS)
+    setlists = []
+    for setlist in res.get("setlist", []):
+        try:
+            played = datetime.strptime(setlist["eventDate"], "%d-%m-%Y")
+            songs = setlist_songs(setlist)
+        except (KeyError, TypeError, ValueError):
+            continue
+        if played >= since and songs:
+            setlists.append(setlist)
+    return setlists
+
+
+def queue_copies(playlist_id, band_id):
+    """
+    - Queues the playlist for every subscriber who favorites the band, in one
+      INSERT ... ON CONFLICT, returns how many subscribers that is
+    - Subscribers who already have it or their edited copy of it saved or
+      queued are skipped
+    """
+    copied = (
+        db.session.query(Spotify_Copy.user_id)
+        .join(Playlist, Playlist.id == Spotify_Copy.playlist_id)
+        .filter(
+            db.or_(Playlist.id == playlist_id, Playlist.forked_from_id == playlist_id)
+        )
+    )
+    user_ids = [
+        user_id
+        for (user_id,) in db.session.query(Favorite.user_id).filter(
+            Favorite.band_id == band_id,
+            Favorite.user_id.in_(subscribers()),
+            Favorite.user_id.notin_(copied),
+        )
+    ]
+    insert_ignoring_conflicts(
+        Spotify_Copy,
+        [
+            {
+                "playlist_id": playlist_id,
+                "user_id": user_id,
+                "status": "pending",
+                "attempts": 0,
+                "created_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow(),
+            }
+            for user_id in user_ids
+        ],
+    )
+    return len(user_ids)
+
+
+def build_new(spotify, today=None):
+    """
+    - Looks for new setlists of every subscribed band, once per band however
+      many users favorite it, CHECK_CONCURRENCY bands at a time
+    - Builds a playlist for each setlist that doesn't have one yet and queues
+      it, or the one already built, for the band's subscribers
+    - Returns counts as a dict
+    """
+    today = today or datetime.utcnow()
+    bands = subscribed_bands()
+    with background():
+        found = map_in_context(
+            lambda mbid: recent_setlists(mbid, today),
+            [band.setlistfm_artist_id for band in bands],
+            CHECK_CONCURRENCY,
+        )
+
+    setlist_ids = [setlist["id"] for setlists in found for setlist in setlists or []]
+    built = dict(
+        Playlist.shared()
+        .filter(Playlist.setlistfm_setlist_id.in_(setlist_ids))
+        .with_entities(Playlist.setlistfm_setlist_id, Playlist.id)
+    )
+
+    counts = {"bands": len(bands), "playlists": 0, "queued": 0}
+    for band, setlists in zip(bands, found):
+        for setlist in setlists or []:
+            if setlist["id"] not in built:
+                with background():
+                    playlist = build_setlist_playlist(spotify, band, setlist)
+                built[setlist["id"]] = playlist.id
+                counts["playlists"] += 1
+                metrics.store.add(
+                    "setplaylist_auto_playlist_total", {"result": "built"}
+                )
+            counts["queued"] += queue_copies(built[setlist["id"]], band.id)
+            db.session.commit()
+    return counts
+
+
+def write_copy(spotify, cred, copy):
+    """
+    Writes a queued copy to the user's Spotify, returns (id, url) or the error
+    """
+    try:
+        token = cred.refresh_user_token(copy["token"])
+        with spotify.token_as(token):
+            return write_to_spotify(
+                spotify,
+                copy["spotify_user_id"],
+                copy["name"],
+                copy["description"],
+                copy["uris"],
+            )
+    except Exception as e:
+        log.warning("Saving playlist %s to Spotify failed: %r", copy["id"], e)
+        return e
+
+
+def deliver_batch(spotify, cred, after=0):
+    """
+    - Writes the next DELIVERY_BATCH queued playlists after copy id after to
+      their users' Spotify, DELIVERY_CONCURRENCY at a time as background work
+      under the rate limiter
+    - Returns the last copy id tried and the number written, or None when
+      there's nothing left
+    """
+    queued = (
+        db.session.query(Spotify_Copy, Playlist, User)
+        .join(Playlist, Playlist.id == Spotify_Copy.playlist_id)
+        .join(User, User.id == Spotify_Copy.user_id)
+        .filter(Spotify_Copy.status == "pending", Spotify_Copy.id > after)
+        .order_by(Spotify_Copy.id)
+        .limit(DELIVERY_BATCH)
+        .all()
+    )
+    if not queued:
+        return None
+
+    uris = {}
+    copies = []
+    for copy, playlist, user in queued:
+        if playlist.id not in uris:
+            uris[playlist.id] = playlist_uris(playlist.id)
+        copies.append(
+            {
+                "id": copy.id,
+                "token": user.spotify_user_token,
+                "spotify_user_id": user.spotify_user_id,
+                "name": playlist.name,
+                "description": playlist.description,
+                "uris": uris[playlist.id],
+            }
+        )
+
+    with background():
+        results = map_in_context(
+            lambda copy: write_copy(spotify, cred, copy), copies, DELIVERY_CONCURRENCY
+        )
+
+    delivered = 0
+    for (copy, playlist, user), result in zip(queued, results):
+        copy.attempts += 1
+        copy.updated_at = datetime.utcnow()
+        if isinstance(result, Exception):
+            copy.error = repr(result)[:500]
+            if copy.attempts >= MAX_ATTEMPTS:
+                copy.status = "failed"
+                metrics.store.add(
+                    "setplaylist_auto_playlist_total", {"result": "failed"}
+                )
+            continue
+        copy.spotify_playlist_id, copy.spotify_playlist_url = result
+        copy.status = "done"
+        copy.error = None
+        add_user_playlist(user.id, playlist.id)
+        delivered += 1
+        metrics.store.add("setplaylist_auto_playlist_total", {"result": "delivered"})
+    db.session.commit()
+    return queued[-1][0].id, delivered
+
+
+def deliver(spotify, cred):
+    """
+    Writes every queued playlist batch by batch, each tried once per run,
+    returns the number written
+    """
+    after = delivered = 0
+    while True:
+        batch = deliver_batch(spotify, cred, after)
+        if batch is None:
+            return delivered
+        after, written = batch
+        delivered += written
+
+
+def run(spotify, cred, today=None):
+    """
+    Builds new setlists' playlists and writes the queued ones to Spotify
+    """
+    counts = build_new(spotify, today)
+    counts["delivered"] = deliver(spotify, cred)
+    return counts
+
+
+def main(argv):
+    """
+    - subscriptions.py run: builds playlists of new setlists by favorited bands
+      and saves them to subscribers' Spotify, run it from a scheduler
+    """
+    if argv == ["run"]:
+        from app import app, cred, spotify
+
+        with app.app_context():
+            counts = run(spotify, cred)
+        print(
+            f"Checked {counts['bands']} bands, built {counts['playlists']} "
+            f"playlists, queued {counts['queued']}, "
+            f"delivered {counts['delivered']}"
+        )
+        return 0
+
+    print(main.__doc__, file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,135 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import tekore
+
+import app as app_module
+import upstream
+from app import CURR_USER_KEY, app
+from models import Playlist, User, User_Playlist, db
+from upstream import ResponseCache, UpstreamSender
+
+db.create_all()
+
+ARTIST = {
+    "external_urls": {"spotify": "https://open.spotify.com/artist/bandID"},
+    "followers": {"href": None, "total": 1},
+    "genres": [],
+    "href": "https://api.spotify.com/v1/artists/bandID",
+    "id": "bandID",
+    "images": [],
+    "name": "The Band",
+    "popularity": 50,
+    "type": "artist",
+    "uri": "spotify:artist:bandID",
+}
+
+SETLIST = {
+    "id": "setlistID",
+    "eventDate": "01-06-2019",
+    "venue": {"name": "The Venue", "city": {"name": "Seattle", "state": "WA"}},
+    "sets": {"set": [{"song": [{"name": "One"}, {"name": "Two"}]}]},
+}
+
+
+class SlowSpotify:
+    """
+    Answers every Spotify request with the artist after a moment, counting
+    the requests and the tokens they were made with
+    """
+
+    is_async = False
+
+    def __init__(self):
+        self.tokens = []
+
+    def send(self, request):
+        self.tokens.append(request.headers["Authorization"])
+        time.sleep(0.3)
+        return tekore.Response(
+            url=request.url, headers={}, status_code=200, content=ARTIST
+        )
+
+
+class ShowSetlistTestCase(TestCase):
+    """
+    Test the setlist page's upstream calls
+    """
+
+    def setUp(self):
+        """
+        Log a user in with a stubbed Spotify and Setlist.fm and a fresh
+        response cache
+        """
+        User_Playlist.query.delete()
+        Playlist.query.delete()
+        User.query.delete()
+        user = User(
+            username="john_doe",
+            password="password",
+            email="john@example.com",
+            secret_question="Question?",
+            secret_answer="Answer",
+            spotify_user_token="refresh-token",
+            spotify_user_id="john_doe",
+        )
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.sender = SlowSpotify()
+        spotify = tekore.Spotify(
+            app_module.APP_TOKEN,
+            sender=UpstreamSender(self.sender, public_token=app_module.APP_TOKEN),
+        )
+        self.patchers = [
+            patch.object(upstream, "response_cache", ResponseCache(self.path)),
+            patch.object(app_module, "spotify", spotify),
+            patch.object(app_module, "setlistfm_get", lambda path: SETLIST),
+            patch.object(
+                app_module.cred, "refresh_user_token", lambda token: "user-token"
+            ),
+            patch.dict(app.config, {"SESSION_COOKIE_SECURE": False}),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        """
+        Restore the stubs and clean up the user
+        """
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+        os.remove(self.path)
+        db.session.rollback()
+        User.query.delete()
+        db.session.commit()
+
+    def test_concurrent_requests_share_artist(self):
+        """
+        TESTS:
+        - Concurrent setlist pages for the same band share one Spotify artist
+          request, made with the app's token rather than the user's
+        """
+        statuses = []
+
+        def get():
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user_id
+            statuses.append(client.get("/playlist/show/bandID/setlistID").status_code)
+
+        threads = [threading.Thread(target=get) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [200] * 4)
+        self.assertEqual(self.sender.tokens, [f"Bearer {app_module.APP_TOKEN}"])
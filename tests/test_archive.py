@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+import archive
+from app import app
+from archive import (
+    ArchiveError,
+    copy_value,
+    decode_column,
+    encode_column,
+    export_tables,
+    import_tables,
+)
+from models import (
+    Album,
+    Band,
+    Playlist,
+    Playlist_Song,
+    Song,
+    Spotify_Copy,
+    User,
+    User_Playlist,
+    db,
+)
+
+db.create_all()
+
+
+def clear_tables():
+    """
+    Deletes the exported tables' rows and the users pointing at them
+    """
+    for model in (Playlist_Song, Playlist, Song, Album):
+        model.query.delete()
+    db.session.commit()
+    User.query.delete()
+    Band.query.delete()
+    db.session.commit()
+
+
+def table_rows(model):
+    """
+    Returns every row of the model's table in id order
+    """
+    table = model.__table__
+    return [
+        tuple(row) for row in db.session.execute(table.select().order_by(table.c.id))
+    ]
+
+
+class ArchiveTestCase(TestCase):
+    """
+    Test exporting and importing the playlist tables
+    """
+
+    def setUp(self):
+        """
+        Add a band with an album, songs, a shared playlist and a user's
+        edited copy of it
+        """
+        for model in (
+            Spotify_Copy,
+            User_Playlist,
+            Playlist_Song,
+            Playlist,
+            Song,
+            Album,
+            User,
+            Band,
+        ):
+            model.query.delete()
+        user = User(
+            username="john_doe",
+            password="password",
+            email="test@email.com",
+            secret_question="What's the magic word?",
+            secret_answer="Banana",
+        )
+        band = Band(
+            spotify_artist_id="band",
+            setlistfm_artist_id="mbid",
+            name="Band",
+            catalog_synced_at=datetime(2030, 1, 2, 3, 4, 5, 6),
+        )
+        db.session.add_all([user, band])
+        db.session.commit()
+        album = Album(spotify_album_id="album", band_id=band.id, name="Album")
+        db.session.add(album)
+        db.session.commit()
+
+        songs = [
+            Song(
+                spotify_song_id=f"song{n}",
+                name=name,
+                duration=60 + n,
+                band_id=band.id,
+                album_id=album.id if n else None,
+            )
+            for n, name in enumerate(["Tab\tNew\nline", "Back\\slash", "Ünïcödé", ""])
+        ]
+        shared = Playlist(
+            setlistfm_setlist_id="setlist",
+            name="Band @ The Venue",
+            description="Band @ The Venue",
+            length=4,
+            band_id=band.id,
+        )
+        db.session.add_all(songs + [shared])
+        db.session.commit()
+        fork = Playlist(
+            setlistfm_setlist_id="setlist",
+            name="Band @ The Venue",
+            description="Band @ The Venue",
+            length=1,
+            band_id=band.id,
+            owner_id=user.id,
+            forked_from_id=shared.id,
+        )
+        db.session.add(fork)
+        db.session.commit()
+        db.session.add_all(
+            [Playlist_Song(playlist_id=shared.id, song_id=song.id) for song in songs]
+            + [Playlist_Song(playlist_id=fork.id, song_id=songs[0].id)]
+        )
+        db.session.commit()
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions and the export
+        """
+        db.session.rollback()
+        shutil.rmtree(self.directory)
+
+    def test_encode_column(self):
+        """
+        TESTS:
+        - Every kind of column comes back as it went in, nulls included
+        """
+        columns = {
+            "int": [1, None, -5],
+            "bool": [True, False, None],
+            "float": [0.5, None, 2.0],
+            "time": [datetime(2030, 1, 1, 0, 0, 0, 1), None, datetime(1960, 5, 4)],
+            "text": ["a", None, "ü\tb"],
+        }
+        for kind, values in columns.items():
+            self.assertEqual(
+                decode_column(kind, encode_column(kind, values), 3), values
+            )
+
+    def test_copy_value(self):
+        """
+        TESTS:
+        - Values are escaped for COPY, None is NULL
+        """
+        self.assertEqual(copy_value(None), "\\N")
+        self.assertEqual(copy_value("a\tb\nc\\d"), "a\\tb\\nc\\\\d")
+        self.assertEqual(copy_value(datetime(2030, 1, 2)), "2030-01-02T00:00:00")
+
+    def test_round_trip(self):
+        """
+        TESTS:
+        - Tables exported in small batches load back with the same rows and
+          ids
+        - Users' edited copies of playlists aren't exported
+        - Loading into tables that already have rows is refused
+        """
+        expected = {
+            model: table_rows(model) for model in (Band, Album, Song, Playlist_Song)
+        }
+        expected[Playlist] = table_rows(Playlist)[:1]
+        expected[Playlist_Song] = expected[Playlist_Song][:4]
+
+        tables = export_tables(self.directory, "columnar", batch_rows=3)
+        self.assertEqual(tables["songs"]["rows"], 4)
+        self.assertEqual(tables["playlists"]["rows"], 1)
+        self.assertEqual(tables["playlists_songs"]["rows"], 4)
+
+        with self.assertRaises(ArchiveError):
+            import_tables(self.directory)
+
+        clear_tables()
+
+        tables = import_tables(self.directory, batch_rows=3)
+        self.assertEqual(tables["bands"]["rows"], 1)
+        for model, rows in expected.items():
+            self.assertEqual(table_rows(model), rows)
+
+    def test_import_count_mismatch(self):
+        """
+        TESTS:
+        - An archive with fewer rows than its manifest lists loads nothing,
+          not even the tables before the short one
+        """
+        export_tables(self.directory, "columnar")
+        path = os.path.join(self.directory, archive.MANIFEST)
+        with open(path) as f:
+            manifest = json.load(f)
+        manifest["tables"]["playlists_songs"]["rows"] += 1
+        with open(path, "w") as f:
+            json.dump(manifest, f)
+        clear_tables()
+
+        with self.assertRaises(ArchiveError):
+            import_tables(self.directory)
+        for model in (Band, Album, Song, Playlist, Playlist_Song):
+            self.assertEqual(table_rows(model), [])
+
+    def test_parquet_needs_pyarrow(self):
+        """
+        TESTS:
+        - Without pyarrow the parquet format is refused
+        """
+        if archive.pyarrow is not None:
+            self.skipTest("pyarrow is installed")
+        with self.assertRaises(ArchiveError):
+            export_tables(self.directory, "parquet")
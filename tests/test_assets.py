@@ -0,0 +1,167 @@
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+from flask import Flask
+
+import assets
+from assets import Manifest, build
+
+CSS = """.hero {
+  background-image: url("../img/hero.png");
+}
+.logo {
+  background: url("/static/img/logo.png") no-repeat;
+}
+.font {
+  src: url("https://example.com/font.woff2");
+}
+/*# sourceMappingURL=main.css.map */
+"""
+
+app = Flask(__name__)
+assets.install_app(app)
+
+
+class AssetBuildTestCase(TestCase):
+    """
+    Test the asset build and serving the built files
+    """
+
+    def setUp(self):
+        """
+        Make a static directory with a stylesheet, a script and two images
+        """
+        self.static = tempfile.mkdtemp()
+        self.out = os.path.join(self.static, "dist")
+        for directory in ("css", "js", "img"):
+            os.mkdir(os.path.join(self.static, directory))
+        with open(os.path.join(self.static, "css", "main.css"), "w") as f:
+            f.write(CSS * 20)
+        with open(os.path.join(self.static, "css", "main.css.map"), "w") as f:
+            f.write("{}")
+        with open(os.path.join(self.static, "js", "main.js"), "w") as f:
+            f.write("console.log('SetPlaylist');\n" * 20)
+        self.write_image("hero.png", 2000)
+        self.write_image("logo.png", 300)
+
+    def tearDown(self):
+        """
+        Remove the static directory
+        """
+        shutil.rmtree(self.static)
+
+    def write_image(self, name, width):
+        """
+        Writes a PNG, a solid color one when Pillow is installed
+        """
+        path = os.path.join(self.static, "img", name)
+        if assets.Image is None:
+            with open(path, "wb") as f:
+                f.write(b"\x89PNG not really " + name.encode())
+            return
+        assets.Image.new("RGB", (width, width // 2), (200, 30, 90)).save(path)
+
+    def test_build(self):
+        """
+        TESTS:
+        - Files are copied under content hashed names, source maps are skipped
+        - Stylesheets point at the hashed files and lose the source map comment
+        - Text files get a smaller gzip variant
+        """
+        manifest = build(self.static, self.out)
+
+        self.assertNotIn("css/main.css.map", manifest["assets"])
+        js = manifest["assets"]["js/main.js"]["file"]
+        self.assertRegex(js, r"^js/main\.[0-9a-f]{10}\.js$")
+        self.assertIn("gzip", manifest["files"][js]["encodings"])
+        with open(os.path.join(self.out, js + ".gz"), "rb") as f:
+            self.assertIn(b"SetPlaylist", gzip.decompress(f.read()))
+
+        css = manifest["assets"]["css/main.css"]["file"]
+        with open(os.path.join(self.out, css)) as f:
+            built = f.read()
+        logo = manifest["assets"]["img/logo.png"]["file"]
+        self.assertIn(f'url("/assets/{logo}")', built)
+        self.assertIn('url("https://example.com/font.woff2")', built)
+        self.assertNotIn("../img/hero.png", built)
+        self.assertNotIn("sourceMappingURL", built)
+
+    @skipIf(assets.Image is None, "Pillow isn't installed")
+    def test_image_variants(self):
+        """
+        TESTS:
+        - Images get WebP copies and resized copies narrower than the original
+        - Backgrounds start with the smallest copy and switch at wider screens
+        """
+        manifest = build(self.static, self.out)
+
+        hero = manifest["assets"]["img/hero.png"]
+        self.assertEqual(sorted(hero["widths"], key=int), ["768", "1280", "1920"])
+        self.assertTrue(manifest["files"][hero["file"]]["webp"].endswith(".webp"))
+        self.assertNotIn("widths", manifest["assets"]["img/logo.png"])
+
+        with open(
+            os.path.join(self.out, manifest["assets"]["css/main.css"]["file"])
+        ) as f:
+            built = f.read()
+        self.assertIn(
+            f'.hero {{\n  background-image: url("/assets/{hero["widths"]["768"]}")',
+            built,
+        )
+        widest = f'url("/assets/{hero["widths"]["1920"]}")'
+        self.assertIn(
+            f"@media (min-width: 1281px) {{ .hero {{ background-image: {widest}; }} }}",
+            built,
+        )
+
+    def test_serve(self):
+        """
+        TESTS:
+        - Built files are served immutable, compressed when the browser accepts it
+        - Unknown files are 404
+        """
+        manifest = build(self.static, self.out)
+        js = manifest["assets"]["js/main.js"]["file"]
+        client = app.test_client()
+
+        with patch.object(assets, "manifest", Manifest(self.out)):
+            res = client.get("/assets/" + js, headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(res.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", res.headers["Vary"])
+            self.assertIn("immutable", res.headers["Cache-Control"])
+            self.assertIn(b"SetPlaylist", gzip.decompress(res.data))
+            res.close()
+
+            res = client.get("/assets/" + js, headers={"Accept-Encoding": "identity"})
+            self.assertNotIn("Content-Encoding", res.headers)
+            self.assertIn(b"SetPlaylist", res.data)
+            res.close()
+
+            self.assertEqual(client.get("/assets/js/main.js").status_code, 404)
+
+            with app.test_request_context():
+                self.assertEqual(assets.asset_url("js/main.js"), "/assets/" + js)
+
+    @skipIf(assets.Image is None, "Pillow isn't installed")
+    def test_serve_webp(self):
+        """
+        TESTS:
+        - Browsers that accept WebP get the WebP copy of an image
+        """
+        manifest = build(self.static, self.out)
+        hero = manifest["assets"]["img/hero.png"]["file"]
+        client = app.test_client()
+
+        with patch.object(assets, "manifest", Manifest(self.out)):
+            res = client.get("/assets/" + hero, headers={"Accept": "image/webp,*/*"})
+            self.assertEqual(res.mimetype, "image/webp")
+            self.assertIn("Accept", res.headers["Vary"])
+            res.close()
+
+            res = client.get("/assets/" + hero, headers={"Accept": "*/*"})
+            self.assertEqual(res.mimetype, "image/png")
+            res.close()
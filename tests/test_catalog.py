@@ -0,0 +1,85 @@
+from unittest import TestCase
+
+from app import app
+from catalog import resolve_local
+from models import Album, Band, Song, db
+
+db.create_all()
+
+
+class CatalogTestCase(TestCase):
+    """
+    Test resolving setlist songs against a band's local catalog
+    """
+
+    def setUp(self):
+        """
+        Clean up data, add a band with a small catalog
+        """
+        Song.query.delete()
+        Album.query.delete()
+        Band.query.delete()
+
+        band = Band(
+            spotify_artist_id="spotifyID",
+            setlistfm_artist_id="anotherID",
+            name="THE Band",
+            photo="Not Today",
+        )
+        db.session.add(band)
+        db.session.commit()
+
+        for spotify_song_id, name, normalized_name in [
+            ("1", "Heroes", "heroes"),
+            ("2", "Heroes - Live", "heroes"),
+            ("3", "Rock & Roll", "rock and roll"),
+        ]:
+            db.session.add(
+                Song(
+                    spotify_song_id=spotify_song_id,
+                    name=name,
+                    duration=200,
+                    band_id=band.id,
+                    normalized_name=normalized_name,
+                )
+            )
+        db.session.commit()
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions and catalog data
+        """
+        db.session.rollback()
+        Song.query.delete()
+        Album.query.delete()
+        db.session.commit()
+
+    def test_resolve_local(self):
+        """
+        TESTS:
+        - Studio versions are preferred unless the setlist asks for live
+        - Medleys resolve to every song
+        - Covers and unknown songs aren't resolved locally
+        """
+        band = Band.query.filter_by(name="THE Band").first()
+
+        self.assertEqual(
+            [s.spotify_song_id for s in resolve_local(band, {"name": "Heroes"})],
+            ["1"],
+        )
+        self.assertEqual(
+            [s.spotify_song_id for s in resolve_local(band, {"name": "Heroes (Live)"})],
+            ["2"],
+        )
+        self.assertEqual(
+            [
+                s.spotify_song_id
+                for s in resolve_local(band, {"name": "Heroes / Rock and Roll"})
+            ],
+            ["1", "3"],
+        )
+        self.assertEqual(
+            resolve_local(band, {"name": "Heroes", "cover": {"name": "David Bowie"}}),
+            [],
+        )
+        self.assertEqual(resolve_local(band, {"name": "Heroes / Unknown"}), [])
@@ -0,0 +1,182 @@
+import json
+from unittest import TestCase
+from unittest.mock import patch
+
+import compilation
+import playlists
+from app import app
+from compilation import (
+    build_compilation,
+    compile_songs,
+    get_setlists,
+    parse_setlist_ids,
+    tour_setlists,
+)
+from models import Band, Playlist, Playlist_Song, Setlist, Song, db
+from playlists import playlist_uris
+
+db.create_all()
+
+
+def setlist(setlist_id, date, songs, mbid="mbid", city="Seattle"):
+    """
+    Returns a setlist shaped like Setlist.fm's
+    """
+    return {
+        "id": setlist_id,
+        "eventDate": date,
+        "artist": {"mbid": mbid},
+        "venue": {"name": "The Venue", "city": {"name": city, "state": "WA"}},
+        "tour": {"name": "The Tour"},
+        "sets": {"set": [{"song": [{"name": name} for name in songs]}]},
+    }
+
+
+def track(song):
+    """
+    Returns a Spotify track for a Setlist.fm song
+    """
+    return [{"id": f"id-{song['name']}", "name": song["name"], "duration_ms": 60000}]
+
+
+class CompilationTestCase(TestCase):
+    """
+    Test compiling many shows into one playlist
+    """
+
+    def setUp(self):
+        """
+        Push an app context (songs are resolved with its config) and add the
+        band
+        """
+        self.ctx = app.app_context()
+        self.ctx.push()
+        for model in (Playlist_Song, Playlist, Song, Setlist, Band):
+            model.query.delete()
+        self.band = Band(
+            spotify_artist_id="band", setlistfm_artist_id="mbid", name="Band"
+        )
+        db.session.add(self.band)
+        db.session.commit()
+
+        self.setlists = [
+            setlist("1", "01-03-2030", ["Intro", "Hit", "Deep Cut"]),
+            setlist("2", "02-03-2030", ["Hit", "Intro", "Encore"], city="Portland"),
+            setlist("3", "03-03-2030", ["Intro", "Hit", "Hit"]),
+        ]
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions
+        """
+        db.session.rollback()
+        self.ctx.pop()
+
+    def test_parse_setlist_ids(self):
+        """
+        TESTS:
+        - Ids can be repeated form values or separated by commas or spaces
+        - Repeats are dropped and there are at most MAX_SETLISTS
+        """
+        self.assertEqual(
+            parse_setlist_ids(["a, b", "c d\nb", ""]), ["a", "b", "c", "d"]
+        )
+        with patch.object(compilation, "MAX_SETLISTS", 2):
+            self.assertEqual(parse_setlist_ids(["a b c"]), ["a", "b"])
+
+    def test_compile_songs(self):
+        """
+        TESTS:
+        - Each song is in once, most played first
+        - Songs played as often are ordered by where they usually come
+        """
+        self.assertEqual(
+            [song["name"] for song in compile_songs(self.setlists)],
+            ["Intro", "Hit", "Deep Cut", "Encore"],
+        )
+
+    def test_get_setlists(self):
+        """
+        TESTS:
+        - Cached setlists aren't fetched again
+        - Setlists that can't be found are left out
+        """
+        db.session.add(
+            Setlist(
+                setlistfm_setlist_id="1",
+                band_id=self.band.id,
+                data=json.dumps(self.setlists[0]),
+            )
+        )
+        db.session.commit()
+        fetched = []
+
+        def fetch(path):
+            fetched.append(path)
+            if path == "/setlist/2":
+                return self.setlists[1]
+            return {"code": 404, "status": "Not Found"}
+
+        with patch.object(compilation, "setlistfm_get", side_effect=fetch):
+            found = get_setlists(["1", "2", "missing"])
+
+        self.assertEqual([setlist["id"] for setlist in found], ["1", "2"])
+        self.assertEqual(sorted(fetched), ["/setlist/2", "/setlist/missing"])
+
+    def test_tour_setlists(self):
+        """
+        TESTS:
+        - Every page of the tour is fetched, up to MAX_SETLISTS
+        - A tour without setlists has none
+        """
+
+        def search(path, params):
+            page = dict(params)["p"]
+            return {
+                "setlist": [
+                    setlist(f"{page}-{i}", "01-03-2030", [])
+                    for i in range(2 * page - 2, min(2 * page, 5))
+                ],
+                "total": 5,
+                "itemsPerPage": 2,
+            }
+
+        with patch.object(compilation, "setlistfm_get", side_effect=search) as get:
+            self.assertEqual(len(tour_setlists("mbid", "The Tour")), 5)
+            self.assertEqual(get.call_count, 3)
+
+            with patch.object(compilation, "MAX_SETLISTS", 3):
+                self.assertEqual(len(tour_setlists("mbid", "The Tour")), 3)
+
+        with patch.object(compilation, "setlistfm_get", return_value={"code": 404}):
+            self.assertEqual(tour_setlists("mbid", "No Tour"), [])
+
+    def test_build_compilation(self):
+        """
+        TESTS:
+        - Each song is searched for once however many shows played it
+        - Other artists' setlists are left out
+        - The same shows compile to the same playlist
+        """
+        setlists = self.setlists + [setlist("4", "04-03-2030", ["Other"], "other")]
+        with patch.object(
+            playlists, "find_tracks", side_effect=lambda sp, song, band: track(song)
+        ) as find:
+            playlist = build_compilation(None, self.band, setlists)
+
+        self.assertEqual(find.call_count, 4)
+        self.assertEqual(playlist.length, 4)
+        self.assertEqual(playlist.name, "Band - The Tour (3 shows)")
+        self.assertEqual(playlist.event_date, "01-03-2030 - 03-03-2030")
+        self.assertEqual(playlist.venue_loc, "2 cities")
+        self.assertEqual(
+            playlist_uris(playlist.id),
+            [
+                f"spotify:track:id-{name}"
+                for name in ("Intro", "Hit", "Deep Cut", "Encore")
+            ],
+        )
+        self.assertEqual(Setlist.query.count(), 3)
+
+        again = build_compilation(None, self.band, list(reversed(self.setlists)))
+        self.assertEqual(again.id, playlist.id)
@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from dbpool import PoolMetrics, engine_options
+
+
+class DbPoolTestCase(TestCase):
+    """
+    Test engine pool configuration and pool metrics
+    """
+
+    def test_engine_options(self):
+        """
+        TESTS:
+        - Postgres gets a bounded pool with pre-ping and a statement timeout
+        - SQLite only gets the thread sharing flag
+        """
+        options = engine_options("postgresql:///setplaylist")
+        self.assertIn("pool_size", options)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertIn("statement_timeout", options["connect_args"]["options"])
+
+        self.assertEqual(
+            engine_options("sqlite://"),
+            {"connect_args": {"check_same_thread": False}},
+        )
+
+    def test_pool_metrics(self):
+        """
+        TESTS:
+        - Checkouts and checkins are counted
+        - Peak and current checked out connections are tracked
+        """
+        engine = create_engine("sqlite://", poolclass=QueuePool, pool_size=2)
+        metrics = PoolMetrics()
+        metrics.install(engine)
+
+        first = engine.connect()
+        second = engine.connect()
+        self.assertEqual(metrics.snapshot()["checked_out"], 2)
+        first.close()
+        second.close()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["checkouts"], 2)
+        self.assertEqual(snapshot["checkins"], 2)
+        self.assertEqual(snapshot["checked_out"], 0)
+        self.assertEqual(snapshot["peak_checked_out"], 2)
+        self.assertEqual(snapshot["size"], 2)
+        engine.dispose()
@@ -0,0 +1,116 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+import favorites
+from app import app
+from favorites import PENDING, enricher, favorited, save_favorites
+from models import Band, Favorite, User, db
+
+db.create_all()
+
+
+def artist(spotify_id, name):
+    """
+    Returns an artist shaped like Spotify's
+    """
+    return {"id": spotify_id, "name": name, "images": []}
+
+
+class FavoritesTestCase(TestCase):
+    """
+    Test adding and removing favorites in batches
+    """
+
+    def setUp(self):
+        """
+        Add a user and one band that's already in the database
+        """
+        Favorite.query.delete()
+        User.query.delete()
+        Band.query.delete()
+        self.user = User(
+            username="john_doe",
+            password="password",
+            email="test@email.com",
+            secret_question="What's the magic word?",
+            secret_answer="Banana",
+        )
+        self.band = Band(
+            spotify_artist_id="known", setlistfm_artist_id="mbid-1", name="Known"
+        )
+        db.session.add_all([self.user, self.band])
+        db.session.commit()
+        self.fetched = []
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions
+        """
+        db.session.rollback()
+
+    def fetch_artists(self, spotify_ids):
+        """
+        Stands in for Spotify, remembering what it was asked for
+        """
+        self.fetched.append(spotify_ids)
+        return [artist(spotify_id, spotify_id.title()) for spotify_id in spotify_ids]
+
+    def test_toggle(self):
+        """
+        TESTS:
+        - Toggling adds bands that aren't favorites and removes ones that are
+        - Only bands missing from the database are fetched, in one call
+        - New bands are queued to be found on Setlist.fm
+        """
+        with patch.object(enricher, "add") as add:
+            result = save_favorites(
+                self.user, ["known", "new", "known"], "toggle", self.fetch_artists
+            )
+        self.assertEqual(result, {"added": ["known", "new"], "removed": []})
+        self.assertEqual(self.fetched, [["new"]])
+        new = Band.query.filter_by(spotify_artist_id="new").one()
+        self.assertEqual(new.setlistfm_artist_id, PENDING)
+        add.assert_called_once_with([new.id])
+
+        with patch.object(enricher, "add"):
+            result = save_favorites(self.user, ["known"], "toggle", self.fetch_artists)
+        self.assertEqual(result, {"added": [], "removed": ["known"]})
+        self.assertEqual(favorited(self.user.id, [self.band.id, new.id]), {new.id})
+
+    def test_add_remove(self):
+        """
+        TESTS:
+        - Adding keeps existing favorites, removing never fetches bands
+        """
+        with patch.object(enricher, "add"):
+            save_favorites(self.user, ["known"], "add", self.fetch_artists)
+            result = save_favorites(
+                self.user, ["known", "other"], "add", self.fetch_artists
+            )
+            self.assertEqual(result["added"], ["other"])
+
+            result = save_favorites(
+                self.user, ["known", "gone"], "remove", self.fetch_artists
+            )
+        self.assertEqual(result, {"added": [], "removed": ["known"]})
+        self.assertEqual(self.fetched, [["other"]])
+        self.assertEqual(Favorite.query.count(), 1)
+
+    def test_enrich(self):
+        """
+        TESTS:
+        - Pending bands get their Setlist.fm mbid when Setlist.fm knows them
+        - Bands it doesn't know stay pending
+        """
+        with patch.object(enricher, "add"):
+            save_favorites(self.user, ["new", "unknown"], "add", self.fetch_artists)
+        new = Band.query.filter_by(spotify_artist_id="new").one()
+        unknown = Band.query.filter_by(spotify_artist_id="unknown").one()
+
+        res = {"artist": [{"name": "Newer", "mbid": "x"}, {"name": "NEW", "mbid": "y"}]}
+        with patch.object(favorites, "setlistfm_get", return_value=res):
+            enricher.enrich(new.id)
+            enricher.enrich(unknown.id)
+
+        self.assertEqual(Band.query.get(new.id).setlistfm_artist_id, "y")
+        self.assertEqual(Band.query.get(unknown.id).setlistfm_artist_id, PENDING)
@@ -0,0 +1,141 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+import tekore
+
+import follow_import
+from app import app
+from favorites import PENDING
+from follow_import import Importer, import_page
+from models import Band, Favorite, Import_Job, User, db
+
+db.create_all()
+
+
+def artist(spotify_id):
+    """
+    Returns an artist shaped like Spotify's
+    """
+    return {"id": spotify_id, "name": f"Band {spotify_id}", "images": []}
+
+
+def pages(*ids_per_page):
+    """
+    Yields pages of followed artists like get_followed_artists
+    """
+    total = sum(len(ids) for ids in ids_per_page)
+    for ids in ids_per_page:
+        yield [artist(spotify_id) for spotify_id in ids], total
+
+
+class FollowImportTestCase(TestCase):
+    """
+    Test importing followed artists as favorites
+    """
+
+    def setUp(self):
+        """
+        Add a user who already has one of the bands as a favorite
+        """
+        Import_Job.query.delete()
+        Favorite.query.delete()
+        User.query.delete()
+        Band.query.delete()
+        self.user = User(
+            username="john_doe",
+            password="password",
+            email="test@email.com",
+            secret_question="What's the magic word?",
+            secret_answer="Banana",
+        )
+        band = Band(spotify_artist_id="a", setlistfm_artist_id="mbid-a", name="Band a")
+        db.session.add_all([self.user, band])
+        db.session.commit()
+        db.session.add(Favorite(user_id=self.user.id, band_id=band.id))
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.importer = Importer(workers=1, concurrency=2)
+        self.importer.app = app
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions
+        """
+        db.session.rollback()
+
+    def test_import_page(self):
+        """
+        TESTS:
+        - Missing bands and favorites are inserted, existing ones are skipped
+        - Only new favorites are counted, repeats in a page are ignored
+        """
+        added, pending = import_page(
+            self.user_id, [artist("a"), artist("b"), artist("c"), artist("b")]
+        )
+        db.session.commit()
+
+        self.assertEqual(added, 2)
+        self.assertEqual(sorted(name for _, name in pending), ["Band b", "Band c"])
+        self.assertEqual(Band.query.count(), 3)
+        self.assertEqual(Favorite.query.filter_by(user_id=self.user_id).count(), 3)
+
+        added, pending = import_page(self.user_id, [artist("c")])
+        self.assertEqual(added, 0)
+
+    def test_run(self):
+        """
+        TESTS:
+        - The import saves every page and reports its progress
+        - New bands get their Setlist.fm mbids, unknown ones stay pending
+        """
+        job = Import_Job(user_id=self.user_id)
+        db.session.add(job)
+        db.session.commit()
+
+        def find(name):
+            return None if name == "Band d" else f"mbid-{name[-1]}"
+
+        with patch.object(follow_import, "find_setlistfm_artist", side_effect=find):
+            self.importer.run(job.id, pages(["a", "b"], ["c", "d"]))
+
+        db.session.expire_all()
+        job = Import_Job.query.get(job.id)
+        self.assertEqual(
+            job.serialize(),
+            {
+                "id": job.id,
+                "status": "done",
+                "total": 4,
+                "imported": 4,
+                "added": 3,
+                "resolved": 2,
+                "error": None,
+            },
+        )
+        mbids = dict(db.session.query(Band.spotify_artist_id, Band.setlistfm_artist_id))
+        self.assertEqual(
+            mbids, {"a": "mbid-a", "b": "mbid-b", "c": "mbid-c", "d": PENDING}
+        )
+
+    def test_failed(self):
+        """
+        TESTS:
+        - A token without the follow scope fails the import with a reason
+        - Users with an unfinished import get it back instead of a new one
+        """
+
+        def forbidden():
+            raise tekore.Forbidden("Insufficient client scope", None, None)
+            yield
+
+        job = Import_Job(user_id=self.user_id)
+        db.session.add(job)
+        db.session.commit()
+        self.assertEqual(self.importer.start(self.user_id, iter([])).id, job.id)
+
+        self.importer.run(job.id, forbidden())
+        db.session.expire_all()
+        job = Import_Job.query.get(job.id)
+        self.assertEqual(job.status, "failed")
+        self.assertIn("Reconnect Spotify", job.error)
@@ -0,0 +1,141 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+import fragments
+from app import app
+from fragments import (
+    FragmentCache,
+    band_setlists,
+    playlist_songs,
+    setlist_display,
+)
+from models import Playlist, Song
+
+BAND = {"id": "spotifyID", "name": "Test Band"}
+
+
+def make_setlist(setlist_id, version_id, venue_name="The Venue"):
+    """
+    Returns a setlist shaped like setlist.fm's
+    """
+    return {
+        "id": setlist_id,
+        "versionId": version_id,
+        "eventDate": "01-06-2019",
+        "venue": {
+            "name": venue_name,
+            "city": {
+                "name": "Seattle",
+                "stateCode": "WA",
+                "country": {"code": "US"},
+            },
+        },
+    }
+
+
+class FragmentCacheTestCase(TestCase):
+    """
+    Test the fragment cache and the cached band and playlist sections
+    """
+
+    def setUp(self):
+        """
+        Give every test an empty cache and a request context to render in
+        """
+        self.cache = FragmentCache(max_entries=2)
+        self.patcher = patch.object(fragments, "cache", self.cache)
+        self.patcher.start()
+        self.ctx = app.test_request_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        """
+        Restore the module's cache and pop the request context
+        """
+        self.ctx.pop()
+        self.patcher.stop()
+
+    def test_lru(self):
+        """
+        TESTS:
+        - The least recently used entry is dropped past max_entries
+        """
+        self.cache.set("a", "A")
+        self.cache.set("b", "B")
+        self.cache.get("a")
+        self.cache.set("c", "C")
+
+        self.assertEqual(self.cache.get("a"), "A")
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("c"), "C")
+
+    def test_setlist_display(self):
+        """
+        TESTS:
+        - Setlists display as venue name - event date - venue location
+        - A blank venue name displays as Venue Unknown
+        """
+        self.assertEqual(
+            setlist_display(make_setlist("1", "v1")),
+            "The Venue - 01-06-2019 - Seattle, WA, US",
+        )
+        self.assertEqual(
+            setlist_display(make_setlist("1", "v1", venue_name="")),
+            "Venue Unknown - 01-06-2019 - Seattle, WA, US",
+        )
+
+    def test_band_setlists(self):
+        """
+        TESTS:
+        - The setlist list renders with its links and display strings
+        - The same setlists are served from the cache without formatting again
+        - An edited setlist (new versionId) renders again
+        """
+        setlists = [make_setlist("1", "v1"), make_setlist("2", "v1")]
+
+        with patch.object(
+            fragments, "setlist_display", wraps=setlist_display
+        ) as display:
+            html = band_setlists(BAND, setlists)
+            self.assertIn('href="/playlist/show/spotifyID/1"', html)
+            self.assertIn("The Venue - 01-06-2019 - Seattle, WA, US", html)
+            self.assertEqual(display.call_count, 2)
+
+            self.assertEqual(band_setlists(BAND, setlists), html)
+            self.assertEqual(display.call_count, 2)
+
+            setlists[1] = make_setlist("2", "v2", venue_name="New Venue")
+            self.assertIn("New Venue", band_setlists(BAND, setlists))
+            self.assertEqual(display.call_count, 4)
+
+    def test_playlist_songs(self):
+        """
+        TESTS:
+        - An unsaved playlist's song names render in order and are escaped
+        """
+        playlist = Playlist(name="Test", description="Test", length=2)
+        playlist.add_songs(["First Song", "<Second> & Song"])
+
+        html = playlist_songs(playlist)
+        self.assertLess(html.index("First Song"), html.index("&lt;Second&gt;"))
+        self.assertIn("&amp; Song", html)
+
+    def test_saved_playlist_songs(self):
+        """
+        TESTS:
+        - A saved playlist's songs are rendered once per version, a reorder
+          that bumps the version shows the new order
+        """
+        first, second = Song(name="First Song"), Song(name="Second Song")
+        playlist = Playlist(id=1, name="Test", length=2, version=1)
+        playlist.songs = [first, second]
+
+        html = playlist_songs(playlist)
+        self.assertLess(html.index("First Song"), html.index("Second Song"))
+
+        playlist.songs = [second, first]
+        self.assertEqual(playlist_songs(playlist), html)
+
+        playlist.version = 2
+        html = playlist_songs(playlist)
+        self.assertLess(html.index("Second Song"), html.index("First Song"))
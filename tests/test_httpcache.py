@@ -0,0 +1,114 @@
+import os
+from unittest import TestCase
+
+from flask import Flask, g, request, session
+
+import httpcache
+from httpcache import asset_url, cache_page
+
+STATIC = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static")
+
+app = Flask(__name__, static_folder=STATIC)
+app.config["SECRET_KEY"] = "test"
+httpcache.install_app(app)
+
+renders = []
+
+
+@app.before_request
+def add_to_g():
+    """
+    Stand-in for the app's signed in user
+    """
+    g.user = request.headers.get("X-User")
+
+
+@app.route("/page/<name>")
+@cache_page(lambda name: (name, request.args.get("v")))
+def page(name):
+    """
+    Stand-in for a cacheable view
+    """
+    renders.append(name)
+    return f"Page {name}"
+
+
+@app.route("/cookie")
+@cache_page()
+def cookie():
+    """
+    Stand-in for a cacheable view that changes the session
+    """
+    session["seen"] = True
+    return "Cookie"
+
+
+class HTTPCacheTestCase(TestCase):
+    """
+    Test the caching headers and conditional GETs
+    """
+
+    def setUp(self):
+        """
+        Use a fresh client for every test
+        """
+        self.client = app.test_client()
+        renders.clear()
+
+    def test_public_page(self):
+        """
+        TESTS:
+        - Signed out pages get an ETag and are cacheable by browsers and CDNs
+        - A matching If-None-Match gets a 304 without running the view
+        - A new data version gets a new ETag
+        """
+        res = self.client.get("/page/a")
+        etag = res.headers["ETag"]
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(res.cache_control.max_age, httpcache.PAGE_MAX_AGE)
+        self.assertEqual(int(res.cache_control.s_maxage), httpcache.CDN_MAX_AGE)
+        self.assertTrue(res.cache_control.public)
+
+        res = self.client.get("/page/a", headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers["ETag"], etag)
+        self.assertEqual(renders, ["a"])
+
+        res = self.client.get("/page/a?v=2", headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    def test_private_page(self):
+        """
+        TESTS:
+        - Signed in users' pages have no ETag and are private
+        - Responses that set a cookie are private
+        """
+        res = self.client.get("/page/a", headers={"X-User": "1"})
+        self.assertNotIn("ETag", res.headers)
+        self.assertTrue(res.cache_control.private)
+        self.assertTrue(res.cache_control.no_cache)
+
+        res = self.client.get("/cookie")
+        self.assertTrue(res.cache_control.private)
+        self.assertNotIn("ETag", res.headers)
+
+    def test_static(self):
+        """
+        TESTS:
+        - Fingerprinted static URLs are cached for a year as immutable
+        - Plain or outdated static URLs are cached for ASSET_MAX_AGE
+        """
+        with app.test_request_context():
+            url = asset_url("js/main.js")
+
+        res = self.client.get(url)
+        self.assertEqual(res.cache_control.max_age, httpcache.IMMUTABLE_MAX_AGE)
+        self.assertIn("immutable", res.headers["Cache-Control"])
+        res.close()
+
+        for url in ("/static/js/main.js", "/static/js/main.js?v=outdated"):
+            res = self.client.get(url)
+            self.assertEqual(res.cache_control.max_age, httpcache.ASSET_MAX_AGE)
+            self.assertNotIn("immutable", res.headers["Cache-Control"])
+            res.close()
@@ -0,0 +1,58 @@
+from unittest import TestCase
+
+from matching import best_match, normalize_title, song_queries, split_medley
+
+
+def make_track(name, artist, album_type="album"):
+    """
+    Builds a Spotify style track with the given name and artist
+    """
+    return {
+        "id": name + artist,
+        "name": name,
+        "duration_ms": 200000,
+        "artists": [{"name": artist}],
+        "album": {"album_type": album_type},
+    }
+
+
+class MatchingTestCase(TestCase):
+    """
+    Test setlist song -> Spotify track matching
+    """
+
+    def test_normalize_title(self):
+        """
+        TESTS:
+        - Qualifiers, accents, punctuation and remaster suffixes are removed
+        """
+        self.assertEqual(normalize_title("Héroes (Acoustic)"), "heroes")
+        self.assertEqual(normalize_title("Don't Stop - 2004 Remaster"), "dont stop")
+        self.assertEqual(normalize_title("Rock & Roll [Live]"), "rock and roll")
+
+    def test_song_queries(self):
+        """
+        TESTS:
+        - Medleys are split into separate songs
+        - Covers are searched under the original artist
+        """
+        self.assertEqual(split_medley("One / Two > Three"), ["One", "Two", "Three"])
+        song = {"name": "Jolene", "cover": {"name": "Dolly Parton"}}
+        self.assertEqual(song_queries(song, "The Band"), [("Jolene", "Dolly Parton")])
+
+    def test_best_match(self):
+        """
+        TESTS:
+        - Studio version by the right artist beats a live version
+        - Nothing is returned when no candidate is close
+        """
+        candidates = [
+            make_track("Heroes - Live", "The Band"),
+            make_track("Heroes", "Someone Else"),
+            make_track("Heroes", "The Band"),
+        ]
+
+        self.assertEqual(best_match("Heroes", "The Band", candidates), candidates[2])
+        self.assertIsNone(
+            best_match("Completely Different", "The Band", candidates[:2])
+        )
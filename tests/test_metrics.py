@@ -0,0 +1,110 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+
+from metrics import MetricsStore, internal
+
+app = Flask(__name__)
+app.config["METRICS_TOKEN"] = "s3cret"
+
+
+@app.route("/status")
+@internal
+def status():
+    """
+    Stand-in for an internal status endpoint
+    """
+    return "Status"
+
+
+class MetricsStoreTestCase(TestCase):
+    """
+    Test the shared metrics store and its Prometheus output
+    """
+
+    def setUp(self):
+        """
+        Use a fresh metrics file for every test
+        """
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.store = MetricsStore(self.path, flush_interval=60)
+
+    def tearDown(self):
+        """
+        Remove the metrics file
+        """
+        os.remove(self.path)
+
+    def test_histogram(self):
+        """
+        TESTS:
+        - Observations land in every bucket they fit, in ascending order
+        - Sum and count are kept per label set
+        """
+        labels = {"api": "spotify", "cache": "hit"}
+        self.store.observe("setplaylist_upstream_seconds", labels, 0.2)
+        self.store.observe("setplaylist_upstream_seconds", labels, 3)
+
+        lines = self.store.render().splitlines()
+        self.assertIn("# TYPE setplaylist_upstream_seconds histogram", lines)
+        self.assertIn(
+            'setplaylist_upstream_seconds_bucket{api="spotify",cache="hit",le="0.25"} 1.0',
+            lines,
+        )
+        self.assertIn(
+            'setplaylist_upstream_seconds_bucket{api="spotify",cache="hit",le="+Inf"} 2.0',
+            lines,
+        )
+        self.assertIn(
+            'setplaylist_upstream_seconds_count{api="spotify",cache="hit"} 2.0', lines
+        )
+
+        buckets = [line for line in lines if "_bucket" in line]
+        self.assertEqual(len(buckets), 12)
+        self.assertIn('le="0.005"} 0.0', buckets[0])
+        self.assertIn('le="+Inf"', buckets[-1])
+
+    def test_workers_share_totals(self):
+        """
+        TESTS:
+        - Counters flushed by separate stores add up in the shared file
+        """
+        other = MetricsStore(self.path, flush_interval=60)
+        self.store.add("setplaylist_request_db_queries_total", {"endpoint": "x"}, 3)
+        other.add("setplaylist_request_db_queries_total", {"endpoint": "x"}, 2)
+        other.flush(force=True)
+
+        self.assertIn(
+            'setplaylist_request_db_queries_total{endpoint="x"} 5.0',
+            self.store.render().splitlines(),
+        )
+
+
+class InternalTestCase(TestCase):
+    """
+    Test internal endpoints are hidden without the metrics token
+    """
+
+    def test_internal(self):
+        """
+        TESTS:
+        - Only the METRICS_TOKEN bearer token gets the view, anything else
+          gets a 404
+        - No METRICS_TOKEN set hides the view from everyone
+        """
+        client = app.test_client()
+        self.assertEqual(client.get("/status").status_code, 404)
+        res = client.get("/status", headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(res.status_code, 404)
+        res = client.get("/status", headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(res.data, b"Status")
+
+        app.config["METRICS_TOKEN"] = None
+        try:
+            res = client.get("/status", headers={"Authorization": "Bearer None"})
+            self.assertEqual(res.status_code, 404)
+        finally:
+            app.config["METRICS_TOKEN"] = "s3cret"
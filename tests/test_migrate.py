@@ -0,0 +1,224 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+
+from migrate import migrate
+from models import db
+
+# The tables as the first release made them
+BASELINE = (
+    """CREATE TABLE users (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL UNIQUE,
+        password TEXT NOT NULL,
+        email TEXT NOT NULL,
+        secret_question TEXT NOT NULL,
+        secret_answer TEXT NOT NULL,
+        spotify_user_token TEXT,
+        spotify_user_id TEXT
+    )""",
+    """CREATE TABLE bands (
+        id INTEGER PRIMARY KEY,
+        spotify_artist_id TEXT NOT NULL,
+        setlistfm_artist_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        photo TEXT
+    )""",
+    """CREATE TABLE songs (
+        id INTEGER PRIMARY KEY,
+        spotify_song_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        duration INTEGER NOT NULL,
+        band_id INTEGER REFERENCES bands (id)
+    )""",
+    """CREATE TABLE playlists (
+        id INTEGER PRIMARY KEY,
+        spotify_playlist_id TEXT NOT NULL,
+        spotify_playlist_url TEXT NOT NULL,
+        setlistfm_setlist_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        description TEXT NOT NULL,
+        tour_name TEXT,
+        venue_name TEXT,
+        event_date TEXT,
+        venue_loc TEXT,
+        length INTEGER NOT NULL,
+        duration TEXT,
+        band_id INTEGER REFERENCES bands (id)
+    )""",
+    """CREATE TABLE favorites (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER REFERENCES users (id),
+        band_id INTEGER REFERENCES bands (id)
+    )""",
+    """CREATE TABLE users_playlists (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER REFERENCES users (id),
+        playlist_id INTEGER REFERENCES playlists (id)
+    )""",
+    """CREATE TABLE playlists_songs (
+        id INTEGER PRIMARY KEY,
+        playlist_id INTEGER REFERENCES playlists (id),
+        song_id INTEGER REFERENCES songs (id)
+    )""",
+)
+
+ROWS = (
+    "INSERT INTO users VALUES (1, 'user', 'pw', 'user@example.com', 'q', 'a', "
+    "NULL, NULL)",
+    "INSERT INTO bands VALUES (1, 'spotify1', 'mbid1', 'Band', NULL)",
+    "INSERT INTO bands VALUES (2, 'spotify1', 'mbid1', 'Band', NULL)",
+    "INSERT INTO songs VALUES (1, 'track1', 'Song (Live)', 200, 1)",
+    "INSERT INTO songs VALUES (2, 'track2', 'Other Song', 180, 2)",
+    "INSERT INTO favorites VALUES (1, 1, 1)",
+    "INSERT INTO favorites VALUES (2, 1, 2)",
+    "INSERT INTO playlists VALUES (1, 'pending', 'pending', 'setlist', 'Band', "
+    "'Band', NULL, NULL, NULL, NULL, 1, NULL, 2)",
+    "INSERT INTO playlists VALUES (2, 'spotify2', 'https://spotify.test/2', "
+    "'setlist', 'Band', 'Band', NULL, NULL, NULL, NULL, 1, NULL, 1)",
+    "INSERT INTO users_playlists VALUES (1, 1, 1)",
+    "INSERT INTO users_playlists VALUES (2, 1, 2)",
+)
+
+app = Flask(__name__)
+# Each test points it at its own file
+app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+db.init_app(app)
+
+
+class MigrateTestCase(TestCase):
+    """
+    Test bringing a database made by the first release up to the models
+    """
+
+    def setUp(self):
+        """
+        Push a stand-in app on its own empty database
+        """
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + self.path
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        """
+        Pop the app context and remove the database
+        """
+        db.session.remove()
+        db.get_engine(app).dispose()
+        self.ctx.pop()
+        os.remove(self.path)
+
+    def columns(self, table):
+        """
+        Returns the names of a table's columns
+        """
+        return {column["name"] for column in inspect(db.engine).get_columns(table)}
+
+    def test_migrate(self):
+        """
+        TESTS:
+        - Every migration runs on the first release's tables, keeping the rows
+        - Added columns hold their defaults on the existing rows
+        - Duplicate bands are merged into the oldest and duplicate favorites
+          dropped, so the unique constraints hold
+        - Saves written to Spotify get a done Spotify_Copy with their Spotify
+          playlist, saves that never were get none
+        - A second run changes nothing
+        """
+        for statement in BASELINE + ROWS:
+            db.session.execute(text(statement))
+        db.session.commit()
+
+        self.assertEqual(
+            migrate(),
+            [
+                "band_stats",
+                "song_catalog",
+                "unique_favorites",
+                "auto_playlists",
+                "playlist_copies",
+                "spotify_copies",
+            ],
+        )
+
+        self.assertLessEqual(
+            {"stats_setlist_count", "stats_song_total"}, self.columns("bands")
+        )
+        self.assertEqual(
+            [
+                tuple(row)
+                for row in db.session.execute(
+                    text("SELECT stats_setlist_count, stats_song_total FROM bands")
+                )
+            ],
+            [(0, 0)],
+        )
+
+        self.assertLessEqual({"normalized_name", "album_id"}, self.columns("songs"))
+        self.assertEqual(
+            db.session.execute(text("SELECT normalized_name FROM songs ORDER BY id"))
+            .scalars()
+            .all(),
+            ["song", "other song"],
+        )
+        self.assertIn(
+            "ix_songs_band_id_normalized_name",
+            {index["name"] for index in inspect(db.engine).get_indexes("songs")},
+        )
+
+        self.assertFalse(
+            db.session.execute(text("SELECT auto_playlists FROM users")).scalar()
+        )
+        self.assertEqual(
+            [
+                tuple(row)
+                for row in db.session.execute(
+                    text(
+                        "SELECT owner_id, forked_from_id, version, band_id FROM playlists"
+                    )
+                )
+            ],
+            [(None, None, 1, 1), (None, None, 1, 1)],
+        )
+        self.assertEqual(
+            [
+                tuple(row)
+                for row in db.session.execute(
+                    text(
+                        "SELECT playlist_id, user_id, status, spotify_playlist_id, "
+                        "spotify_playlist_url FROM spotify_copies"
+                    )
+                )
+            ],
+            [(2, 1, "done", "spotify2", "https://spotify.test/2")],
+        )
+        self.assertEqual(
+            db.session.execute(text("SELECT band_id FROM songs")).scalars().all(),
+            [1, 1],
+        )
+        self.assertEqual(
+            db.session.execute(text("SELECT id FROM favorites")).scalars().all(),
+            [1],
+        )
+        with self.assertRaises(IntegrityError):
+            db.session.execute(text("INSERT INTO favorites VALUES (3, 1, 1)"))
+        db.session.rollback()
+
+        self.assertEqual(migrate(), [])
+
+    def test_fresh_database(self):
+        """
+        TESTS:
+        - A database with no tables gets them all and needs no migrations
+        """
+        self.assertEqual(migrate(), [])
+        self.assertEqual(
+            set(inspect(db.engine).get_table_names()), set(db.metadata.tables)
+        )
@@ -0,0 +1,110 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+import passwords
+from app import app
+from models import User, db
+from passwords import (
+    Hasher,
+    HashingBusy,
+    check_hash,
+    make_hashes,
+    needs_rehash,
+)
+
+db.create_all()
+
+
+class HasherTestCase(TestCase):
+    """
+    Test hashing passwords in the process pool
+    """
+
+    def test_pool(self):
+        """
+        TESTS:
+        - Hashes made in the pool verify, wrong passwords don't
+        - The queue is empty once the hashes are done
+        """
+        hasher = Hasher(workers=1)
+        hashed, answer = hasher.run("hash", make_hashes, "password", "Banana")
+
+        self.assertTrue(hasher.run("verify", check_hash, hashed, "password"))
+        self.assertFalse(hasher.run("verify", check_hash, hashed, "wrong"))
+        self.assertTrue(hasher.run("verify", check_hash, answer, "Banana"))
+        self.assertEqual(hasher.snapshot()["waiting"], 0)
+        self.assertEqual(hasher.snapshot()["running"], 0)
+
+    def test_busy(self):
+        """
+        TESTS:
+        - Hashes are turned away once the queue is full
+        """
+        hasher = Hasher(workers=1, max_waiting=0)
+        with self.assertRaises(HashingBusy):
+            hasher.run("hash", make_hashes, "password")
+
+    def test_needs_rehash(self):
+        """
+        TESTS:
+        - Hashes made with another bcrypt cost need rehashing
+        - Anything that isn't a bcrypt hash needs rehashing
+        """
+        with patch.object(passwords, "BCRYPT_ROUNDS", 4):
+            [hashed] = make_hashes("password")
+            self.assertFalse(needs_rehash(hashed))
+
+        self.assertTrue(needs_rehash(hashed))
+        self.assertTrue(needs_rehash("$argon2id$v=19$m=65536,t=3,p=1$abc$def"))
+        self.assertFalse(check_hash("not a hash", "password"))
+
+
+class RehashTestCase(TestCase):
+    """
+    Test rehashing passwords on login
+    """
+
+    def setUp(self):
+        """
+        Add a user whose hashes were made with a lower cost
+        """
+        User.query.delete()
+        with patch.object(passwords, "BCRYPT_ROUNDS", 4):
+            password, answer = make_hashes("password", "Banana")
+        db.session.add(
+            User(
+                username="john_doe",
+                password=password,
+                email="test@email.com",
+                secret_question="What's the magic word?",
+                secret_answer=answer,
+            )
+        )
+        db.session.commit()
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions
+        """
+        db.session.rollback()
+
+    def test_rehash_on_login(self):
+        """
+        TESTS:
+        - Logging in rehashes the password to the configured cost
+        - Answering the secret question rehashes the answer
+        - Wrong passwords don't rehash
+        """
+        old = User.query.one().password
+        self.assertFalse(User.authenticate("john_doe", "wrong"))
+        self.assertEqual(User.query.one().password, old)
+
+        user = User.authenticate("john_doe", "password")
+        db.session.commit()
+        self.assertNotEqual(user.password, old)
+        self.assertFalse(needs_rehash(user.password))
+        self.assertTrue(User.authenticate("john_doe", "password"))
+
+        self.assertTrue(User.authenticate_secret_answer("john_doe", "Banana"))
+        db.session.commit()
+        self.assertFalse(needs_rehash(User.query.one().secret_answer))
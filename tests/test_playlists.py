@@ -0,0 +1,233 @@
+import json
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import playlists
+from app import app
+from models import (
+    Band,
+    Playlist,
+    Playlist_Song,
+    Song,
+    Spotify_Copy,
+    User,
+    User_Playlist,
+    db,
+)
+from playlists import (
+    edit_for_user,
+    fill_playlist,
+    playlist_uris,
+    save_to_spotify,
+)
+from upstream import UpstreamUnavailable
+
+db.create_all()
+
+
+class FakeSpotify:
+    """
+    Records what's written to Spotify
+    """
+
+    def __init__(self):
+        self.created = []
+        self.added = []
+        self.replaced = []
+
+    def playlist_create(self, user_id, name, public, description):
+        self.created.append(user_id)
+        res = MagicMock()
+        res.json.return_value = json.dumps(
+            {
+                "id": f"sp-{user_id}-{len(self.created)}",
+                "external_urls": {"spotify": f"https://spotify.test/{user_id}"},
+            }
+        )
+        return res
+
+    def playlist_add(self, playlist_id, uris):
+        self.added.append((playlist_id, uris))
+
+    def playlist_replace(self, playlist_id, uris):
+        self.replaced.append((playlist_id, uris))
+
+
+class SharedPlaylistTestCase(TestCase):
+    """
+    Test saving a shared playlist per user and editing it copy on write
+    """
+
+    def setUp(self):
+        """
+        Push an app context for the app's config, add a shared playlist of
+        three songs and two users
+        """
+        self.ctx = app.app_context()
+        self.ctx.push()
+        for model in (
+            Spotify_Copy,
+            User_Playlist,
+            Playlist_Song,
+            Playlist,
+            Song,
+            User,
+            Band,
+        ):
+            model.query.delete()
+        self.users = [
+            User(
+                username=name,
+                password="password",
+                email=f"{name}@email.com",
+                secret_question="What's the magic word?",
+                secret_answer="Banana",
+                spotify_user_id=name,
+            )
+            for name in ("john_doe", "jane_doe")
+        ]
+        band = Band(spotify_artist_id="band", setlistfm_artist_id="mbid", name="Band")
+        db.session.add_all(self.users + [band])
+        db.session.commit()
+
+        self.songs = [
+            Song(spotify_song_id=name, name=name, duration=60, band_id=band.id)
+            for name in ("a", "b", "c")
+        ]
+        self.playlist = Playlist(
+            setlistfm_setlist_id="setlist",
+            name="Band @ The Venue",
+            description="Band @ The Venue",
+            length=3,
+            duration="3 min",
+            band_id=band.id,
+        )
+        db.session.add_all(self.songs + [self.playlist])
+        db.session.commit()
+        db.session.add_all(
+            [
+                Playlist_Song(playlist_id=self.playlist.id, song_id=song.id)
+                for song in self.songs
+            ]
+        )
+        db.session.commit()
+        self.spotify = FakeSpotify()
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions
+        """
+        db.session.rollback()
+        self.ctx.pop()
+
+    def test_save_to_spotify(self):
+        """
+        TESTS:
+        - Each user gets their own Spotify playlist, the shared one isn't
+          written to
+        - Saving again returns the Spotify playlist already written
+        """
+        john, jane = self.users
+        johns = save_to_spotify(self.spotify, john, self.playlist)
+        janes = save_to_spotify(self.spotify, jane, self.playlist)
+
+        self.assertEqual(johns.spotify_playlist_id, "sp-john_doe-1")
+        self.assertEqual(janes.spotify_playlist_id, "sp-jane_doe-2")
+        self.assertEqual(self.playlist.spotify_playlist_id, "pending")
+        self.assertEqual(
+            self.spotify.added[0][1],
+            ["spotify:track:a", "spotify:track:b", "spotify:track:c"],
+        )
+
+        self.assertEqual(
+            save_to_spotify(self.spotify, john, self.playlist).id, johns.id
+        )
+        self.assertEqual(len(self.spotify.created), 2)
+        self.assertEqual(User_Playlist.query.count(), 2)
+
+    def test_edit_copy_on_write(self):
+        """
+        TESTS:
+        - The first edit gives the user their own copy and moves their Spotify
+          playlist onto it, which is updated
+        - Other users keep the shared playlist
+        - Later edits change the same copy and bump its version, new songs
+          can't be added
+        """
+        john, jane = self.users
+        a, b, c = self.songs
+        johns = save_to_spotify(self.spotify, john, self.playlist)
+        save_to_spotify(self.spotify, jane, self.playlist)
+
+        fork = edit_for_user(self.spotify, john, self.playlist, [c.id, a.id])
+
+        self.assertNotEqual(fork.id, self.playlist.id)
+        self.assertEqual(fork.forked_from_id, self.playlist.id)
+        self.assertEqual(fork.length, 2)
+        self.assertEqual(playlist_uris(fork.id), ["spotify:track:c", "spotify:track:a"])
+        self.assertEqual(len(playlist_uris(self.playlist.id)), 3)
+        self.assertEqual(
+            self.spotify.replaced,
+            [("sp-john_doe-1", ["spotify:track:c", "spotify:track:a"])],
+        )
+        self.assertEqual(Spotify_Copy.query.get(johns.id).playlist_id, fork.id)
+        self.assertEqual(
+            Spotify_Copy.query.filter_by(user_id=jane.id).one().playlist_id,
+            self.playlist.id,
+        )
+
+        version = fork.version
+        again = edit_for_user(self.spotify, john, self.playlist, [a.id, c.id])
+        self.assertEqual(again.id, fork.id)
+        self.assertEqual(again.version, version + 1)
+        self.assertEqual(Playlist.query.count(), 2)
+        self.assertEqual(
+            save_to_spotify(self.spotify, john, self.playlist).id, johns.id
+        )
+
+        with self.assertRaises(ValueError):
+            edit_for_user(self.spotify, john, self.playlist, [a.id, b.id])
+
+    def test_fill_playlist(self):
+        """
+        TESTS:
+        - Songs already found on Spotify are added in order without searching,
+          reusing their Song rows
+        - A failed search leaves no playlist behind
+        """
+        band = self.playlist.band
+        tracks = [
+            {"id": "c", "name": "c", "duration_ms": 60000},
+            {"id": "d", "name": "d", "duration_ms": 90000},
+        ]
+        hype = Playlist(
+            setlistfm_setlist_id="Hype",
+            name="Band Hype-Up",
+            description="Band Hype-Up",
+            length=0,
+            band_id=band.id,
+        )
+        with patch.object(playlists, "find_tracks", side_effect=AssertionError):
+            fill_playlist(
+                self.spotify, band, hype, [{"name": "c"}, {"name": "d"}], tracks
+            )
+            db.session.commit()
+
+        self.assertEqual(playlist_uris(hype.id), ["spotify:track:c", "spotify:track:d"])
+        self.assertEqual((hype.length, hype.duration), (2, "2min. 30sec."))
+        self.assertEqual(Song.query.count(), 4)
+
+        failed = Playlist(
+            setlistfm_setlist_id="setlist2",
+            name="Band @ The Venue",
+            description="Band @ The Venue",
+            length=0,
+            band_id=band.id,
+        )
+        with patch.object(
+            playlists, "find_tracks", side_effect=UpstreamUnavailable("spotify")
+        ):
+            with self.assertRaises(UpstreamUnavailable):
+                fill_playlist(self.spotify, band, failed, [{"name": "e"}])
+            db.session.commit()
+        self.assertEqual(Playlist.query.count(), 2)
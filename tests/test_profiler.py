@@ -0,0 +1,120 @@
+import contextvars
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+from profiler import (
+    Profile,
+    ProfileStore,
+    Sampler,
+    current_profile,
+    request_params,
+    track,
+)
+
+app = Flask(__name__)
+
+
+def busy_until(deadline):
+    """
+    Keeps a thread busy for the sampler to find
+    """
+    while time.time() < deadline:
+        sum(range(1000))
+
+
+class ProfilerTestCase(TestCase):
+    """
+    Test stack sampling and saved profiles
+    """
+
+    def setUp(self):
+        """
+        Use a fresh profile file for every test
+        """
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.store = ProfileStore(self.path, max_keep=2)
+
+    def tearDown(self):
+        """
+        Remove the profile file
+        """
+        os.remove(self.path)
+
+    def test_samples_tracked_threads(self):
+        """
+        TESTS:
+        - Threads working on the profiled request are sampled as folded stacks
+        - Threads outside a track() block aren't
+        """
+        sampler = Sampler(interval=0.005)
+        profile = Profile()
+        token = current_profile.set(profile)
+
+        def tracked():
+            with track():
+                busy_until(time.time() + 0.2)
+
+        # Copies the request's context like asyncio.to_thread does
+        thread = threading.Thread(
+            target=contextvars.copy_context().run, args=(tracked,)
+        )
+        untracked = threading.Thread(target=busy_until, args=(time.time() + 0.2,))
+        sampler.start(profile)
+        thread.start()
+        untracked.start()
+        thread.join()
+        untracked.join()
+        sampler.stop(profile)
+        current_profile.reset(token)
+
+        folded = profile.folded()
+        self.assertGreater(profile.samples(), 0)
+        self.assertIn("test_profiler:tracked;test_profiler:busy_until", folded)
+        self.assertNotIn("threading:run;test_profiler:busy_until", folded)
+
+    def test_store(self):
+        """
+        TESTS:
+        - Saved profiles keep their route, params, stacks and timeline
+        - Only the newest max_keep profiles are kept
+        """
+        profile = Profile()
+        profile.stacks["app:create_playlist;upstream:fetch"] = 3
+        profile.record("upstream", "spotify miss", profile.started, 1.5)
+
+        ids = [
+            self.store.save(
+                profile,
+                "create_playlist",
+                "POST",
+                "/playlist/create/a/b",
+                {"view_args": {"band_id": "a", "setlist_id": "b"}},
+                31.2,
+            )
+            for _ in range(3)
+        ]
+
+        self.assertEqual([row["id"] for row in self.store.list()], ids[:0:-1])
+        self.assertIsNone(self.store.get(ids[0]))
+
+        saved = self.store.get(ids[-1])
+        self.assertEqual(saved["endpoint"], "create_playlist")
+        self.assertEqual(saved["params"]["view_args"]["setlist_id"], "b")
+        self.assertEqual(saved["folded"], "app:create_playlist;upstream:fetch 3")
+        self.assertEqual(saved["timeline"][0]["ms"], 1500)
+
+    def test_request_params(self):
+        """
+        TESTS:
+        - Only the names of query args are kept, never values like OAuth codes
+        """
+        with app.test_request_context("/callback?state=xyz&code=secret"):
+            self.assertEqual(
+                request_params(), {"view_args": {}, "args": ["code", "state"]}
+            )
@@ -0,0 +1,87 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import ratelimit
+from metrics import MetricsStore
+from ratelimit import BACKGROUND, INTERACTIVE, Governor, RateLimitExceeded
+
+
+class GovernorTestCase(TestCase):
+    """
+    Test the shared token bucket governor
+    """
+
+    def setUp(self):
+        """
+        Use a fresh bucket file and metrics file for every test
+        """
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.governor = Governor(self.path, {"api": (1.0, 4)})
+        fd, self.metrics_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.store = MetricsStore(self.metrics_path, flush_interval=60)
+        self.patcher = patch.object(ratelimit.metrics, "store", self.store)
+        self.patcher.start()
+
+    def tearDown(self):
+        """
+        Restore the metrics store and remove the files
+        """
+        self.patcher.stop()
+        os.remove(self.path)
+        os.remove(self.metrics_path)
+
+    def test_burst_then_reject(self):
+        """
+        TESTS:
+        - The full bucket can be used in a burst
+        - Requests past the deadline are rejected, both are counted in the
+          metrics
+        """
+        for _ in range(4):
+            self.governor.acquire("api", INTERACTIVE, deadline=0)
+
+        with self.assertRaises(RateLimitExceeded):
+            self.governor.acquire("api", INTERACTIVE, deadline=0)
+
+        lines = self.store.render().splitlines()
+        self.assertIn(
+            'setplaylist_rate_limit_total{api="api",priority="interactive",'
+            'result="acquired"} 4.0',
+            lines,
+        )
+        self.assertIn(
+            'setplaylist_rate_limit_total{api="api",priority="interactive",'
+            'result="rejected"} 1.0',
+            lines,
+        )
+
+    def test_background_leaves_reserve(self):
+        """
+        TESTS:
+        - Background requests stop at the interactive reserve
+        - Interactive requests can still use the reserve
+        """
+        self.governor.acquire("api", BACKGROUND, deadline=0)
+        self.governor.acquire("api", BACKGROUND, deadline=0)
+
+        with self.assertRaises(RateLimitExceeded):
+            self.governor.acquire("api", BACKGROUND, deadline=0)
+
+        self.governor.acquire("api", INTERACTIVE, deadline=0)
+
+    def test_shared_between_instances(self):
+        """
+        TESTS:
+        - Separate governors on the same file share one bucket
+        """
+        other = Governor(self.path, {"api": (1.0, 4)})
+        for _ in range(2):
+            self.governor.acquire("api", INTERACTIVE, deadline=0)
+            other.acquire("api", INTERACTIVE, deadline=0)
+
+        with self.assertRaises(RateLimitExceeded):
+            other.acquire("api", INTERACTIVE, deadline=0)
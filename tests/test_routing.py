@@ -0,0 +1,148 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from flask import session
+
+from app import app
+from models import Band, db
+from routing import (
+    REPLICA_BIND,
+    STICKY_KEY,
+    read_primary,
+    remember_write,
+    replica_reads,
+    shared_writes,
+)
+
+db.create_all()
+
+
+@replica_reads
+def read_only_view():
+    """
+    Stand-in for a read-only view
+    """
+    return Band.query.one().name
+
+
+def plain_view():
+    """
+    Stand-in for a view that isn't marked read-only
+    """
+    return Band.query.one().name
+
+
+class RoutingTestCase(TestCase):
+    """
+    Test routing read-only views to the replica, a second database stands in
+    for the replica
+    """
+
+    def setUp(self):
+        """
+        Add a band with a different name to the primary and the replica
+        """
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        app.config["SQLALCHEMY_BINDS"] = {REPLICA_BIND: f"sqlite:///{self.path}"}
+        self.replica = db.get_engine(app, bind=REPLICA_BIND)
+        db.Model.metadata.create_all(self.replica)
+
+        Band.query.delete()
+        db.session.add(
+            Band(
+                spotify_artist_id="spotifyID",
+                setlistfm_artist_id="anotherID",
+                name="Primary Band",
+                photo="Not Today",
+            )
+        )
+        db.session.commit()
+
+        with self.replica.begin() as conn:
+            conn.execute(
+                Band.__table__.insert(),
+                {
+                    "spotify_artist_id": "spotifyID",
+                    "setlistfm_artist_id": "anotherID",
+                    "name": "Replica Band",
+                    "photo": "Not Today",
+                },
+            )
+
+    def tearDown(self):
+        """
+        Drop the replica and clean up data
+        """
+        app.config.pop("SQLALCHEMY_BINDS")
+        self.replica.dispose()
+        os.remove(self.path)
+        db.session.rollback()
+        Band.query.delete()
+        db.session.commit()
+
+    def test_read_only_view_uses_replica(self):
+        """
+        TESTS:
+        - Read-only GET views read from the replica
+        - Other views and other methods read from the primary
+        """
+        with app.app_context(), app.test_request_context():
+            self.assertEqual(read_only_view(), "Replica Band")
+
+        with app.app_context(), app.test_request_context():
+            self.assertEqual(plain_view(), "Primary Band")
+
+        with app.app_context(), app.test_request_context(method="POST"):
+            self.assertEqual(read_only_view(), "Primary Band")
+
+    def test_read_your_writes(self):
+        """
+        TESTS:
+        - Reads after a write in the same request go to the primary
+        - The write starts the sticky window for the user's next requests
+        - Users in the sticky window read from the primary
+        """
+        with app.app_context(), app.test_request_context():
+            band = Band.query.one()
+            band.photo = "Today"
+            db.session.commit()
+            self.assertEqual(read_only_view(), "Primary Band")
+
+            remember_write(None)
+            self.assertGreater(session[STICKY_KEY], time.time())
+
+        with app.app_context(), app.test_request_context():
+            session[STICKY_KEY] = time.time() + 10
+            self.assertEqual(read_only_view(), "Primary Band")
+
+    def test_read_primary(self):
+        """
+        TESTS:
+        - read_primary sends the request's reads to the primary
+        - It doesn't start the sticky window
+        """
+        with app.app_context(), app.test_request_context():
+            read_primary()
+            self.assertEqual(read_only_view(), "Primary Band")
+
+            remember_write(None)
+            self.assertNotIn(STICKY_KEY, session)
+
+    def test_shared_writes(self):
+        """
+        TESTS:
+        - Writes inside shared_writes send the rest of the request to the
+          primary but don't start the sticky window
+        """
+        with app.app_context(), app.test_request_context():
+            with shared_writes():
+                band = Band.query.one()
+                band.photo = "Today"
+                db.session.commit()
+            self.assertEqual(read_only_view(), "Primary Band")
+
+            remember_write(None)
+            self.assertNotIn(STICKY_KEY, session)
@@ -0,0 +1,165 @@
+import random
+from collections import Counter
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app
+from models import (
+    Album,
+    Band,
+    Favorite,
+    Playlist,
+    Playlist_Song,
+    Song,
+    Spotify_Copy,
+    User,
+    User_Playlist,
+    db,
+)
+from seed import BatchLoader, generate, zipf_rank
+
+db.create_all()
+
+SIZES = dict(
+    users=60,
+    bands=30,
+    songs_per_band=10,
+    playlists=300,
+    songs_per_playlist=8,
+    seed=7,
+    batch_rows=50,
+)
+
+
+def clear_tables():
+    """
+    Deletes every row the generator writes to
+    """
+    for model in (
+        Spotify_Copy,
+        User_Playlist,
+        Favorite,
+        Playlist_Song,
+        Playlist,
+        Song,
+        Album,
+        User,
+        Band,
+    ):
+        model.query.delete()
+    db.session.commit()
+
+
+class SeedTestCase(TestCase):
+    """
+    Test generating a synthetic data set
+    """
+
+    def setUp(self):
+        """
+        Start from empty tables
+        """
+        clear_tables()
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions and the generated rows
+        """
+        db.session.rollback()
+        clear_tables()
+
+    def test_zipf_rank(self):
+        """
+        TESTS:
+        - Ranks stay between 1 and n and the first ranks are drawn most
+        """
+        rng = random.Random(1)
+        for skew in (0.8, 1, 1.5):
+            ranks = Counter(zipf_rank(rng, 50, skew) for _ in range(5000))
+            self.assertTrue(set(ranks) <= set(range(1, 51)))
+            self.assertGreater(ranks[1], ranks[10])
+            self.assertGreater(ranks[10], ranks[50])
+
+    def test_batch_loader(self):
+        """
+        TESTS:
+        - Rows are loaded as batches fill, a child's parents are loaded
+          first
+        """
+        bands = BatchLoader(Band, batch_rows=5)
+        songs = BatchLoader(Song, batch_rows=2, parents=[bands])
+        bands.add(dict(id=1, spotify_artist_id="a", setlistfm_artist_id="m", name="A"))
+        for n in range(3):
+            songs.add(
+                dict(id=n + 1, spotify_song_id=f"s{n}", name="S", duration=1, band_id=1)
+            )
+
+        self.assertEqual((bands.count, songs.count), (1, 2))
+        self.assertEqual(len(songs.rows), 1)
+        songs.flush()
+        self.assertEqual(Song.query.count(), 3)
+
+    def test_generate(self):
+        """
+        TESTS:
+        - The requested rows are written with every reference intact
+        - Popular bands get far more playlists than most
+        - The same seed gives the same data, a second run adds after it
+        """
+        counts = generate(**SIZES)
+
+        self.assertEqual(counts["users"], 60)
+        self.assertEqual(counts["bands"], 30)
+        self.assertEqual(counts["songs"], 300)
+        self.assertEqual(counts["playlists"], 300)
+        self.assertEqual(Playlist_Song.query.count(), counts["playlists_songs"])
+        self.assertEqual(Favorite.query.count(), counts["favorites"])
+        self.assertEqual(User_Playlist.query.count(), counts["users_playlists"])
+
+        playlist_ids = {p.id for p in Playlist.query}
+        for link in Playlist_Song.query:
+            song = Song.query.get(link.song_id)
+            self.assertIn(link.playlist_id, playlist_ids)
+            self.assertEqual(song.band_id, Playlist.query.get(link.playlist_id).band_id)
+        for favorite in Favorite.query:
+            self.assertIsNotNone(User.query.get(favorite.user_id))
+            self.assertIsNotNone(Band.query.get(favorite.band_id))
+
+        per_band = sorted(Counter(p.band_id for p in Playlist.query).values())
+        self.assertGreater(per_band[-1], 5 * per_band[len(per_band) // 2])
+
+        lengths = [p.length for p in Playlist.query.order_by(Playlist.id)]
+        self.assertTrue(
+            User.authenticate(User.query.first().username, "syntheticpassword")
+        )
+
+        again = generate(**SIZES)
+        self.assertEqual(again, counts)
+        self.assertEqual(Playlist.query.count(), 600)
+        added = Playlist.query.order_by(Playlist.id).offset(300)
+        self.assertEqual([p.length for p in added], lengths)
+
+    def test_generate_loads_parents_first(self):
+        """
+        TESTS:
+        - With foreign keys enforced, no batch references a row still
+          buffered, even with far more users than bands
+        """
+
+        def enforce_foreign_keys(connection, record):
+            connection.execute("PRAGMA foreign_keys=ON")
+
+        db.session.remove()
+        db.engine.dispose()
+        event.listen(db.engine, "connect", enforce_foreign_keys)
+        try:
+            counts = generate(
+                users=300, bands=50, songs_per_band=1, playlists=10, batch_rows=100
+            )
+        finally:
+            db.session.remove()
+            event.remove(db.engine, "connect", enforce_foreign_keys)
+            db.engine.dispose()
+
+        self.assertEqual(Favorite.query.count(), counts["favorites"])
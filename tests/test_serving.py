@@ -0,0 +1,70 @@
+import asyncio
+import os
+import runpy
+import threading
+import time
+import urllib.request
+from unittest import TestCase
+
+from flask import Flask
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+
+app = Flask(__name__)
+
+
+@app.route("/slow")
+async def slow():
+    """
+    Stand-in for an async view waiting on an upstream API in a thread
+    """
+    await asyncio.to_thread(time.sleep, 0.5)
+    return "Slow"
+
+
+class ServingTestCase(TestCase):
+    """
+    Test the async views are served concurrently
+    """
+
+    def test_gunicorn_config(self):
+        """
+        TESTS:
+        - The Procfile's gunicorn config uses threaded workers
+        """
+        config = runpy.run_path(os.path.join(ROOT, "gunicorn.conf.py"))
+        self.assertEqual(config["worker_class"], "gthread")
+        self.assertGreaterEqual(config["threads"], 4)
+        with open(os.path.join(ROOT, "Procfile")) as f:
+            self.assertIn("-c gunicorn.conf.py", f.read())
+
+    def test_concurrent_async_views(self):
+        """
+        TESTS:
+        - Slow async views served by a threaded WSGI server overlap, four
+          take about as long as one
+        """
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = f"http://127.0.0.1:{server.server_port}/slow"
+        bodies = []
+
+        def get():
+            with urllib.request.urlopen(url) as res:
+                bodies.append(res.read())
+
+        try:
+            started = time.perf_counter()
+            clients = [threading.Thread(target=get) for _ in range(4)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            server.shutdown()
+
+        self.assertEqual(bodies, [b"Slow"] * 4)
+        self.assertLess(elapsed, 1.2)
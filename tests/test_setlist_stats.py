@@ -0,0 +1,153 @@
+from unittest import TestCase
+
+from app import app
+from models import Band, Setlist, Song_Stat, db
+from setlist_stats import (
+    cache_setlists,
+    extract_songs,
+    predicted_id,
+    predicted_setlist,
+    refresh_song_stats,
+)
+
+db.create_all()
+
+
+def make_setlist(setlist_id, songs):
+    """
+    Builds a Setlist.fm style setlist with the given song names
+    """
+    return {
+        "id": setlist_id,
+        "eventDate": "01-01-2021",
+        "sets": {"set": [{"song": [{"name": name} for name in songs]}]},
+    }
+
+
+class SetlistStatsTestCase(TestCase):
+    """
+    Test song statistics across a band's setlists
+    """
+
+    def setUp(self):
+        """
+        Clean up data
+        """
+        Song_Stat.query.delete()
+        Setlist.query.delete()
+        Band.query.delete()
+
+        band = Band(
+            spotify_artist_id="spotifyID",
+            setlistfm_artist_id="anotherID",
+            name="THE Band",
+            photo="Not Today",
+        )
+        db.session.add(band)
+        db.session.commit()
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions and stats data
+        """
+        db.session.rollback()
+        Song_Stat.query.delete()
+        Setlist.query.delete()
+        db.session.commit()
+
+    def test_extract_songs(self):
+        """
+        TESTS:
+        - Tapes, blank names and repeats are skipped
+        """
+        setlist = make_setlist("a", ["Intro", "One", "", "Two", "One"])
+        setlist["sets"]["set"][0]["song"][0]["tape"] = True
+
+        self.assertEqual(extract_songs(setlist), ["One", "Two"])
+        self.assertEqual(extract_songs({}), [])
+
+    def test_refresh_is_incremental(self):
+        """
+        TESTS:
+        - Only uncounted setlists are added to the stats
+        - Cached setlists are not cached twice
+        """
+        band = Band.query.filter_by(name="THE Band").first()
+
+        cache_setlists(band, [make_setlist("a", ["One", "Two", "Three"])])
+        db.session.commit()
+        self.assertEqual(refresh_song_stats(band), 1)
+        self.assertEqual(refresh_song_stats(band), 0)
+
+        new = cache_setlists(
+            band,
+            [
+                make_setlist("a", ["One", "Two", "Three"]),
+                make_setlist("b", ["One", "Three", "Two"]),
+            ],
+        )
+        db.session.commit()
+        self.assertEqual(len(new), 1)
+        self.assertEqual(refresh_song_stats(band), 1)
+
+        one = Song_Stat.query.filter_by(band_id=band.id, name="One").first()
+        three = Song_Stat.query.filter_by(band_id=band.id, name="Three").first()
+        self.assertEqual(one.plays, 2)
+        self.assertEqual(one.openers, 2)
+        self.assertEqual(three.closers, 1)
+        self.assertEqual(band.stats_setlist_count, 2)
+
+    def test_refresh_adds_to_stored_stats(self):
+        """
+        TESTS:
+        - A song another request already stored stats for is added to, not
+          inserted again
+        """
+        band = Band.query.filter_by(name="THE Band").first()
+        db.session.add(
+            Song_Stat(
+                band_id=band.id,
+                name="One",
+                plays=3,
+                position_total=0.5,
+                openers=1,
+                closers=0,
+            )
+        )
+        cache_setlists(band, [make_setlist("a", ["One", "Two"])])
+        db.session.commit()
+
+        self.assertEqual(refresh_song_stats(band), 1)
+        one = Song_Stat.query.filter_by(band_id=band.id, name="One").one()
+        two = Song_Stat.query.filter_by(band_id=band.id, name="Two").one()
+        self.assertEqual((one.plays, one.openers, one.position_total), (4, 2, 0.5))
+        self.assertEqual((two.plays, two.closers, two.position_total), (1, 1, 1.0))
+
+    def test_predicted_setlist(self):
+        """
+        TESTS:
+        - Predicted setlist uses the most played songs
+        - Opener and closer are placed at the ends
+        - Counting new setlists changes the predicted playlist's id, so it's
+          rebuilt from the new stats
+        """
+        band = Band.query.filter_by(name="THE Band").first()
+
+        cache_setlists(
+            band,
+            [
+                make_setlist("a", ["One", "Two", "Three"]),
+                make_setlist("b", ["One", "Four", "Three"]),
+                make_setlist("c", ["One", "Two", "Three"]),
+            ],
+        )
+        db.session.commit()
+        refresh_song_stats(band)
+
+        self.assertEqual(predicted_setlist(band), ["One", "Two", "Three"])
+        self.assertEqual(predicted_id(band), "Predicted:3")
+
+        cache_setlists(band, [make_setlist("d", ["Four", "Four", "One"])])
+        db.session.commit()
+        refresh_song_stats(band)
+        self.assertEqual(predicted_id(band), "Predicted:4")
@@ -0,0 +1,136 @@
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+import shows
+from app import app
+from models import Band, Event, Favorite, User, User_Upcoming, db
+from shows import sweep, user_upcoming
+from upstream import UpstreamUnavailable
+
+db.create_all()
+
+NOW = datetime(2030, 1, 1)
+
+
+def event(event_id, date, venue="The Venue"):
+    """
+    Returns an event shaped like Bandsintown's
+    """
+    return {
+        "id": event_id,
+        "datetime": f"{date}T20:00:00",
+        "url": f"https://bandsintown.test/e/{event_id}",
+        "venue": {"name": venue, "location": "Seattle, WA"},
+    }
+
+
+class ShowsSweepTestCase(TestCase):
+    """
+    Test the upcoming shows sweep and the users' lists
+    """
+
+    def setUp(self):
+        """
+        Add two users sharing a favorite, and a band nobody favorites
+        """
+        for model in (User_Upcoming, Event, Favorite, User, Band):
+            model.query.delete()
+        self.users = [
+            User(
+                username=name,
+                password="password",
+                email=f"{name}@email.com",
+                secret_question="What's the magic word?",
+                secret_answer="Banana",
+            )
+            for name in ("john_doe", "jane_doe")
+        ]
+        self.bands = [
+            Band(spotify_artist_id=name, setlistfm_artist_id=name, name=name.title())
+            for name in ("shared", "solo", "unloved")
+        ]
+        db.session.add_all(self.users + self.bands)
+        db.session.commit()
+        john, jane = self.users
+        shared, solo, _ = self.bands
+        db.session.add_all(
+            [
+                Favorite(user_id=john.id, band_id=shared.id),
+                Favorite(user_id=jane.id, band_id=shared.id),
+                Favorite(user_id=john.id, band_id=solo.id),
+            ]
+        )
+        db.session.commit()
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions
+        """
+        db.session.rollback()
+
+    def test_sweep(self):
+        """
+        TESTS:
+        - Each favorited band is fetched once however many users favorite it
+        - Past events are dropped and each user's list is soonest first
+        """
+        events = {
+            "Shared": [event(1, "2030-03-01"), event(2, "2029-06-01")],
+            "Solo": [event(3, "2030-02-01")],
+        }
+        fetched = []
+
+        def fetch(path):
+            fetched.append(path)
+            return events[path.split("/")[2]]
+
+        with patch.object(shows, "bandsintown_get", side_effect=fetch):
+            counts = sweep(NOW)
+
+        self.assertEqual(
+            sorted(fetched), ["/artists/Shared/events/", "/artists/Solo/events/"]
+        )
+        self.assertEqual(counts, {"bands": 2, "failed": 0, "events": 3, "users": 2})
+        self.assertEqual(Event.query.count(), 2)
+
+        john, jane = self.users
+        self.assertEqual(
+            [show["band"] for show in user_upcoming(john.id, NOW)], ["Solo", "Shared"]
+        )
+        self.assertEqual(
+            user_upcoming(jane.id, NOW),
+            [
+                {
+                    "band": "Shared",
+                    "band_id": "shared",
+                    "date": "2030-03-01T20:00:00",
+                    "venue": "The Venue",
+                    "location": "Seattle, WA",
+                    "url": "https://bandsintown.test/e/1",
+                }
+            ],
+        )
+
+    def test_failed_fetch(self):
+        """
+        TESTS:
+        - Bands that can't be fetched keep their stored events
+        - Users whose bands have no shows left lose their list
+        """
+        with patch.object(
+            shows, "bandsintown_get", return_value=[event(1, "2030-03-01")]
+        ):
+            sweep(NOW)
+
+        with patch.object(
+            shows, "bandsintown_get", side_effect=UpstreamUnavailable("bandsintown")
+        ):
+            counts = sweep(NOW)
+        self.assertEqual(counts["failed"], 2)
+        self.assertEqual(Event.query.count(), 2)
+
+        with patch.object(shows, "bandsintown_get", return_value=[]):
+            sweep(NOW)
+        self.assertEqual(Event.query.count(), 0)
+        self.assertEqual(User_Upcoming.query.count(), 0)
@@ -0,0 +1,278 @@
+import json
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import playlists
+import subscriptions
+from app import app
+from models import (
+    Band,
+    Favorite,
+    Playlist,
+    Playlist_Song,
+    Song,
+    Spotify_Copy,
+    User,
+    User_Playlist,
+    db,
+)
+from playlists import save_to_spotify
+from subscriptions import run
+
+db.create_all()
+
+TODAY = datetime(2030, 1, 10)
+
+
+def setlist(setlist_id, date, songs):
+    """
+    Returns a setlist shaped like Setlist.fm's
+    """
+    return {
+        "id": setlist_id,
+        "eventDate": date,
+        "venue": {"name": "The Venue", "city": {"name": "Seattle", "state": "WA"}},
+        "tour": {"name": "The Tour"},
+        "sets": {"set": [{"song": [{"name": name} for name in songs]}]},
+    }
+
+
+def track(name):
+    """
+    Returns a track shaped like Spotify's
+    """
+    return {"id": f"id-{name}", "name": name, "duration_ms": 180000}
+
+
+class FakeSpotify:
+    """
+    Records the playlists written to Spotify, failing for some users
+    """
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.created = []
+        self.added = []
+        self.token = None
+
+    @contextmanager
+    def token_as(self, token):
+        self.token = token
+        yield
+
+    def playlist_create(self, user_id, name, public, description):
+        if user_id in self.failing:
+            raise RuntimeError("Spotify is down")
+        self.created.append(user_id)
+        res = MagicMock()
+        res.json.return_value = json.dumps(
+            {
+                "id": f"sp-{user_id}",
+                "external_urls": {"spotify": f"https://spotify.test/{user_id}"},
+            }
+        )
+        return res
+
+    def playlist_add(self, playlist_id, uris):
+        self.added.append((playlist_id, uris))
+
+
+class SubscriptionsTestCase(TestCase):
+    """
+    Test building playlists of new setlists and saving them to Spotify
+    """
+
+    def setUp(self):
+        """
+        Push an app context for the app's config, add two subscribers and a
+        user who hasn't subscribed, all favoriting the same band
+        """
+        self.ctx = app.app_context()
+        self.ctx.push()
+        for model in (
+            Spotify_Copy,
+            User_Playlist,
+            Playlist_Song,
+            Playlist,
+            Song,
+            Favorite,
+            User,
+            Band,
+        ):
+            model.query.delete()
+        self.users = [
+            User(
+                username=name,
+                password="password",
+                email=f"{name}@email.com",
+                secret_question="What's the magic word?",
+                secret_answer="Banana",
+                spotify_user_token="refresh",
+                spotify_user_id=name,
+                auto_playlists=name != "jim_doe",
+            )
+            for name in ("john_doe", "jane_doe", "jim_doe")
+        ]
+        self.band = Band(
+            spotify_artist_id="band", setlistfm_artist_id="mbid", name="Band"
+        )
+        db.session.add_all(self.users + [self.band])
+        db.session.commit()
+        db.session.add_all(
+            [Favorite(user_id=user.id, band_id=self.band.id) for user in self.users]
+        )
+        db.session.commit()
+
+        self.cred = MagicMock()
+        self.cred.refresh_user_token.return_value = "token"
+        self.setlists = {
+            "setlist": [
+                setlist("new", "08-01-2030", ["One", "Two"]),
+                setlist("old", "08-12-2029", ["One"]),
+                setlist("empty", "09-01-2030", []),
+            ]
+        }
+
+    def tearDown(self):
+        """
+        Clean up any failed transactions
+        """
+        db.session.rollback()
+        self.ctx.pop()
+
+    def run_subscriptions(self, spotify):
+        """
+        Runs the engine against the fake Setlist.fm setlists and Spotify search
+        """
+        with patch.object(
+            subscriptions, "setlistfm_get", return_value=self.setlists
+        ), patch.object(
+            playlists,
+            "find_tracks",
+            side_effect=lambda sp, song, band: [track(song["name"])],
+        ):
+            return run(spotify, self.cred, TODAY)
+
+    def add_playlist(self):
+        """
+        Adds the shared playlist of the new setlist, as a user saving it would
+        """
+        playlist = Playlist(
+            spotify_playlist_id="None Yet",
+            setlistfm_setlist_id="new",
+            name="Band",
+            description="Band",
+            length=0,
+            band_id=self.band.id,
+        )
+        db.session.add(playlist)
+        db.session.commit()
+        return playlist
+
+    def test_run(self):
+        """
+        TESTS:
+        - Only recent setlists with songs are built, once for all subscribers
+        - Each subscriber gets it in their Spotify, the others don't
+        - Running again doesn't build or write anything twice
+        """
+        spotify = FakeSpotify()
+        counts = self.run_subscriptions(spotify)
+
+        self.assertEqual(
+            counts, {"bands": 1, "playlists": 1, "queued": 2, "delivered": 2}
+        )
+        playlist = Playlist.query.one()
+        self.assertEqual(playlist.setlistfm_setlist_id, "new")
+        self.assertEqual(playlist.length, 2)
+        self.assertEqual(sorted(spotify.created), ["jane_doe", "john_doe"])
+        self.assertEqual(
+            spotify.added[0][1], ["spotify:track:id-One", "spotify:track:id-Two"]
+        )
+        self.assertEqual(
+            sorted(
+                (copy.user.username, copy.status, copy.spotify_playlist_id)
+                for copy in Spotify_Copy.query
+            ),
+            [("jane_doe", "done", "sp-jane_doe"), ("john_doe", "done", "sp-john_doe")],
+        )
+        self.assertEqual(User_Playlist.query.count(), 2)
+
+        counts = self.run_subscriptions(spotify)
+        self.assertEqual(
+            counts, {"bands": 1, "playlists": 0, "queued": 0, "delivered": 0}
+        )
+        self.assertEqual(len(spotify.created), 2)
+
+    def test_already_built(self):
+        """
+        TESTS:
+        - A setlist whose shared playlist was already built, by a user saving
+          it, isn't built again but is still queued for the subscribers
+        - Subscribers who already saved it aren't queued
+        """
+        playlist = self.add_playlist()
+        db.session.add(
+            Spotify_Copy(
+                playlist_id=playlist.id, user_id=self.users[0].id, status="done"
+            )
+        )
+        db.session.commit()
+
+        spotify = FakeSpotify()
+        counts = self.run_subscriptions(spotify)
+
+        self.assertEqual(
+            counts, {"bands": 1, "playlists": 0, "queued": 1, "delivered": 1}
+        )
+        self.assertEqual(Playlist.query.count(), 1)
+        self.assertEqual(spotify.created, ["jane_doe"])
+
+    def test_interactive_saves(self):
+        """
+        TESTS:
+        - A user's own save that failed is marked failed and not delivered
+        - A user who already has the playlist in their playlists doesn't get it
+          added twice
+        """
+        playlist = self.add_playlist()
+        with self.assertRaises(RuntimeError):
+            save_to_spotify(FakeSpotify(failing=("john_doe",)), self.users[0], playlist)
+        db.session.add(User_Playlist(user_id=self.users[1].id, playlist_id=playlist.id))
+        db.session.commit()
+
+        spotify = FakeSpotify()
+        counts = self.run_subscriptions(spotify)
+
+        self.assertEqual(counts["delivered"], 1)
+        self.assertEqual(spotify.created, ["jane_doe"])
+        self.assertEqual(
+            Spotify_Copy.query.filter_by(user_id=self.users[0].id).one().status,
+            "failed",
+        )
+        self.assertEqual(
+            User_Playlist.query.filter_by(user_id=self.users[1].id).count(), 1
+        )
+
+    def test_failed_delivery(self):
+        """
+        TESTS:
+        - A failed write stays queued with its error and is retried next run
+        - It's given up on after MAX_ATTEMPTS
+        """
+        spotify = FakeSpotify(failing=("jane_doe",))
+        with patch.object(subscriptions, "MAX_ATTEMPTS", 2):
+            counts = self.run_subscriptions(spotify)
+            self.assertEqual(counts["delivered"], 1)
+            copy = Spotify_Copy.query.filter_by(status="pending").one()
+            self.assertEqual(copy.attempts, 1)
+            self.assertIn("Spotify is down", copy.error)
+
+            self.run_subscriptions(spotify)
+            db.session.expire_all()
+            copy = Spotify_Copy.query.get(copy.id)
+            self.assertEqual(copy.status, "failed")
+            self.assertEqual(copy.attempts, 2)
+        self.assertEqual(spotify.created, ["john_doe"])
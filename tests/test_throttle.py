@@ -0,0 +1,195 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask, request
+
+import throttle
+from throttle import Throttle, Throttled, failed, succeeded, throttled
+
+app = Flask(__name__)
+
+
+@app.route("/login", methods=["GET", "POST"])
+@throttled("login")
+def login():
+    if request.method == "GET":
+        return "form"
+    if request.form["password"] == "right":
+        succeeded()
+        return "welcome"
+    failed()
+    return "invalid", 401
+
+
+@app.errorhandler(Throttled)
+def too_many_attempts(e):
+    return "locked", 429, {"Retry-After": str(int(e.retry_after))}
+
+
+class ThrottleTestCase(TestCase):
+    """
+    Test the login throttle
+    """
+
+    def setUp(self):
+        """
+        Use a fresh throttle file for every test
+        """
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.throttle = Throttle(self.path, {"account_ip": 3, "account": 5, "ip": 8})
+        self.keys = self.throttle.keys("login", "John_Doe", "10.0.0.1")
+
+    def tearDown(self):
+        """
+        Remove the throttle file
+        """
+        os.remove(self.path)
+
+    def test_lockout(self):
+        """
+        TESTS:
+        - Failures under the limit aren't locked out
+        - Reaching the limit locks the account out from that address
+        - Other workers see the lockout through the file
+        """
+        self.assertEqual(self.throttle.failure(self.keys), 0)
+        self.assertEqual(self.throttle.failure(self.keys), 0)
+        self.throttle.check(self.keys)
+
+        self.assertEqual(self.throttle.failure(self.keys), throttle.LOCKOUT_SECONDS)
+        with self.assertRaises(Throttled) as locked:
+            self.throttle.check(self.keys)
+        self.assertGreater(locked.exception.retry_after, 0)
+
+        other = Throttle(self.path)
+        with self.assertRaises(Throttled):
+            other.check(self.throttle.keys("login", "john_doe", "10.0.0.1"))
+        other.check(self.throttle.keys("login", "john_doe", "10.0.0.2"))
+        other.check(self.throttle.keys("reset", "john_doe", "10.0.0.1"))
+
+    def test_lockout_doubles(self):
+        """
+        TESTS:
+        - Each lockout after the first lasts twice as long, up to the maximum
+        """
+        self.throttle.limits = {"account_ip": 3, "account": 100, "ip": 100}
+        seconds = []
+        for _ in range(3):
+            for _ in range(3):
+                locked = self.throttle.failure(self.keys)
+            seconds.append(locked)
+        self.assertEqual(
+            seconds,
+            [
+                throttle.LOCKOUT_SECONDS,
+                throttle.LOCKOUT_SECONDS * 2,
+                throttle.LOCKOUT_SECONDS * 4,
+            ],
+        )
+
+        with patch.object(throttle, "LOCKOUT_MAX", throttle.LOCKOUT_SECONDS):
+            for _ in range(3):
+                locked = self.throttle.failure(self.keys)
+        self.assertEqual(locked, throttle.LOCKOUT_SECONDS)
+
+    def test_success(self):
+        """
+        TESTS:
+        - Success clears the account's failures from that address
+        - Failures still count toward the address's limit
+        """
+        for _ in range(2):
+            self.throttle.failure(self.keys)
+        self.throttle.success(self.keys)
+        for _ in range(2):
+            self.throttle.failure(self.keys)
+        self.throttle.check(self.keys)
+
+        for name in ("a", "b", "c", "d"):
+            self.throttle.failure(self.throttle.keys("login", name, "10.0.0.1"))
+        with self.assertRaises(Throttled):
+            self.throttle.check(self.throttle.keys("login", "e", "10.0.0.1"))
+
+    def test_account_under_attack(self):
+        """
+        TESTS:
+        - Failures on one account from many addresses never lock the account
+          itself, so its owner can still sign in
+        - Past the account's limit every address locks on its first failure
+        """
+        for n in range(5):
+            self.throttle.failure(
+                self.throttle.keys("login", "john_doe", f"10.1.0.{n}")
+            )
+        self.throttle.check(self.keys)
+
+        self.assertEqual(self.throttle.failure(self.keys), throttle.LOCKOUT_SECONDS)
+        with self.assertRaises(Throttled):
+            self.throttle.check(self.keys)
+        self.throttle.check(self.throttle.keys("login", "john_doe", "10.0.0.2"))
+
+    def test_client_ip(self):
+        """
+        TESTS:
+        - Behind trusted proxies the client is the address the first of them
+          saw, otherwise the connection's address
+        """
+        headers = {"X-Forwarded-For": "1.2.3.4, 10.0.0.9"}
+        environ = {"REMOTE_ADDR": "10.0.0.1"}
+        with app.test_request_context(headers=headers, environ_base=environ):
+            self.assertEqual(throttle.client_ip(), "10.0.0.1")
+            with patch.object(throttle, "TRUSTED_PROXIES", 1):
+                self.assertEqual(throttle.client_ip(), "10.0.0.9")
+            with patch.object(throttle, "TRUSTED_PROXIES", 2):
+                self.assertEqual(throttle.client_ip(), "1.2.3.4")
+
+    def test_view(self):
+        """
+        TESTS:
+        - Locked out logins are turned away with a 429 before the view runs
+        - GETs are never throttled
+        """
+        client = app.test_client()
+        login = {"username": "john_doe", "password": "wrong"}
+        with patch.object(throttle, "throttle", self.throttle):
+            for _ in range(3):
+                self.assertEqual(client.post("/login", data=login).status_code, 401)
+
+            login["password"] = "right"
+            res = client.post("/login", data=login)
+            self.assertEqual(res.status_code, 429)
+            self.assertGreater(int(res.headers["Retry-After"]), 0)
+
+            self.assertEqual(client.get("/login").status_code, 200)
+
+            # Lockouts seen once are answered from memory
+            with patch.object(self.throttle, "connection", side_effect=AssertionError):
+                self.assertEqual(client.post("/login", data=login).status_code, 429)
+
+    def test_sliding_window(self):
+        """
+        TESTS:
+        - Failures in the previous window count in proportion to how much of it
+          is still inside the sliding window
+        """
+        window = self.throttle.window
+        start = int(time.time() // window) * window
+        recent = self.throttle.keys("login", "john_doe", "10.0.0.2")
+        old = self.throttle.keys("login", "jane_doe", "10.0.0.3")
+
+        with patch.object(throttle.time, "time", return_value=start - 1):
+            for keys in (recent, old):
+                self.throttle.failure(keys)
+                self.throttle.failure(keys)
+
+        with patch.object(throttle.time, "time", return_value=start + 1):
+            self.assertEqual(self.throttle.failure(recent), 0)
+            self.assertGreater(self.throttle.failure(recent), 0)
+
+        with patch.object(throttle.time, "time", return_value=start + window - 1):
+            self.assertEqual(self.throttle.failure(old), 0)
+            self.assertEqual(self.throttle.failure(old), 0)
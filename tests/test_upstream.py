@@ -0,0 +1,215 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import tekore
+
+import upstream
+from upstream import CircuitBreaker, ResponseCache, UpstreamSender, cache_key
+
+
+class CircuitBreakerTestCase(TestCase):
+    """
+    Test the upstream circuit breaker
+    """
+
+    def test_opens_after_threshold(self):
+        """
+        TESTS:
+        - Breaker opens after the failure threshold and fails fast
+        - Successes reset the failure count
+        """
+        breaker = CircuitBreaker("api", threshold=2, reset=60)
+
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.state, "closed")
+
+        breaker.failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_probe(self):
+        """
+        TESTS:
+        - Only one probe is let through when half open
+        - A failed probe reopens the breaker, a successful one closes it
+        """
+        breaker = CircuitBreaker("api", threshold=1, reset=0)
+        breaker.failure()
+
+        self.assertEqual(breaker.state, "half_open")
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, "closed")
+
+
+class ResponseCacheTestCase(TestCase):
+    """
+    Test the shared upstream response cache
+    """
+
+    def test_get_and_set(self):
+        """
+        TESTS:
+        - Responses round trip with their age
+        - Missing keys return None
+        """
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            cache = ResponseCache(path)
+            cache.set("key", {"setlist": [1, 2]})
+
+            body, age = cache.get("key")
+            self.assertEqual(body, {"setlist": [1, 2]})
+            self.assertGreaterEqual(age, 0)
+            self.assertIsNone(cache.get("missing"))
+        finally:
+            os.remove(path)
+
+
+class SingleFlightTestCase(TestCase):
+    """
+    Test request coalescing for identical upstream fetches
+    """
+
+    def setUp(self):
+        """
+        Use a fresh response cache for every test
+        """
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.original_cache = upstream.response_cache
+        upstream.response_cache = ResponseCache(self.path)
+
+    def tearDown(self):
+        """
+        Restore the response cache
+        """
+        upstream.response_cache = self.original_cache
+        os.remove(self.path)
+
+    def test_threads_share_one_fetch(self):
+        """
+        TESTS:
+        - Concurrent identical requests in one process fetch once
+        - Every caller gets the result
+        """
+        calls = []
+        started = threading.Event()
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return {"id": "abc"}
+
+        results = []
+
+        def call():
+            results.append(upstream.single_flight("key", fetch, lambda body: body))
+
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"id": "abc"}] * 5)
+
+    def test_other_process_result_from_cache(self):
+        """
+        TESTS:
+        - When another process holds the claim, the result is read from the
+          shared cache once that process stores it
+        """
+        upstream.response_cache.claim("key", 5)
+
+        def store():
+            time.sleep(0.1)
+            upstream.response_cache.set("key", {"id": "abc"})
+
+        threading.Thread(target=store).start()
+        result = upstream.single_flight(
+            "key", lambda: self.fail("fetched twice"), lambda body: body
+        )
+
+        self.assertEqual(result, {"id": "abc"})
+
+
+class FakeSender:
+    """
+    Answers every request with the token it was made with
+    """
+
+    is_async = False
+
+    def __init__(self):
+        self.requests = []
+
+    def send(self, request):
+        self.requests.append(request)
+        token = request.headers["Authorization"]
+        return tekore.Response(
+            url=request.url, headers={}, status_code=200, content={"token": token}
+        )
+
+
+class UpstreamSenderTestCase(TestCase):
+    """
+    Test which Spotify requests are cached and shared
+    """
+
+    def setUp(self):
+        """
+        Use a fresh response cache for every test
+        """
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.original_cache = upstream.response_cache
+        upstream.response_cache = ResponseCache(self.path)
+
+    def tearDown(self):
+        """
+        Restore the response cache
+        """
+        upstream.response_cache = self.original_cache
+        os.remove(self.path)
+
+    def test_only_app_token_cached(self):
+        """
+        TESTS:
+        - GETs made with a user's token are never cached, so they can't be
+          served to anyone else
+        - GETs made with the app's client token are cached
+        """
+        url = "https://api.spotify.com/v1/playlists/private"
+        key = cache_key("spotify", url, [])
+        inner = FakeSender()
+        sender = UpstreamSender(inner, public_token="app")
+
+        def get(token):
+            return sender.send(
+                tekore.Request(
+                    "GET", url, params={}, headers={"Authorization": f"Bearer {token}"}
+                )
+            )
+
+        self.assertEqual(get("user-a").content, {"token": "Bearer user-a"})
+        self.assertEqual(get("user-b").content, {"token": "Bearer user-b"})
+        self.assertIsNone(upstream.response_cache.get(key))
+
+        self.assertEqual(get("app").content, {"token": "Bearer app"})
+        self.assertEqual(upstream.response_cache.get(key)[0], {"token": "Bearer app"})
+        self.assertEqual(len(inner.requests), 3)
@@ -0,0 +1,275 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from functools import wraps
+
+from flask import g, request
+
+import metrics
+
+# Failures allowed per sliding window before a lockout
+WINDOW = int(os.environ.get("THROTTLE_WINDOW_SECONDS", 900))
+LIMITS = {
+    # One account from one address, the usual guessing attack
+    "account_ip": int(os.environ.get("THROTTLE_ACCOUNT_IP_LIMIT", 5)),
+    # One account from many addresses, past it each address gets one failure
+    # on the account before its lockout. The account itself is never locked,
+    # so nobody can lock its owner out just by knowing the username
+    "account": int(os.environ.get("THROTTLE_ACCOUNT_LIMIT", 20)),
+    # Many accounts from one address, credential stuffing
+    "ip": int(os.environ.get("THROTTLE_IP_LIMIT", 50)),
+}
+# First lockout, doubled for each lockout since the key was last quiet
+LOCKOUT_SECONDS = float(os.environ.get("THROTTLE_LOCKOUT_SECONDS", 60))
+LOCKOUT_MAX = float(os.environ.get("THROTTLE_LOCKOUT_MAX_SECONDS", 3600))
+# Proxies in front of the app that append to X-Forwarded-For, defaults to 1
+# on Heroku (which sets DYNO) for its router
+TRUSTED_PROXIES = int(
+    os.environ.get("THROTTLE_TRUSTED_PROXIES", 1 if "DYNO" in os.environ else 0)
+)
+
+
+class Throttled(Exception):
+    """
+    Raised when an attempt comes from a locked out account or address
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Locked out for {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def client_ip():
+    """
+    Returns the client's address, as seen by the first trusted proxy
+    """
+    if TRUSTED_PROXIES and len(request.access_route) >= TRUSTED_PROXIES:
+        return request.access_route[-TRUSTED_PROXIES]
+    return request.remote_addr or ""
+
+
+class Throttle:
+    """
+    - Sliding window failure counts and lockouts shared by every worker
+      through a SQLite file
+    - Each worker also remembers the lockouts it has seen, so repeat attempts
+      are turned away without touching the file
+    """
+
+    def __init__(self, path, limits=LIMITS, window=WINDOW):
+        self.path = path
+        self.limits = limits
+        self.window = window
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.locked_until = {}
+
+    def connection(self):
+        """
+        Returns this thread's connection, creating the tables on first use
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS throttle_counts "
+                "(key TEXT NOT NULL, window INTEGER NOT NULL, "
+                "failures INTEGER NOT NULL, PRIMARY KEY (key, window))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS throttle_locks "
+                "(key TEXT PRIMARY KEY, locked_until REAL NOT NULL, "
+                "strikes INTEGER NOT NULL)"
+            )
+            self.local.conn = conn
+        return conn
+
+    def keys(self, action, account, ip):
+        """
+        Returns the keys an attempt is counted under, by scope
+        """
+        account = account.strip().lower()
+        return {
+            "account_ip": f"{action}|{account}|{ip}",
+            "account": f"{action}|{account}",
+            "ip": f"{action}||{ip}",
+        }
+
+    def check(self, keys):
+        """
+        Raises Throttled if any of the keys is locked out
+        """
+        now = time.time()
+        with self.lock:
+            until = max(self.locked_until.get(key, 0) for key in keys.values())
+        if until > now:
+            raise Throttled(until - now)
+
+        placeholders = ", ".join("?" * len(keys))
+        rows = (
+            self.connection()
+            .execute(
+                "SELECT key, locked_until FROM throttle_locks "
+                f"WHERE key IN ({placeholders}) AND locked_until > ?",
+                [*keys.values(), now],
+            )
+            .fetchall()
+        )
+        if rows:
+            with self.lock:
+                self.locked_until.update(rows)
+            raise Throttled(max(until for key, until in rows) - now)
+
+    def failure(self, keys):
+        """
+        - Counts a failed attempt under each key
+        - A key whose sliding window count reaches its limit is locked out,
+          for twice as long as its last lockout unless it's been quiet since
+        - The account-wide key is never locked, past its limit the account's
+          key for this address locks on its first failure instead
+        - Returns the seconds locked out, 0 if nothing was locked
+        """
+        now = time.time()
+        current = int(now // self.window)
+        # Share of the previous window still inside the sliding window
+        overlap = 1 - (now % self.window) / self.window
+        locked = 0
+
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            failures = {}
+            for scope, key in keys.items():
+                conn.execute(
+                    "INSERT INTO throttle_counts (key, window, failures) "
+                    "VALUES (?, ?, 1) ON CONFLICT (key, window) "
+                    "DO UPDATE SET failures = failures + 1",
+                    (key, current),
+                )
+                counts = dict(
+                    conn.execute(
+                        "SELECT window, failures FROM throttle_counts "
+                        "WHERE key = ? AND window >= ?",
+                        (key, current - 1),
+                    ).fetchall()
+                )
+                failures[scope] = (
+                    counts.get(current, 0) + counts.get(current - 1, 0) * overlap
+                )
+
+            limits = {
+                "account_ip": self.limits["account_ip"],
+                "ip": self.limits["ip"],
+            }
+            if failures["account"] >= self.limits["account"]:
+                # Guessed at from many addresses, slow each of them down
+                limits["account_ip"] = 1
+
+            for scope, limit in limits.items():
+                if failures[scope] < limit:
+                    continue
+
+                key = keys[scope]
+                row = conn.execute(
+                    "SELECT locked_until, strikes FROM throttle_locks WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                strikes = 1
+                if row is not None and now - row[0] < LOCKOUT_MAX + self.window:
+                    strikes = row[1] + 1
+                seconds = min(LOCKOUT_SECONDS * 2 ** (strikes - 1), LOCKOUT_MAX)
+                conn.execute(
+                    "INSERT INTO throttle_locks (key, locked_until, strikes) "
+                    "VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                    "locked_until = excluded.locked_until, strikes = excluded.strikes",
+                    (key, now + seconds, strikes),
+                )
+                # Start counting afresh once the lockout ends
+                conn.execute("DELETE FROM throttle_counts WHERE key = ?", (key,))
+                locked = max(locked, seconds)
+
+            conn.execute("DELETE FROM throttle_counts WHERE window < ?", (current - 1,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        if locked:
+            with self.lock:
+                for key in keys.values():
+                    self.locked_until.pop(key, None)
+        return locked
+
+    def success(self, keys):
+        """
+        Clears the account's failures from this address, the wider scopes keep
+        counting so an attacker can't reset them with an account of their own
+        """
+        conn = self.connection()
+        conn.execute("DELETE FROM throttle_counts WHERE key = ?", (keys["account_ip"],))
+        conn.execute("DELETE FROM throttle_locks WHERE key = ?", (keys["account_ip"],))
+
+
+throttle = Throttle(
+    os.environ.get(
+        "THROTTLE_DB", os.path.join(tempfile.gettempdir(), "setplaylist-throttle.db")
+    )
+)
+
+
+def throttled(action, account=None):
+    """
+    - Turns away POSTs to a view from locked out accounts and addresses
+      before any database or hashing work
+    - account gets the view's arguments and returns the account the attempt
+      is for, by default the form's username
+    - The view reports the outcome with failed() and succeeded()
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "POST":
+                return view(*args, **kwargs)
+
+            if account is None:
+                name = request.form.get("username", "")
+            else:
+                name = account(**kwargs)
+            keys = throttle.keys(action, name, client_ip())
+            try:
+                throttle.check(keys)
+            except Throttled:
+                metrics.store.add(
+                    "setplaylist_auth_throttle_total",
+                    {"action": action, "result": "rejected"},
+                )
+                raise
+            g.throttle = (action, keys)
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def failed():
+    """
+    Counts a failed attempt for the current request
+    """
+    action, keys = g.throttle
+    result = "locked" if throttle.failure(keys) else "failed"
+    metrics.store.add(
+        "setplaylist_auth_throttle_total", {"action": action, "result": result}
+    )
+
+
+def succeeded():
+    """
+    Clears the current request's account from this address
+    """
+    action, keys = g.throttle
+    throttle.success(keys)
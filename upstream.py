@@ -0,0 +1,513 @@
+import hmac
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+import httpx
+import requests
+import tekore
+
+from metrics import upstream_timer
+from ratelimit import RateLimitExceeded, background, governor
+
+CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 10))
+
+FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5))
+RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", 30))
+
+# Seconds a cached response is served without revalidating
+TTLS = {
+    "setlistfm": int(os.environ.get("SETLIST_FM_CACHE_TTL", 3600)),
+    "bandsintown": int(os.environ.get("BANDSINTOWN_CACHE_TTL", 3600)),
+}
+# Upstream calls a single async request may have in flight at once
+REQUEST_CONCURRENCY = int(os.environ.get("UPSTREAM_REQUEST_CONCURRENCY", 8))
+CACHE_MAX_ENTRIES = int(os.environ.get("UPSTREAM_CACHE_MAX_ENTRIES", 50000))
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised when an upstream API fails and there's no cached response to serve
+    """
+
+    def __init__(self, api):
+        super().__init__(f"{api} is unavailable")
+        self.api = api
+
+
+class CircuitBreaker:
+    """
+    - Closed: requests go through, consecutive failures are counted
+    - Open: after FAILURE_THRESHOLD failures requests fail fast
+    - Half open: after RESET_TIMEOUT one probe request is let through,
+      closing the breaker on success and reopening it on failure
+    """
+
+    def __init__(self, name, threshold=FAILURE_THRESHOLD, reset=RESET_TIMEOUT):
+        self.name = name
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        """
+        Returns "closed", "open" or "half_open"
+        """
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.reset:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        """
+        Returns True if a request may be sent now
+        """
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def success(self):
+        """
+        Closes the breaker
+        """
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        """
+        Counts a failure, opening the breaker at the threshold or on a failed probe
+        """
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.time()
+            self.probing = False
+
+
+breakers = {api: CircuitBreaker(api) for api in ("spotify", "setlistfm", "bandsintown")}
+
+
+class ResponseCache:
+    """
+    Upstream JSON responses shared by every worker through a SQLite file
+    """
+
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.writes = 0
+
+    def connection(self):
+        """
+        Returns this thread's connection, creating the table on first use
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, body TEXT NOT NULL, fetched REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_responses_fetched "
+                "ON responses (fetched)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS inflight "
+                "(key TEXT PRIMARY KEY, expires REAL NOT NULL)"
+            )
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        """
+        Returns (body, age in seconds) or None if the key isn't cached
+        """
+        row = (
+            self.connection()
+            .execute("SELECT body, fetched FROM responses WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return json.loads(row[0]), time.time() - row[1]
+
+    def set(self, key, body):
+        """
+        Saves a response, pruning the oldest entries every 1000 writes
+        """
+        conn = self.connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, body, fetched) VALUES (?, ?, ?)",
+            (key, json.dumps(body), time.time()),
+        )
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            conn.execute(
+                "DELETE FROM responses WHERE key NOT IN "
+                "(SELECT key FROM responses ORDER BY fetched DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def claim(self, key, lease):
+        """
+        - Claims the key for a fetch in this process, for up to lease seconds
+        - Returns False if another process holds an unexpired claim
+        """
+        conn = self.connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM inflight WHERE key = ? AND expires < ?", (key, now)
+            )
+            claimed = conn.execute(
+                "INSERT OR IGNORE INTO inflight (key, expires) VALUES (?, ?)",
+                (key, now + lease),
+            ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return claimed == 1
+
+    def claimed(self, key):
+        """
+        Returns True if a process holds an unexpired claim on the key
+        """
+        row = (
+            self.connection()
+            .execute(
+                "SELECT 1 FROM inflight WHERE key = ? AND expires >= ?",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def release(self, key):
+        """
+        Releases this process's claim on the key
+        """
+        self.connection().execute("DELETE FROM inflight WHERE key = ?", (key,))
+
+
+response_cache = ResponseCache(
+    os.environ.get(
+        "UPSTREAM_CACHE_DB",
+        os.path.join(tempfile.gettempdir(), "setplaylist-cache.db"),
+    )
+)
+
+revalidating = set()
+revalidating_lock = threading.Lock()
+
+
+class Flight:
+    """
+    An in-progress fetch that other threads can wait on
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+flights = {}
+flights_lock = threading.Lock()
+
+LEASE = CONNECT_TIMEOUT + READ_TIMEOUT + 1
+POLL_INTERVAL = 0.05
+
+
+def single_flight(key, fetch_fn, from_cache):
+    """
+    - Runs fetch_fn once for concurrent identical requests
+    - Threads in this process wait for the leader's result
+    - Other processes wait for the leader to store the response in the
+      shared cache, then build their result from it with from_cache
+    - Returns the fetched result
+    """
+    with flights_lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = Flight()
+
+    if not leader:
+        flight.done.wait(LEASE)
+        if flight.error is not None:
+            raise flight.error
+        if flight.done.is_set():
+            return flight.result
+        return fetch_fn()
+
+    try:
+        flight.result = shared_flight(key, fetch_fn, from_cache)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with flights_lock:
+            del flights[key]
+        flight.done.set()
+
+
+def shared_flight(key, fetch_fn, from_cache):
+    """
+    Coordinates a fetch with other processes through the response cache
+    """
+    started = time.time()
+    if response_cache.claim(key, LEASE):
+        try:
+            return fetch_fn()
+        finally:
+            response_cache.release(key)
+
+    while time.time() - started < LEASE:
+        time.sleep(POLL_INTERVAL)
+        cached = response_cache.get(key)
+        if cached is not None and cached[1] <= time.time() - started:
+            return from_cache(cached[0])
+        if not response_cache.claimed(key):
+            break
+
+    return fetch_fn()
+
+
+def cache_key(api, path, params):
+    """
+    Returns the response cache key for a request
+    """
+    return f"{api} {path}?{urlencode(list(params or []))}"
+
+
+def fetch(api, url, headers, params):
+    """
+    - Sends a GET through the api's rate limiter and circuit breaker
+    - Raises UpstreamUnavailable if the breaker is open or the request fails
+    - Returns (status code, decoded JSON)
+    """
+    governor.acquire(api)
+
+    breaker = breakers[api]
+    if not breaker.allow():
+        raise UpstreamUnavailable(api)
+
+    try:
+        res = requests.get(
+            url,
+            headers=headers,
+            params=params,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        )
+        if res.status_code == 429 or res.status_code >= 500:
+            raise UpstreamUnavailable(api)
+        body = res.json()
+    except (requests.RequestException, ValueError, UpstreamUnavailable):
+        breaker.failure()
+        raise UpstreamUnavailable(api)
+
+    breaker.success()
+    return res.status_code, body
+
+
+def revalidate(api, key, url, headers, params):
+    """
+    Refreshes a stale cache entry in a background thread
+    """
+
+    def run():
+        try:
+            with background():
+                status, body = fetch(api, url, headers, params)
+            if status == 200:
+                response_cache.set(key, body)
+        except Exception:
+            pass
+        finally:
+            with revalidating_lock:
+                revalidating.discard(key)
+
+    with revalidating_lock:
+        if key in revalidating:
+            return
+        revalidating.add(key)
+    threading.Thread(target=run, daemon=True).start()
+
+
+def cached_get(api, key, url, headers, params):
+    """
+    - Serves fresh cached responses without calling the api
+    - Serves stale cached responses immediately and revalidates in the background
+    - Otherwise fetches once for all concurrent callers, caching successful
+      responses
+    - Returns the decoded JSON response
+    """
+    with upstream_timer(api) as call:
+        cached = response_cache.get(key)
+
+        if cached is not None:
+            body, age = cached
+            call.cache = "hit"
+            if age >= TTLS[api]:
+                call.cache = "stale"
+                revalidate(api, key, url, headers, params)
+            return body
+
+        def fetch_and_store():
+            status, body = fetch(api, url, headers, params)
+            if status == 200:
+                response_cache.set(key, body)
+            return body
+
+        def shared(body):
+            call.cache = "shared"
+            return body
+
+        return single_flight(key, fetch_and_store, shared)
+
+
+class UpstreamSender(tekore.ExtendingSender):
+    """
+    - Tekore sender that applies the Spotify rate limiter and circuit breaker,
+      serving the last good response for public GETs while Spotify is failing
+    - Public GETs are the ones made with the app's client token (public_token),
+      requests made with a user's token are never cached or shared
+    """
+
+    def __init__(self, sender=None, public_token=None):
+        super().__init__(sender)
+        self.public_token = public_token
+
+    def is_public(self, request):
+        """
+        Whether the request is a GET made with the app's client token
+        """
+        if request.method != "GET" or self.public_token is None:
+            return False
+        authorization = (request.headers or {}).get("Authorization", "")
+        return hmac.compare_digest(authorization, f"Bearer {self.public_token}")
+
+    def send(self, request):
+        """
+        - Delegate to the underlying sender, falling back to a stale response
+        - Concurrent identical public GETs share one request
+        """
+        with upstream_timer("spotify") as call:
+            if not self.is_public(request):
+                return self.send_now(request, None, call)
+
+            params = sorted((request.params or {}).items())
+            key = cache_key("spotify", request.url, params)
+
+            def shared(body):
+                call.cache = "shared"
+                return tekore.Response(
+                    url=request.url, headers={}, status_code=200, content=body
+                )
+
+            return single_flight(key, lambda: self.send_now(request, key, call), shared)
+
+    def send_now(self, request, key, call):
+        """
+        Sends the request, caching the response under key if given
+        """
+        try:
+            governor.acquire("spotify")
+        except RateLimitExceeded:
+            return self.stale(request, key, call, RateLimitExceeded("spotify"))
+
+        breaker = breakers["spotify"]
+        if not breaker.allow():
+            return self.stale(request, key, call, UpstreamUnavailable("spotify"))
+
+        try:
+            res = self.sender.send(request)
+        except httpx.HTTPError:
+            breaker.failure()
+            return self.stale(request, key, call, UpstreamUnavailable("spotify"))
+
+        if res.status_code >= 500:
+            breaker.failure()
+            return self.stale(request, key, call, UpstreamUnavailable("spotify"))
+
+        breaker.success()
+        if key and res.status_code == 200 and res.content is not None:
+            response_cache.set(key, res.content)
+        return res
+
+    def stale(self, request, key, call, error):
+        """
+        Returns the last good response for the request, or raises the error
+        """
+        cached = response_cache.get(key) if key else None
+        if cached is None:
+            raise error
+        call.cache = "stale"
+        return tekore.Response(
+            url=request.url, headers={}, status_code=200, content=cached[0]
+        )
+
+
+def spotify_sender(public_token=None):
+    """
+    - Returns the sender used for all Spotify API calls
+    - Only GETs made with public_token, the app's client token, are cached
+    """
+    client = httpx.Client(timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT))
+    return tekore.RetryingSender(
+        sender=UpstreamSender(tekore.SyncSender(client=client), public_token)
+    )
+
+
+def setlistfm_get(path, params=None):
+    """
+    - GET a Setlist.fm API path under the rate limiter, breaker and cache
+    - Returns the decoded JSON response
+    """
+    return cached_get(
+        "setlistfm",
+        cache_key("setlistfm", path, params),
+        os.environ.get("SETLIST_FM_BASE_URL") + path,
+        {
+            "Accept": "application/json",
+            "x-api-key": os.environ.get("SETLIST_FM_API_KEY"),
+        },
+        params,
+    )
+
+
+def bandsintown_get(path, params=None):
+    """
+    - GET a Bandsintown API path under the rate limiter, breaker and cache
+    - Returns the decoded JSON response
+    """
+    return cached_get(
+        "bandsintown",
+        cache_key("bandsintown", path, params),
+        os.environ.get("BANDSINTOWN_BASE_URL") + path,
+        {"accept": "application/json"},
+        [("app_id", os.environ.get("BIT_APP_ID"))] + list(params or []),
+    )